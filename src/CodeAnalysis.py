@@ -60,15 +60,20 @@
     >>> parsed = c.parse()
 
 '''
+import re
+from array import array
 
 
 class CodeAnalysis(object):
     ''' Top level analysis class. Sets up the required directory information
         and provides access to the analyser. '''
 
-    def __init__(self):
+    def __init__(self, instrumentation=None, reader=None, dedup=False):
         self._directory_info = []
         self._files = []
+        self._instrumentation = instrumentation
+        self._reader = reader
+        self._dedup = dedup
 
     def __str__(self):
         result = "CodeAnalysis:\n"
@@ -90,6 +95,46 @@ class CodeAnalysis(object):
             result += "\n"
         return result
 
+    @property
+    def instrumentation(self):
+        ''' the :class:`Instrumentation` recording the cost of the parse,
+            or None (the default) if the parse is not instrumented '''
+        return self._instrumentation
+
+    @instrumentation.setter
+    def instrumentation(self, instrumentation):
+        self._instrumentation = instrumentation
+
+    @property
+    def reader(self):
+        ''' the :class:`SourceReader` used to find and read the source
+            files, or None (the default) to walk the directories with
+            walkdir and let fparser read each file '''
+        return self._reader
+
+    @reader.setter
+    def reader(self, reader):
+        self._reader = reader
+
+    @property
+    def dedup(self):
+        ''' Whether :func:`parse` and :func:`iter_parse` parse each unique
+            source only once. A file that is the same file as one already
+            found (through a symbolic link, a hard link or overlapping
+            directories) is skipped, so each physical file is analysed
+            once. A different file with the same content as one already
+            found (for example an unchanged file in another version of a
+            model) is not parsed again. It is given a copy of the analysis
+            of the first one instead (see :func:`File.copy`). The analysis of
+            every unique file is kept until the parse finishes, and a file
+            whose content is found again is released. The default is
+            False. '''
+        return self._dedup
+
+    @dedup.setter
+    def dedup(self, dedup):
+        self._dedup = dedup
+
     def add_directory(self, my_directory, recurse_depth=None,
                       included_files=['*.f90', '*.f'],
                       excluded_dirs=['.*']):
@@ -116,217 +161,4488 @@ class CodeAnalysis(object):
         dir_map["excluded_dirs"] = excluded_dirs
         self._directory_info.append(dir_map)
 
-    def parse(self, link=False):
+    def parse(self, link=False, workers=None, cache=None, timeout=None,
+              memory_limit=None):
         ''' Parse all of the matched files, print out the path of each one and
             whether the parsing was successful. Print a summary at the end. By
-            default also link calls and subroutines together'''
+            default also link calls and subroutines together
+
+        :param workers: the number of processes to spread the parsing and
+                        analysis over. 'None' (the default) or 1 parses
+                        the files one at a time in this process. When
+                        more than one worker is used the returned files
+                        are compact summaries that no longer hold the
+                        fparser ast (see :func:`File.release`).
+        :type workers: int.
+        :param cache: an optional persistent cache of analysed files. Files
+                      whose content has not changed since they were cached
+                      are loaded from the cache rather than parsed. As with
+                      workers, the returned files are compact summaries.
+        :type cache: :class:`ParseCache`
+        :param timeout: if given, each file is parsed and analysed in an
+                        isolated worker process (see workers) that is
+                        killed if the file takes longer than this number of
+                        seconds. The file is reported as timed out and the
+                        run carries on. As with workers, the returned files
+                        are compact summaries.
+        :type timeout: float.
+        :param memory_limit: if given, files are parsed in isolated worker
+                             processes as for timeout and the address space
+                             of each worker is limited to this number of
+                             bytes. A file that exceeds the limit is
+                             reported as failed.
+        :type memory_limit: int.
+        '''
+        for my_file in self._iter_parse(workers, cache, False, timeout,
+                                        memory_limit):
+            self._files.append(my_file)
+        return self._files
+
+    def iter_parse(self, workers=None, cache=None, timeout=None,
+                   memory_limit=None):
+        ''' Parse all of the matched files in the same way as :func:`parse`
+            but return a generator that yields each successfully parsed
+            file as soon as it has been analysed. The fparser ast of each
+            file is released once it has been analysed and the files are
+            not stored in this object, so the memory used only depends on
+            the largest single file (plus whatever the caller keeps).
+
+            For example:
+
+            >>> stats = Stats()
+            >>> stats.apply(c.iter_parse())
+
+        :param workers: as for :func:`parse`.
+        :type workers: int.
+        :param cache: as for :func:`parse`.
+        :type cache: :class:`ParseCache`
+        :param timeout: as for :func:`parse`.
+        :type timeout: float.
+        :param memory_limit: as for :func:`parse`.
+        :type memory_limit: int.
+        '''
+        return self._iter_parse(workers, cache, True, timeout, memory_limit)
+
+    def scan(self):
+        ''' Build the files from all of the matched files using the fast
+            :class:`Scanner` rather than fparser. This finds the modules,
+            subroutines, USE statements and calls, so the files can be
+            linked, at close to the speed the files can be read, but does
+            not count statements. Files that need a deeper analysis can
+            then be fully parsed with :func:`update`, which replaces their
+            scanned versions.
+
+            For example:
+
+            >>> scanned = c.scan()
+            >>> link = Link()
+            >>> link.transform(scanned)
+            >>> c.update(["/home/rupert/proj/jules/src/sbc.f90"], link=link)
+
+        :return: the list of files.
+        '''
+        scanner = Scanner()
+        instrumentation = self._instrumentation
+        for dir_info in self._directory_info:
+            list_files = self._discover_directory(dir_info)
+            print "Found {0} matching files in directory '{1}'" \
+                  .format(str(len(list_files)), dir_info["directory"])
+            if instrumentation is not None:
+                with instrumentation.stage("scan") as stage:
+                    scanned = self._scan_files(scanner, list_files)
+                    stage.count += len(list_files)
+            else:
+                scanned = self._scan_files(scanner, list_files)
+            failed = []
+            for my_file in scanned:
+                if my_file.parsed_ok:
+                    self._files.append(my_file)
+                else:
+                    failed.append(my_file.path)
+            print "{0} out of {1} files successfully scanned". \
+                  format(str(len(list_files) - len(failed)),
+                         str(len(list_files)))
+            if failed:
+                print "    failed: {0}".format(" ".join(failed))
+        return self._files
+
+    def set_files(self, files):
+        ''' Use files that have already been analysed (for example loaded
+            from an :class:`AnalysisDatabase`) as the parsed files, so that
+            :func:`update` can be used on them. The list itself is kept,
+            and updated in place, as a :class:`Link` may hold it.
+
+        :param files: the analysed files.
+        :type files: list of :class:`File`
+        '''
+        self._files = files
+        return self._files
+
+    def pipeline(self, workers=None, queue_size=64, readers=4):
+        ''' Return a :class:`Pipeline` over the matched files, in which
+            discovery, reading, parsing and linking overlap.
+
+        :param workers: as for :func:`parse`.
+        :type workers: int.
+        :param queue_size: the bound on the number of items waiting between
+                           stages.
+        :type queue_size: int.
+        :param readers: the number of threads reading files.
+        :type readers: int.
+        '''
+        return Pipeline(self, workers, queue_size, readers)
+
+    def lazy(self, workers=None, cache=None):
+        ''' Return a :class:`LazyAnalysis` of the matched files, which
+            only parses the files needed to answer each call tree query.
+
+        :param workers: as for :func:`parse`.
+        :type workers: int.
+        :param cache: as for :func:`parse`.
+        :type cache: :class:`ParseCache`
+        '''
+        return LazyAnalysis(self, workers, cache)
+
+    def _scan_files(self, scanner, list_files):
+        ''' return the scanned file for each of list_files '''
+        if self._reader is None:
+            return [scanner.scan(file_path) for file_path in list_files]
+        return [scanner.scan(file_path, source) for file_path, source
+                in self._reader.iter_read(list_files)]
+
+    def discover(self):
+        ''' return the paths of all of the files matched by the added
+            directories, without parsing them '''
+        paths = []
+        for dir_info in self._directory_info:
+            paths.extend(self._discover_directory(dir_info))
+        return paths
+
+    def _discover_directory(self, dir_info):
+        ''' return a list of the paths of the matching files in one of the
+            added directories '''
+        if self._reader is not None:
+            return self._reader.discover(dir_info)
+        return list(_walk_files(dir_info["directory"],
+                                dir_info["included_files"],
+                                dir_info["excluded_dirs"],
+                                dir_info["depth"]))
+
+    def _iter_parse(self, workers, cache, release, timeout=None,
+                    memory_limit=None):
+        ''' the generator behind :func:`parse` and :func:`iter_parse` '''
+        instrumentation = self._instrumentation
+        if instrumentation is not None:
+            instrumentation.start_profile()
+        dedup = _Deduplicator() if self._dedup else None
         try:
-            from walkdir import filtered_walk, file_paths
-        except ImportError:
-            raise RuntimeError(
-                "CodeAnalysis requires walkdir <http://walkdir.readthedocs.org"
-                "/en/latest/#obtaining-the-module> to be installed")
+            for my_file in self._iter_directories(workers, cache, release,
+                                                  timeout, memory_limit,
+                                                  dedup):
+                yield my_file
+        finally:
+            if instrumentation is not None:
+                instrumentation.stop_profile()
+
+    def _iter_directories(self, workers, cache, release, timeout,
+                          memory_limit, dedup=None):
+        ''' parse each of the added directories in turn. If dedup is
+            given, files it has already seen through another path are
+            skipped, and files with the same content as one it has seen
+            are copied rather than parsed. '''
+        instrumentation = self._instrumentation
         for dir_info in self._directory_info:
-            files = file_paths(
-                filtered_walk(dir_info["directory"],
-                              included_files=dir_info["included_files"],
-                              excluded_dirs=dir_info["excluded_dirs"],
-                              depth=dir_info["depth"]))
-            #print '\n'.join(files)
-            list_files = list(files)
+            if instrumentation is not None:
+                with instrumentation.stage("discover") as stage:
+                    list_files = self._discover_directory(dir_info)
+                    stage.count += len(list_files)
+            else:
+                list_files = self._discover_directory(dir_info)
             print "Found {0} matching files in directory '{1}'" \
                   .format(str(len(list_files)), dir_info["directory"])
             success = 0
+            failed = []
+            timed_out = []
+            n_seen = 0
+            if dedup is not None:
+                # each physical file is analysed once, whatever the path
+                n_seen = len(list_files)
+                list_files = [file_path for file_path in list_files
+                              if dedup.same_file(file_path) is None]
+                n_seen -= len(list_files)
+                if instrumentation is not None and n_seen:
+                    instrumentation.count("files seen before", n_seen)
+            originals = [None] * len(list_files)
+            to_parse = list_files
+            if dedup is not None:
+                originals = [dedup.original(file_path)
+                             for file_path in list_files]
+                to_parse = [file_path for file_path, original in
+                            zip(list_files, originals) if original is None]
+                if instrumentation is not None:
+                    instrumentation.count(
+                        "duplicate files", len(list_files) - len(to_parse))
+            parsed_files = self._parse_files(to_parse, workers, cache,
+                                             release, instrumentation,
+                                             timeout, memory_limit,
+                                             self._reader)
             for idx, file_path in enumerate(list_files):
-                my_file = File()
-                ok = my_file.parse(file_path)
-                if ok:
-                    my_file.analyse()
-                    self._files.append(my_file)
-                    print "[{0}/{1}][ok] {2}".format(idx + 1,
-                                                     len(list_files),
-                                                     file_path)
+                original = originals[idx]
+                if original is None:
+                    my_file = next(parsed_files)
+                    if dedup is not None:
+                        dedup.add(my_file)
+                else:
+                    my_file = dedup.copy(original, file_path)
+                if my_file.parsed_ok:
+                    if original is None:
+                        print "[{0}/{1}][ok] {2}".format(idx + 1,
+                                                         len(list_files),
+                                                         file_path)
+                    else:
+                        print "[{0}/{1}][ok] {2} (identical to {3})".format(
+                            idx + 1, len(list_files), file_path, original)
                     success += 1
+                    yield my_file
+                elif my_file.failure == "timeout":
+                    print "[{0}/{1}][timeout] {2}".format(idx + 1,
+                                                          len(list_files),
+                                                          file_path)
+                    timed_out.append(file_path)
                 else:
                     print "[{0}/{1}][failed] {2}".format(idx + 1,
                                                          len(list_files),
                                                          file_path)
+                    failed.append(file_path)
             print "{0} out of {1} files successfully examined". \
                   format(str(success), str(len(list_files)))
+            if n_seen:
+                print "    {0} files had already been examined through " \
+                      "another path".format(n_seen)
+            if len(to_parse) < len(list_files):
+                print "    {0} files were identical to files already " \
+                      "examined".format(len(list_files) - len(to_parse))
+            if failed:
+                print "    failed: {0}".format(" ".join(failed))
+            if timed_out:
+                print "    timed out: {0}".format(" ".join(timed_out))
+
+    def update(self, changed_paths, link=None, workers=None, cache=None,
+               timeout=None, memory_limit=None):
+        ''' Re-parse and re-analyse only the files in changed_paths,
+            replacing any previous results for those files. A changed path
+            that no longer exists is removed. If the files have been linked
+            then pass the Link object so that only the affected calls are
+            re-linked.
+
+        :param changed_paths: the paths of the files that have changed.
+        :type changed_paths: list of str
+        :param link: the Link that has been used to transform the files.
+        :type link: :class:`Link`
+        :param workers: as for :func:`parse`.
+        :type workers: int.
+        :param cache: as for :func:`parse`.
+        :type cache: :class:`ParseCache`
+        :param timeout: as for :func:`parse`.
+        :type timeout: float.
+        :param memory_limit: as for :func:`parse`.
+        :type memory_limit: int.
+        :return: the updated list of files.
+        '''
+        import os
+        positions = {}
+        for idx, my_file in enumerate(self._files):
+            positions[os.path.abspath(my_file.path)] = idx
+
+        old_files = []
+        new_files = []
+        removed = []
+        to_parse = []
+        for file_path in changed_paths:
+            idx = positions.get(os.path.abspath(file_path))
+            if idx is not None:
+                old_files.append(self._files[idx])
+            if os.path.isfile(file_path):
+                to_parse.append(file_path)
+            elif idx is not None:
+                removed.append(idx)
+
+        parsed_files = self._parse_files(
+            to_parse, workers, cache, False, self._instrumentation, timeout,
+            memory_limit, self._reader)
+        for file_path, my_file in zip(to_parse, parsed_files):
+            idx = positions.get(os.path.abspath(file_path))
+            if my_file.parsed_ok:
+                new_files.append(my_file)
+                if idx is None:
+                    self._files.append(my_file)
+                else:
+                    self._files[idx] = my_file
+                print "[update][ok] {0}".format(file_path)
+            else:
+                if idx is not None:
+                    removed.append(idx)
+                print "[update][{0}] {1}".format(
+                    "timeout" if my_file.failure == "timeout" else "failed",
+                    file_path)
+        # the list is modified in place as Link holds a reference to it
+        for idx in sorted(removed, reverse=True):
+            del self._files[idx]
+
+        if link is not None:
+            link.update(old_files, new_files)
         return self._files
 
+    @staticmethod
+    def _parse_files(list_files, workers=None, cache=None, release=False,
+                     instrumentation=None, timeout=None, memory_limit=None,
+                     reader=None):
+        ''' Generator returning the parsed and analysed File for each of
+            the supplied paths, in the same order as the paths. Files found
+            in the cache are returned directly, the rest are parsed either
+            serially or in a pool of worker processes. Files are released
+            if requested or if they come from, or go to, a worker process
+            or the cache. If instrumentation is given the cost of each
+            parsed file is recorded in it. If a timeout or memory limit is
+            given the files are parsed in isolated worker processes (see
+            :class:`_IsolatedParser`). If a reader is given, files parsed in
+            this process are read ahead by it and parsed from memory. '''
+        import time
+        cached_files = {}
+        to_parse = list_files
+        if cache is not None:
+            to_parse = []
+            for idx, file_path in enumerate(list_files):
+                start = time.time()
+                my_file = cache.get(file_path)
+                if my_file is None:
+                    to_parse.append(file_path)
+                else:
+                    cached_files[idx] = my_file
+                    if instrumentation is not None:
+                        instrumentation.add_file(FileRecord(
+                            file_path, 0, time.time() - start, 0.0,
+                            sum(my_file.statement_counts),
+                            my_file.parsed_ok, cached=True))
+        release = release or cache is not None
+        parse_file = _parse_file
+        if instrumentation is not None:
+            parse_file = _parse_file_timed
+        pool = None
+        if (timeout is not None or memory_limit is not None) and to_parse:
+            pool = _IsolatedParser(workers, timeout, memory_limit,
+                                   timed=instrumentation is not None)
+            new_files = pool.imap(to_parse)
+        elif workers is not None and workers > 1 and to_parse:
+            import multiprocessing
+            pool = multiprocessing.Pool(processes=workers)
+            # imap returns the results in the order of to_parse so
+            # the progress output and self._files stay deterministic
+            new_files = pool.imap(parse_file, to_parse)
+        elif reader is not None:
+            new_files = (parse_file(file_path, release=release, source=source)
+                         for file_path, source in reader.iter_read(to_parse))
+        else:
+            new_files = (parse_file(file_path, release=release)
+                         for file_path in to_parse)
+        try:
+            for idx in range(len(list_files)):
+                if idx in cached_files:
+                    yield cached_files.pop(idx)
+                else:
+                    my_file = next(new_files)
+                    if instrumentation is not None:
+                        my_file, record = my_file
+                        instrumentation.add_file(record)
+                        if my_file.failure == "timeout":
+                            instrumentation.count("files timed out")
+                    # running out of time or memory, or being killed, may
+                    # not happen with other limits so only successes and
+                    # parse errors are cached. Under a memory limit fparser
+                    # can fail in other ways when it runs out, so a parse
+                    # error may be down to the limit and is not cached.
+                    if cache is not None and \
+                       (my_file.failure is None or
+                        my_file.failure == "error" and memory_limit is None):
+                        cache.put(my_file)
+                    yield my_file
+        finally:
+            if pool is not None:
+                pool.terminate()
+                pool.join()
+
 
-class CodeAnalysisUtilBase(object):
+class _Deduplicator(object):
+    ''' Recognises files that have been seen before. The same physical
+        file reached through another path (a symbolic or hard link, or
+        overlapping directories) is found by device and inode without
+        reading it. A different file with the same content is found by a
+        hash of the content, and the analysed file for the first path with
+        each content is kept so that it can be copied to the others. '''
+
+    def __init__(self):
+        # (device, inode) or real path -> first path to that file
+        self._by_identity = {}
+        # content hash -> first path with that content
+        self._by_content = {}
+        # first path -> its analysed file
+        self._files = {}
+
+    @staticmethod
+    def _identity(file_path):
+        import os
+        info = os.stat(file_path)
+        if info.st_ino:
+            return (info.st_dev, info.st_ino)
+        # the file system does not provide inode numbers
+        return os.path.realpath(file_path)
+
+    @staticmethod
+    def _content_hash(file_path):
+        import hashlib
+        digest = hashlib.sha1()
+        with open(file_path, "rb") as source:
+            while True:
+                block = source.read(1 << 20)
+                if not block:
+                    break
+                digest.update(block)
+        return digest.digest()
+
+    def same_file(self, file_path):
+        ''' Return the first path seen to the same physical file as
+            file_path, or None (recording file_path) if there is none. A
+            file that can not be found is always taken to be new so that
+            the failure is reported. '''
+        try:
+            identity = self._identity(file_path)
+        except OSError:
+            return None
+        original = self._by_identity.get(identity)
+        if original is None:
+            self._by_identity[identity] = file_path
+        return original
+
+    def original(self, file_path):
+        ''' Return the first path seen with the same content as
+            file_path (a different file, see :func:`same_file`), or None
+            (recording file_path) if there is none. A file that can not be
+            read is always taken to be new so that the failure is
+            reported. '''
+        try:
+            content = self._content_hash(file_path)
+        except (IOError, OSError):
+            return None
+        original = self._by_content.get(content)
+        if original is None:
+            self._by_content[content] = file_path
+        return original
+
+    def add(self, my_file):
+        ''' keep the analysed file for a path that was not seen before '''
+        self._files[my_file.path] = my_file
+
+    def copy(self, original, file_path):
+        ''' return the analysis of the file at original for the identical
+            file at file_path '''
+        my_file = self._files[original]
+        if not my_file.parsed_ok:
+            return _failed_file(file_path, my_file.failure)
+        return my_file.copy(file_path)
+
+
+def _walk_files(directory, included_files, excluded_dirs, depth):
+    ''' return walkdir's generator of the matching file paths under
+        directory '''
+    try:
+        from walkdir import filtered_walk, file_paths
+    except ImportError:
+        raise RuntimeError(
+            "CodeAnalysis requires walkdir <http://walkdir.readthedocs.org"
+            "/en/latest/#obtaining-the-module> to be installed")
+    return file_paths(filtered_walk(directory, included_files=included_files,
+                                    excluded_dirs=excluded_dirs, depth=depth))
+
+
+class SourceReader(object):
+    ''' An I/O layer for finding and reading source files on slow (for
+        example network or parallel) filesystems. Sub-directories are
+        walked concurrently, and files are read ahead of the parser by a
+        pool of threads, each file in a single large read (or through mmap
+        for large files), and handed to fparser from memory. The number of
+        files and bytes found and read, and the time taken, are recorded.
+
+        For example:
+
+        >>> reader = SourceReader(threads=16)
+        >>> c = CodeAnalysis(reader=reader)
+        >>> parsed = c.parse()
+        >>> reader.info()
+
+    :param threads: the number of threads used to walk directories and
+                    read files.
+    :type threads: int.
+    :param read_ahead: the maximum number of files read but not yet parsed.
+    :type read_ahead: int.
+    :param mmap_threshold: files at least this size in bytes are read
+                           through mmap.
+    :type mmap_threshold: int.
+    '''
+
+    def __init__(self, threads=8, read_ahead=64, mmap_threshold=4*1024**2):
+        self._threads = max(1, threads)
+        self._read_ahead = max(1, read_ahead)
+        self._mmap_threshold = mmap_threshold
+        self._pool = None
+        self.n_files_found = 0
+        self.discover_time = 0.0
+        self.n_files_read = 0
+        self.n_bytes_read = 0
+        self.read_time = 0.0
+
+    def _thread_pool(self):
+        if self._pool is None:
+            from multiprocessing.pool import ThreadPool
+            self._pool = ThreadPool(self._threads)
+        return self._pool
+
+    def close(self):
+        ''' stop the threads '''
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
+
+    def discover(self, dir_info):
+        ''' Return the matching files for a directory added with
+            :func:`CodeAnalysis.add_directory`, in the same order as walkdir
+            gives them. The top level sub-directories are walked in
+            parallel. '''
+        import os
+        import time
+        start = time.time()
+        directory = dir_info["directory"]
+        included = dir_info["included_files"]
+        excluded = dir_info["excluded_dirs"]
+        depth = dir_info["depth"]
+        paths = list(_walk_files(directory, included, excluded, 0))
+        if depth is None or depth > 0:
+            # the sub-directories that walkdir would descend into
+            try:
+                from walkdir import filtered_walk
+            except ImportError:
+                raise RuntimeError(
+                    "CodeAnalysis requires walkdir <http://walkdir.readthedocs"
+                    ".org/en/latest/#obtaining-the-module> to be installed")
+            sub_dirs = []
+            for _, dir_names, _ in filtered_walk(directory,
+                                                 excluded_dirs=excluded,
+                                                 depth=0):
+                sub_dirs = [os.path.join(directory, name)
+                            for name in dir_names]
+            sub_depth = None if depth is None else depth - 1
+            for sub_paths in self._thread_pool().imap(
+                    lambda sub_dir: list(_walk_files(sub_dir, included,
+                                                     excluded, sub_depth)),
+                    sub_dirs):
+                paths.extend(sub_paths)
+        self.discover_time += time.time() - start
+        self.n_files_found += len(paths)
+        return paths
+
+    def read(self, file_path):
+        ''' return the content of file_path, or None if it can not be
+            read '''
+        import os
+        try:
+            with open(file_path, "rb") as source:
+                size = os.fstat(source.fileno()).st_size
+                if size >= self._mmap_threshold:
+                    import mmap
+                    mapped = mmap.mmap(source.fileno(), 0,
+                                       access=mmap.ACCESS_READ)
+                    try:
+                        content = mapped[:]
+                    finally:
+                        mapped.close()
+                else:
+                    # one read of the whole file (plus one to see the end)
+                    content = source.read(size + 1)
+                    if len(content) > size:
+                        content += source.read()
+        except (IOError, OSError):
+            return None
+        # as fparser would see the file if it read it itself
+        return content.replace("\r\n", "\n")
+
+    def iter_read(self, paths):
+        ''' Generator returning (path, content) for each of paths, in
+            order, reading up to read_ahead files ahead of the caller. The
+            content is None if the file could not be read. '''
+        import time
+        from collections import deque
+        pool = self._thread_pool()
+        pending = deque()
+        paths = iter(paths)
+        exhausted = False
+        while True:
+            while not exhausted and len(pending) < self._read_ahead:
+                try:
+                    file_path = next(paths)
+                except StopIteration:
+                    exhausted = True
+                    break
+                pending.append((file_path,
+                                pool.apply_async(_timed_read,
+                                                 (self, file_path))))
+            if not pending:
+                return
+            file_path, result = pending.popleft()
+            content, seconds = result.get()
+            self.read_time += seconds
+            if content is not None:
+                self.n_files_read += 1
+                self.n_bytes_read += len(content)
+            yield file_path, content
+
+    def info(self, stream=None):
+        ''' write the I/O counts and rates to stream (stdout by
+            default) '''
+        if stream is None:
+            import sys
+            stream = sys.stdout
+        lines = ["Source reader ...",
+                 "    files found                 {0}".format(
+                     self.n_files_found),
+                 "    discover time (s)           {0:.3f}".format(
+                     self.discover_time)]
+        if self.discover_time > 0:
+            lines.append("    files found per second      {0:.0f}".format(
+                self.n_files_found / self.discover_time))
+        lines.extend(["    files read                  {0}".format(
+                          self.n_files_read),
+                      "    bytes read                  {0}".format(
+                          self.n_bytes_read),
+                      "    read time, all threads (s)  {0:.3f}".format(
+                          self.read_time)])
+        if self.read_time > 0:
+            lines.append("    files per second per thread {0:.0f}".format(
+                self.n_files_read / self.read_time))
+            lines.append("    bytes per second per thread {0:.0f}".format(
+                self.n_bytes_read / self.read_time))
+        stream.write("\n".join(lines) + "\n")
+
+
+def _timed_read(reader, file_path):
+    ''' return the content of file_path from reader and the time it took
+        to read it '''
+    import time
+    start = time.time()
+    content = reader.read(file_path)
+    return content, time.time() - start
+
+
+def _parse_file(file_path, release=True, source=None):
+    ''' Parse and analyse a single file. This is a module level function
+        so that it can be handed to a multiprocessing pool.
+
+    :param file_path: the file to parse.
+    :type file_path: str.
+    :param release: whether to drop the fparser ast once the file has been
+                    analysed so that the result is compact and picklable.
+    :type release: bool.
+    :param source: the content of the file, if it has already been read.
+    :type source: str.
+    :return: the parsed (and, if successful, analysed) file.
+    :rtype: :class:`File`
+    '''
+    my_file = File()
+    if my_file.parse(file_path, source):
+        my_file.analyse()
+    if release:
+        my_file.release()
+    return my_file
+
+
+def _parse_file_timed(file_path, release=True, source=None):
+    ''' As :func:`_parse_file` but return a tuple of the file and its
+        :class:`FileRecord`. '''
+    import os
+    import time
+    if source is not None:
+        n_bytes = len(source)
+    else:
+        try:
+            n_bytes = os.path.getsize(file_path)
+        except OSError:
+            n_bytes = 0
+    start = time.time()
+    my_file = File()
+    parsed_ok = my_file.parse(file_path, source)
+    parse_time = time.time() - start
+    analyse_time = 0.0
+    n_statements = 0
+    if parsed_ok:
+        start = time.time()
+        my_file.analyse()
+        analyse_time = time.time() - start
+        n_statements = sum(my_file.statement_counts)
+    if release:
+        my_file.release()
+    return my_file, FileRecord(file_path, n_bytes, parse_time, analyse_time,
+                               n_statements, bool(parsed_ok))
+
+
+class _IsolatedParser(object):
+    ''' Parses and analyses files in separate worker processes so that a
+        file that takes too long, or uses too much memory, can not stall
+        the run. Each worker parses one file at a time. A worker that goes
+        over the timeout is killed and replaced, and the file is returned
+        as failed with a failure of "timeout". The timeout of a file only
+        starts once its worker has started up (imported fparser and so on)
+        and is ready, so a replacement worker's start up does not count
+        against the next file. A worker whose address space is limited
+        fails any file that exceeds the limit.
+
+    :param workers: the number of worker processes. 'None' means one.
+    :type workers: int.
+    :param timeout: the wall-clock limit for each file in seconds.
+    :type timeout: float.
+    :param memory_limit: the address space limit of each worker in bytes.
+    :type memory_limit: int.
+    :param timed: return (file, :class:`FileRecord`) tuples as
+                  :func:`_parse_file_timed` does.
+    :type timed: bool.
+    '''
+
+    # how long to wait between checks on busy workers
+    _POLL_INTERVAL = 0.01
+
+    def __init__(self, workers=None, timeout=None, memory_limit=None,
+                 timed=False):
+        self._n_workers = max(1, workers or 1)
+        self._timeout = timeout
+        self._memory_limit = memory_limit
+        self._timed = timed
+        # a (process, connection) pair for each running worker
+        self._workers = [None] * self._n_workers
+        # whether each worker has started up and is ready for a file
+        self._ready = [False] * self._n_workers
+
+    def _start(self, slot):
+        import multiprocessing
+        parent_conn, child_conn = multiprocessing.Pipe()
+        process = multiprocessing.Process(
+            target=_isolated_worker,
+            args=(child_conn, self._memory_limit, self._timed))
+        process.daemon = True
+        process.start()
+        # so that the parent sees the end of file if the worker dies
+        child_conn.close()
+        self._workers[slot] = (process, parent_conn)
+        self._ready[slot] = False
+
+    def _stop(self, slot, kill=False):
+        process, conn = self._workers[slot]
+        self._workers[slot] = None
+        self._ready[slot] = False
+        if not kill:
+            try:
+                conn.send(None)
+            except (IOError, OSError):
+                kill = True
+        if kill or not _join(process, 1.0):
+            process.terminate()
+            process.join()
+        conn.close()
+
+    def _failed(self, file_path, reason, elapsed):
+        my_file = _failed_file(file_path, reason)
+        if self._timed:
+            return my_file, FileRecord(file_path, 0, elapsed, 0.0, 0, False)
+        return my_file
+
+    def terminate(self):
+        ''' kill any running workers '''
+        for slot in range(self._n_workers):
+            if self._workers[slot] is not None:
+                self._stop(slot, kill=True)
+
+    def join(self):
+        pass
+
+    def imap(self, paths):
+        ''' Generator returning the result for each of paths in the same
+            order as paths. The workers are stopped when it completes. '''
+        import time
+        results = {}
+        # the (path index, start time) of the file each worker is parsing.
+        # The start time is None until the path is sent to a ready worker.
+        busy = [None] * self._n_workers
+        next_task = 0
+        next_result = 0
+        try:
+            while next_result < len(paths):
+                for slot in range(self._n_workers):
+                    if busy[slot] is None and next_task < len(paths):
+                        if self._workers[slot] is None:
+                            self._start(slot)
+                        busy[slot] = (next_task, None)
+                        next_task += 1
+                    if busy[slot] is not None and busy[slot][1] is None \
+                       and self._ready[slot]:
+                        self._workers[slot][1].send(paths[busy[slot][0]])
+                        busy[slot] = (busy[slot][0], time.time())
+                progress = False
+                for slot in range(self._n_workers):
+                    if busy[slot] is None:
+                        continue
+                    idx, start = busy[slot]
+                    process, conn = self._workers[slot]
+                    result = None
+                    if conn.poll():
+                        try:
+                            result = conn.recv()
+                        except (EOFError, IOError, OSError):
+                            # the worker died, most likely from running
+                            # out of memory
+                            self._stop(slot, kill=True)
+                            result = self._failed(
+                                paths[idx], "killed",
+                                0.0 if start is None else time.time() - start)
+                        if result == _READY:
+                            self._ready[slot] = True
+                            progress = True
+                            continue
+                    elif start is None:
+                        # the worker is still starting up
+                        continue
+                    elif self._timeout is not None and \
+                            time.time() - start > self._timeout:
+                        self._stop(slot, kill=True)
+                        result = self._failed(paths[idx], "timeout",
+                                              time.time() - start)
+                    if result is not None:
+                        results[idx] = result
+                        busy[slot] = None
+                        progress = True
+                while next_result in results:
+                    yield results.pop(next_result)
+                    next_result += 1
+                if not progress:
+                    time.sleep(self._POLL_INTERVAL)
+        finally:
+            for slot in range(self._n_workers):
+                if self._workers[slot] is not None:
+                    self._stop(slot, kill=busy[slot] is not None)
+
+
+def _join(process, timeout):
+    ''' wait up to timeout seconds for process to finish and return
+        whether it did '''
+    process.join(timeout)
+    return not process.is_alive()
+
+
+# the message an :class:`_IsolatedParser` worker sends once it has started
+_READY = "ready"
+
+
+def _isolated_worker(conn, memory_limit, timed):
+    ''' The main loop of an :class:`_IsolatedParser` worker process. Once
+        it has started up it sends _READY, then each path received is
+        parsed, analysed and released and the result sent back, until None
+        is received. '''
+    if memory_limit is not None:
+        try:
+            import resource
+            resource.setrlimit(resource.RLIMIT_AS,
+                               (memory_limit, memory_limit))
+        except (ImportError, ValueError):
+            pass
+    # import fparser and build the statement table before any file's
+    # timeout starts
+    from fparser import api
+    statement_types()
+    conn.send(_READY)
+    parse_file = _parse_file_timed if timed else _parse_file
+    while True:
+        try:
+            file_path = conn.recv()
+        except EOFError:
+            break
+        if file_path is None:
+            break
+        try:
+            result = parse_file(file_path)
+        except MemoryError:
+            result = _failed_file(file_path, "memory")
+        except Exception:
+            result = _failed_file(file_path, "error")
+        if timed and isinstance(result, File):
+            result = result, FileRecord(file_path, 0, 0.0, 0.0, 0, False)
+        conn.send(result)
+    conn.close()
+
+
+def _failed_file(file_path, reason):
+    ''' return a File for file_path that failed to parse for reason '''
+    my_file = File()
+    my_file._parsed = True
+    my_file._path = file_path
+    my_file._parsed_ok = False
+    my_file._failure = reason
+    return my_file
+
+
+class LazyAnalysis(object):
+    ''' On-demand analysis driven by call tree queries. All of the matched
+        files are first indexed with the fast :class:`Scanner`. A query from
+        a root subroutine then follows the calls from the root, fully
+        parsing (and analysing) only the files that define the subroutines
+        that are reached. Parsed files are kept, so each file is parsed at
+        most once over all queries. If a file fails to parse its scanned
+        version is used instead.
+
+        For example:
+
+        >>> lazy = c.lazy()
+        >>> lazy.dot("sbc")
+        >>> print lazy.n_parsed
+
+    :param code_analysis: the analysis holding the directories to use.
+    :type code_analysis: :class:`CodeAnalysis`
+    :param workers: as for :func:`CodeAnalysis.parse`.
+    :type workers: int.
+    :param cache: as for :func:`CodeAnalysis.parse`.
+    :type cache: :class:`ParseCache`
+    '''
+
+    def __init__(self, code_analysis, workers=None, cache=None):
+        self._code_analysis = code_analysis
+        self._workers = workers
+        self._cache = cache
+        self._index = None
+        # path -> scanned file, in the order the files were found
+        self._scanned = None
+        # id(scanned subroutine) -> path of its file
+        self._paths = {}
+        # path -> fully parsed file (or the scanned file if that failed)
+        self._parsed = {}
+        # path -> {(lower-cased name, lower-cased module): subroutine}
+        self._parsed_subroutines = {}
 
     @property
-    def name(self):
-        raise NotImplementedError("name method should be implemented")
+    def index(self):
+        ''' the :class:`SymbolTable` of the scanned files. It is built on
+            first use. '''
+        if self._index is None:
+            from collections import OrderedDict
+            self._scanned = OrderedDict()
+            self._index = SymbolTable()
+            scanner = Scanner()
+            paths = self._code_analysis.discover()
+            for my_file in self._code_analysis._scan_files(scanner, paths):
+                file_path = my_file.path
+                if my_file.parsed_ok:
+                    self._scanned[file_path] = my_file
+                    self._index.add_file(my_file)
+                    for subroutine in my_file.all_subroutines:
+                        self._paths[id(subroutine)] = file_path
+            print "Indexed {0} files".format(len(self._scanned))
+        return self._index
 
     @property
-    def description(self):
-        raise NotImplementedError("description method should be implemented")
+    def n_parsed(self):
+        ''' the number of files that have been parsed so far '''
+        return len(self._parsed)
 
+    def files(self, sub_name):
+        ''' Return the files that define sub_name and every subroutine it
+            (transitively) calls, parsing any that have not yet been
+            parsed. The files are returned in the order they were found.
 
-class CodeAnalysisTransform(CodeAnalysisUtilBase):
+        :param sub_name: the name of the root subroutine.
+        :type sub_name: str.
+        '''
+        index = self.index
+        definitions = index.definitions(sub_name.lower())
+        if not definitions:
+            raise RuntimeError(
+                "specified subroutine '{0}' is not in the code".format(
+                    sub_name))
+        paths = set()
+        seen = set()
+        pending = list(definitions)
+        while pending:
+            self._parse([self._path(subroutine) for subroutine in pending])
+            next_pending = []
+            for subroutine in pending:
+                key = id(subroutine)
+                if key in seen:
+                    continue
+                seen.add(key)
+                file_path = self._path(subroutine)
+                paths.add(file_path)
+                # follow the calls found by the full parse where possible
+                parsed = self._parsed_subroutines[file_path].get(
+                    _subroutine_key(subroutine), subroutine)
+                for call in parsed.calls:
+                    callee, _ = index.resolve(call.name.lower(), subroutine,
+                                              call.is_reference)
+                    if callee is not None and id(callee) not in seen:
+                        next_pending.append(callee)
+            pending = next_pending
+        return [self._parsed[file_path] for file_path in self._scanned
+                if file_path in paths]
 
-    def transform(self, files):
-        raise NotImplementedError("transform method should be implemented")
+    def link(self, sub_name):
+        ''' return a :class:`Link` of the files needed for the call tree
+            of sub_name '''
+        link = Link()
+        link.transform(self.files(sub_name))
+        return link
+
+    def dot(self, sub_name, stream=None):
+        ''' write the call tree of sub_name in the dot graph format, as
+            :func:`Link.dot` does '''
+        self.link(sub_name).dot(sub_name.lower(), stream)
+
+    def _path(self, subroutine):
+        ''' return the path of the scanned file defining subroutine '''
+        return self._paths[id(subroutine)]
+
+    def _parse(self, paths):
+        ''' parse any of paths that have not yet been parsed '''
+        to_parse = []
+        for file_path in paths:
+            if file_path not in self._parsed and file_path not in to_parse:
+                to_parse.append(file_path)
+        if not to_parse:
+            return
+        parsed_files = CodeAnalysis._parse_files(
+            to_parse, self._workers, self._cache, release=True,
+            reader=self._code_analysis.reader)
+        for file_path, my_file in zip(to_parse, parsed_files):
+            if my_file.parsed_ok:
+                print "[lazy][ok] {0}".format(file_path)
+            else:
+                print "[lazy][failed] {0}".format(file_path)
+                my_file = self._scanned[file_path]
+            self._parsed[file_path] = my_file
+            self._parsed_subroutines[file_path] = dict(
+                (_subroutine_key(subroutine), subroutine)
+                for subroutine in my_file.all_subroutines)
+
+
+class Pipeline(object):
+    ''' A pipelined analysis in which the stages run concurrently and are
+        connected by bounded queues: a thread walks the directories, a pool
+        of threads reads the files it finds and the parsing and analysis
+        is done in a pool of worker processes (or, with one worker, in
+        this thread). The parsed files are returned in the order they were
+        found, as soon as they are ready, so linking and statistics can
+        start before the last file has been parsed, and reading is hidden
+        behind parsing.
+
+        For example:
+
+        >>> stats = Stats()
+        >>> link = Link()
+        >>> parsed = c.pipeline(workers=8).run(link=link, stats=stats)
+
+    :param code_analysis: the analysis holding the directories to use. If
+                          it has a :class:`SourceReader` that is used to
+                          read the files.
+    :type code_analysis: :class:`CodeAnalysis`
+    :param workers: as for :func:`CodeAnalysis.parse`.
+    :type workers: int.
+    :param queue_size: the bound on the number of items waiting between
+                       stages.
+    :type queue_size: int.
+    :param readers: the number of threads reading files.
+    :type readers: int.
+    '''
+
+    # marks the end of the items from a stage
+    _DONE = None
+    # the seconds between checks for a stop while waiting on a queue
+    _POLL = 0.1
+
+    def __init__(self, code_analysis, workers=None, queue_size=64,
+                 readers=4):
+        self._code_analysis = code_analysis
+        self._workers = workers
+        self._queue_size = max(1, queue_size)
+        self._n_readers = max(1, readers)
+
+    def _put(self, queue, item, stop):
+        ''' put item on queue unless the pipeline is stopped first, and
+            return whether it was put '''
+        from Queue import Full
+        while not stop.is_set():
+            try:
+                queue.put(item, timeout=self._POLL)
+                return True
+            except Full:
+                pass
+        return False
+
+    def _get(self, queue, stop):
+        ''' return the next item on queue, or the end marker if the
+            pipeline is stopped first '''
+        from Queue import Empty
+        while not stop.is_set():
+            try:
+                return queue.get(timeout=self._POLL)
+            except Empty:
+                pass
+        return self._DONE
+
+    def _discover(self, paths_queue, stop):
+        ''' the discovery stage: put (index, path) for each matching file
+            then one end marker for each reader '''
+        try:
+            analysis = self._code_analysis
+            index = 0
+            for dir_info in analysis._directory_info:
+                if analysis.reader is not None:
+                    paths = analysis.reader.discover(dir_info)
+                else:
+                    # walk lazily so that reading starts straight away
+                    paths = _walk_files(dir_info["directory"],
+                                        dir_info["included_files"],
+                                        dir_info["excluded_dirs"],
+                                        dir_info["depth"])
+                for file_path in paths:
+                    if not self._put(paths_queue, (index, file_path), stop):
+                        return
+                    index += 1
+        except Exception as excinfo:
+            self._put(paths_queue, excinfo, stop)
+        for _ in range(self._n_readers):
+            self._put(paths_queue, self._DONE, stop)
+
+    def _read(self, paths_queue, sources_queue, stop):
+        ''' a reading stage thread: put (index, path, content) for each
+            path, then an end marker. An error is passed on in place of
+            the end marker. '''
+        reader = self._code_analysis.reader
+        while True:
+            item = self._get(paths_queue, stop)
+            if item is self._DONE or isinstance(item, Exception):
+                self._put(sources_queue, item, stop)
+                return
+            index, file_path = item
+            try:
+                if reader is not None:
+                    content = reader.read(file_path)
+                else:
+                    try:
+                        with open(file_path, "rb") as source:
+                            content = source.read().replace("\r\n", "\n")
+                    except (IOError, OSError):
+                        # leave fparser to report the problem
+                        content = None
+            except Exception as excinfo:
+                self._put(sources_queue, excinfo, stop)
+                return
+            if not self._put(sources_queue, (index, file_path, content),
+                             stop):
+                return
+
+    def files(self):
+        ''' Generator returning each successfully parsed and analysed
+            (and released) file in the order the files were found. An
+            error in any stage is raised here. If that happens, or the
+            generator is closed early, the stages are stopped. '''
+        import threading
+        from Queue import Queue
+        paths_queue = Queue(self._queue_size)
+        sources_queue = Queue(self._queue_size)
+        stop = threading.Event()
+        threads = [threading.Thread(target=self._discover,
+                                    args=(paths_queue, stop))]
+        for _ in range(self._n_readers):
+            threads.append(threading.Thread(
+                target=self._read, args=(paths_queue, sources_queue, stop)))
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        pool = None
+        if self._workers is not None and self._workers > 1:
+            import multiprocessing
+            pool = multiprocessing.Pool(processes=self._workers)
+        # index -> (path, result) of the files being parsed
+        pending = {}
+        next_index = 0
+        n_done = 0
+        success = 0
+        try:
+            while True:
+                while next_index in pending and pending[next_index][1].ready():
+                    file_path, result = pending.pop(next_index)
+                    next_index += 1
+                    my_file = result.get()
+                    if my_file.parsed_ok:
+                        print "[{0}][ok] {1}".format(next_index, file_path)
+                        success += 1
+                        yield my_file
+                    else:
+                        print "[{0}][failed] {1}".format(next_index,
+                                                         file_path)
+                if n_done == self._n_readers and not pending:
+                    break
+                if n_done < self._n_readers and \
+                   (len(pending) < self._queue_size or
+                        next_index not in pending):
+                    item = sources_queue.get()
+                    if item is self._DONE:
+                        n_done += 1
+                    elif isinstance(item, Exception):
+                        raise item
+                    else:
+                        index, file_path, content = item
+                        if pool is not None:
+                            result = pool.apply_async(
+                                _parse_file, (file_path, True, content))
+                        else:
+                            result = _Ready(_parse_file(file_path, True,
+                                                        content))
+                        pending[index] = (file_path, result)
+                else:
+                    # wait for the next file in order to be parsed
+                    pending[next_index][1].wait()
+        finally:
+            stop.set()
+            if pool is not None:
+                pool.terminate()
+                pool.join()
+            for thread in threads:
+                thread.join()
+        print "{0} out of {1} files successfully examined".format(
+            success, next_index)
+
+    def run(self, link=None, stats=None):
+        ''' Run the pipeline and return the list of parsed files. If a
+            Link is given each file is linked as soon as it is parsed (see
+            :func:`Link.update`), and if a Stats is given it is applied to
+            the files as they arrive. '''
+        files = []
+        if link is not None:
+            link.transform(files)
+
+        def registered():
+            for my_file in self.files():
+                files.append(my_file)
+                if link is not None:
+                    link.update([], [my_file])
+                yield my_file
+
+        if stats is not None:
+            stats.apply(registered())
+        else:
+            for _ in registered():
+                pass
         return files
 
 
-class CodeAnalysisOperator(CodeAnalysisUtilBase):
+class _Ready(object):
+    ''' a result that is already available, with the parts of the
+        multiprocessing AsyncResult interface used by :class:`Pipeline` '''
 
-    def apply(self, files):
-        raise NotImplementedError("apply method should be implemented")
+    def __init__(self, value):
+        self._value = value
 
+    def ready(self):
+        return True
 
-class Link(CodeAnalysisTransform):
+    def wait(self, timeout=None):
+        pass
+
+    def get(self, timeout=None):
+        return self._value
+
+
+def _subroutine_key(subroutine):
+    ''' return a key that identifies subroutine within its file '''
+    module = subroutine.module
+    return (subroutine.name.lower(),
+            module.lower() if module is not None else None)
 
-    def __init__(self):
-        self._symbol_table = {}
-        self._files = None
+
+class ParseCache(object):
+    ''' A persistent on-disk cache of analysed (and released) File
+        summaries. There is one entry per source file path. An entry is only
+        used if the content of the file, the version of fparser and the
+        cache format all match those used when the entry was written.
+
+        For example:
+
+        >>> cache = ParseCache("/tmp/fanalyser_cache", max_size=500*1024**2)
+        >>> parsed = c.parse(cache=cache)
+
+    :param directory: the directory in which to store the cache. It is
+                      created if it does not exist.
+    :type directory: str.
+    :param max_size: the maximum size of the cache in bytes. When this is
+                     exceeded the least recently used entries are removed.
+                     'None' (the default) means there is no limit.
+    :type max_size: int.
+    '''
+
+    # increment this whenever the layout of the cached summaries changes
+    _FORMAT = 9
+    _SUFFIX = ".fcache"
+
+    def __init__(self, directory, max_size=None):
+        import os
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self._directory = directory
+        self._max_size = max_size
+        self._hits = 0
+        self._misses = 0
 
     @property
-    def name(self):
-        return "link"
+    def directory(self):
+        return self._directory
 
     @property
-    def description(self):
-        return ("links calls and subroutines. Modifies the files object to "
-                "add link information.")
+    def hits(self):
+        return self._hits
 
-    def transform(self, files):
+    @property
+    def misses(self):
+        return self._misses
 
-        print "linking:",
-        self._files = files
+    def _entry_path(self, file_path):
+        import os
+        import hashlib
+        key = hashlib.sha1(os.path.abspath(file_path)).hexdigest()
+        return os.path.join(self._directory, key + self._SUFFIX)
 
-        # create the symbol table
-        for my_file in self._files:
-            for subroutine in my_file.subroutines:
-                self._symbol_table[subroutine.name.lower()] = subroutine
+    def _signature(self, file_path):
+        ''' the values that must match for a cache entry to be used '''
+        import hashlib
+        with open(file_path, "rb") as source:
+            digest = hashlib.sha1(source.read()).hexdigest()
+        return (self._FORMAT, _fparser_version(), digest)
 
-        for my_file in self._files:
-            for subroutine in my_file.subroutines:
-                for call in subroutine.calls:
-                    if call.name.lower() in self._symbol_table.keys():
-                        my_subroutine = self._symbol_table[call.name.lower()]
-                        call.link = my_subroutine
-                        my_subroutine.add_link(call)
+    def get(self, file_path):
+        ''' Return the cached File for file_path or None if there is no
+            valid entry. '''
+        import os
+        import cPickle
+        entry_path = self._entry_path(file_path)
+        try:
+            with open(entry_path, "rb") as entry:
+                signature = cPickle.load(entry)
+                if signature != self._signature(file_path):
+                    self._misses += 1
+                    return None
+                my_file = cPickle.load(entry)
+        except (IOError, OSError, EOFError, cPickle.UnpicklingError):
+            self._misses += 1
+            return None
+        # record the use so that eviction removes the least recently used
+        os.utime(entry_path, None)
+        self._hits += 1
+        return my_file
 
-        print "done"
-        return files
+    def put(self, my_file):
+        ''' Add a released File to the cache, replacing any existing entry
+            for the same path. Nothing is cached if the source can not be
+            read (for example a broken symbolic link). '''
+        import os
+        import cPickle
+        import tempfile
+        if my_file.path is None:
+            raise RuntimeError("Cannot cache a file that has not been parsed")
+        if my_file._ast is not None:
+            raise RuntimeError("Only released files can be cached")
+        try:
+            signature = self._signature(my_file.path)
+        except (IOError, OSError):
+            return
+        # write to a temporary file and rename so that concurrent readers
+        # never see a partially written entry
+        handle, tmp_path = tempfile.mkstemp(dir=self._directory)
+        with os.fdopen(handle, "wb") as entry:
+            cPickle.dump(signature, entry, cPickle.HIGHEST_PROTOCOL)
+            cPickle.dump(my_file, entry, cPickle.HIGHEST_PROTOCOL)
+        os.rename(tmp_path, self._entry_path(my_file.path))
+        if self._max_size is not None:
+            self._evict()
 
-    def dot(self, sub_name=""):
+    def _entries(self):
+        ''' return a list of (last use, size, path) for every entry '''
+        import os
+        entries = []
+        for name in os.listdir(self._directory):
+            if name.endswith(self._SUFFIX):
+                entry_path = os.path.join(self._directory, name)
+                try:
+                    info = os.stat(entry_path)
+                except OSError:
+                    continue
+                entries.append((info.st_mtime, info.st_size, entry_path))
+        return entries
 
-        if self._files is None:
-            raise RuntimeError("run the apply method first")
+    @property
+    def size(self):
+        ''' the total size of the cache entries in bytes '''
+        return sum(size for _, size, _ in self._entries())
 
-        if sub_name not in self._symbol_table and sub_name != "":
-            raise RuntimeError("specified subroutine is not in the code")
+    def _evict(self):
+        ''' remove the least recently used entries until the cache is no
+            larger than max_size '''
+        import os
+        entries = self._entries()
+        total = sum(size for _, size, _ in entries)
+        if total <= self._max_size:
+            return
+        for _, size, entry_path in sorted(entries):
+            try:
+                os.remove(entry_path)
+            except OSError:
+                pass
+            total -= size
+            if total <= self._max_size:
+                break
 
-        ''' return the call tree as a dot file '''
-        if sub_name == "":
-            print "digraph G {"
-            for my_file in self._files:
-                for subroutine in my_file.subroutines:
-                    subroutine.call_tree()
-                for module in my_file.modules:
-                    for subroutine in module.subroutines:
-                        subroutine.call_tree()
-            print "}"
+    def invalidate(self, file_path=None):
+        ''' Remove the entry for file_path from the cache. If no path is
+            given the whole cache is cleared. '''
+        if file_path is None:
+            entry_paths = [entry_path for _, _, entry_path in self._entries()]
         else:
-            print "digraph G {"
-            self._x(self._symbol_table[sub_name], [])
-            print "}"
-
-    def _x(self, subroutine, called_names):
-        subroutine.call_tree()
-        for call in subroutine.calls:
-            if call.name not in called_names:
-                called_names.append(call.name)
-                if call.link is not None:
-                    self._x(call.link, called_names)
+            entry_paths = [self._entry_path(file_path)]
+        for entry_path in entry_paths:
+            self._remove(entry_path)
 
-    def info(self):
-        # TBD info about orphans and unresolved calls
-        pass
+    @staticmethod
+    def _remove(entry_path):
+        ''' remove an entry, which another process may already have
+            removed '''
+        import os
+        import errno
+        try:
+            os.remove(entry_path)
+        except OSError as excinfo:
+            if excinfo.errno != errno.ENOENT:
+                raise
 
 
-class Stats(CodeAnalysisOperator):
+class FileRecord(object):
+    ''' The cost of parsing and analysing one file, as recorded by
+        :class:`Instrumentation`. The number of statements is also the
+        number of nodes in the fparser ast. For a file found in the
+        :class:`ParseCache`, cached is True, parse_time is the time taken
+        to load it and no bytes are counted as read. '''
+    __slots__ = ("path", "n_bytes", "parse_time", "analyse_time",
+                 "n_statements", "parsed_ok", "cached")
 
-    def __init__(self):
-        self._n_files_ok = 0
-        self._n_files_empty = 0
-        self._n_files_failed = 0
-        self._n_modules = 0
-        self._n_modules_no_subroutines = 0
-        self._n_subroutines_outside_modules = 0
-        self._n_subroutines_in_modules = 0
-        self._n_statements = 0
-        self._statement_count_bin = {}
-        self._applied = False
-        self._n_comments = 0
-        self._n_type_decls = 0
-        self._n_code_statements = 0
+    def __init__(self, path, n_bytes, parse_time, analyse_time, n_statements,
+                 parsed_ok, cached=False):
+        self.path = path
+        self.n_bytes = n_bytes
+        self.parse_time = parse_time
+        self.analyse_time = analyse_time
+        self.n_statements = n_statements
+        self.parsed_ok = parsed_ok
+        self.cached = cached
 
-    @property
-    def name(self):
-        return "Statistics"
+    def __getstate__(self):
+        return tuple(getattr(self, slot) for slot in self.__slots__)
+
+    def __setstate__(self, state):
+        for slot, value in zip(self.__slots__, state):
+            setattr(self, slot, value)
 
     @property
-    def description(self):
-        return "Statistics about the code"
+    def time(self):
+        ''' the total time spent on the file in seconds '''
+        return self.parse_time + self.analyse_time
 
-    def apply(self, files):
-        ''' determine stats about the code '''
 
-        print "Creating stats:",
-        import sys
-        sys.stdout.flush()
-        for my_file in files:
-            if not my_file.parsed_ok:
-                self._n_files_failed += 1
-            else:
-                self._n_files_ok += 1
-                if my_file.is_empty:
-                    self._n_files_empty += 1
-                else:
-                    self._n_modules += len(my_file.modules)
-                    self._n_subroutines_outside_modules \
-                        += len(my_file.subroutines)
-                    for my_module in my_file.modules:
-                        if len(my_module.subroutines) == 0:
-                            self._n_modules_no_subroutines += 1
-                        else:
-                            self._n_subroutines_in_modules \
-                                += len(my_module.subroutines)
-
-                    # walk through all statements in the current file
-                    from fparser import api
-                    for statement, depth in api.walk(my_file._ast, -1):
-                        self._n_statements += 1
-                        type_statement = type(statement)
-                        if type_statement not in self._statement_count_bin:
-                            self._statement_count_bin[type_statement] = 1
+class StageRecord(object):
+    ''' The accumulated cost of one stage of the analysis: the number of
+        times it was entered, the wall time in seconds, a count of the
+        items it processed and the peak memory (RSS in kB) of the process
+        when it last completed. '''
+
+    def __init__(self, name):
+        self.name = name
+        self.calls = 0
+        self.time = 0.0
+        self.count = 0
+        self.peak_memory = None
+
+
+class Instrumentation(object):
+    ''' Records where the time goes in an analysis run. When it is given
+        to :class:`CodeAnalysis` the directory scan ("discover") and the
+        parsing ("parse") and analysis ("analyse") of each file are timed,
+        along with the bytes read and the statements found in each file.
+        Files loaded from a :class:`ParseCache` are timed as "cache".
+        Other stages, such as :func:`Stats.apply` or :func:`Link.transform`,
+        can be timed with :func:`stage`. When no instrumentation is given
+        (the default) nothing is recorded and the cost is a single test
+        per file.
+
+        For example:
+
+        >>> instrumentation = Instrumentation()
+        >>> c = CodeAnalysis(instrumentation=instrumentation)
+        >>> parsed = c.parse()
+        >>> with instrumentation.stage("link"):
+        ...     Link().transform(parsed)
+        >>> instrumentation.report(top=10)
+
+    :param profile: run cProfile over the parse. The results are available
+                    from :func:`profile_stats`. Only code run in this
+                    process is profiled, so use a single worker.
+    :type profile: bool.
+    :param memory: record the peak memory of the process after each stage.
+    :type memory: bool.
+    '''
+
+    def __init__(self, profile=False, memory=True):
+        self._stages = {}
+        self._stage_order = []
+        self._counters = {}
+        self._files = []
+        self._memory = memory
+        self._profile = None
+        if profile:
+            import cProfile
+            self._profile = cProfile.Profile()
+
+    def _stage_record(self, name):
+        record = self._stages.get(name)
+        if record is None:
+            record = StageRecord(name)
+            self._stages[name] = record
+            self._stage_order.append(name)
+        return record
+
+    def stage(self, name):
+        ''' Return a context manager that adds the time spent in its block
+            to the stage called name. The StageRecord is returned by the
+            with statement so that the block can add to its count. '''
+        return _StageTimer(self, self._stage_record(name))
+
+    def add_time(self, name, seconds, count=0):
+        ''' add time (and a count of items) to the stage called name '''
+        record = self._stage_record(name)
+        record.calls += 1
+        record.time += seconds
+        record.count += count
+        if self._memory:
+            record.peak_memory = _peak_memory()
+
+    def count(self, name, value=1):
+        ''' add value to the counter called name '''
+        self._counters[name] = self._counters.get(name, 0) + value
+
+    def add_file(self, record):
+        ''' add the :class:`FileRecord` of a parsed (or cached) file.
+            Cache hits are timed as the "cache" stage. '''
+        self._files.append(record)
+        if record.cached:
+            self.add_time("cache", record.parse_time, 1)
+            self.count("cache hits")
+            return
+        self.add_time("parse", record.parse_time, 1)
+        if record.parsed_ok:
+            self.add_time("analyse", record.analyse_time,
+                          record.n_statements)
+        else:
+            self.count("files failed")
+        self.count("bytes read", record.n_bytes)
+        self.count("statements", record.n_statements)
+
+    @property
+    def stages(self):
+        ''' the StageRecords in the order the stages were first used '''
+        return [self._stages[name] for name in self._stage_order]
+
+    @property
+    def counters(self):
+        return self._counters
+
+    @property
+    def files(self):
+        ''' the FileRecords in the order the files were parsed '''
+        return self._files
+
+    def slowest(self, top=10):
+        ''' return the FileRecords of the top slowest files '''
+        import heapq
+        return heapq.nlargest(top, self._files, key=lambda record:
+                              record.time)
+
+    def start_profile(self):
+        if self._profile is not None:
+            self._profile.enable()
+
+    def stop_profile(self):
+        if self._profile is not None:
+            self._profile.disable()
+
+    def profile_stats(self):
+        ''' return a pstats.Stats holding the cProfile results '''
+        if self._profile is None:
+            raise RuntimeError("profiling was not requested")
+        import pstats
+        return pstats.Stats(self._profile)
+
+    def report(self, top=10, stream=None):
+        ''' write the stage timings, the counters and the top slowest
+            files to stream (stdout by default) '''
+        if stream is None:
+            import sys
+            stream = sys.stdout
+        lines = ["Instrumentation ...",
+                 "    {0:<12}{1:>8}{2:>12}{3:>12}{4:>14}".format(
+                     "stage", "calls", "time (s)", "count", "peak mem (kB)")]
+        for record in self.stages:
+            lines.append("    {0:<12}{1:>8}{2:>12.3f}{3:>12}{4:>14}".format(
+                record.name, record.calls, record.time, record.count,
+                "" if record.peak_memory is None else record.peak_memory))
+        lines.append("")
+        for name in sorted(self._counters):
+            lines.append("    {0:<28}{1}".format(name, self._counters[name]))
+        parse = self._stages.get("parse")
+        analyse = self._stages.get("analyse")
+        if parse is not None and parse.time > 0:
+            lines.append("    {0:<28}{1:.0f}".format(
+                "bytes per second (parse)",
+                self._counters.get("bytes read", 0) / parse.time))
+        if parse is not None and analyse is not None and \
+           parse.time + analyse.time > 0:
+            lines.append("    {0:<28}{1:.0f}".format(
+                "statements per second",
+                self._counters.get("statements", 0) /
+                (parse.time + analyse.time)))
+        slowest = self.slowest(top)
+        if slowest:
+            lines.append("")
+            lines.append("    {0} slowest files (parse, analyse, "
+                         "statements, bytes):".format(len(slowest)))
+            for record in slowest:
+                lines.append("    {0:8.3f}s {1:8.3f}s {2:8} {3:10} {4}{5}".
+                             format(record.parse_time, record.analyse_time,
+                                    record.n_statements, record.n_bytes,
+                                    record.path,
+                                    " (cached)" if record.cached else ""))
+        stream.write("\n".join(lines) + "\n")
+
+
+class _StageTimer(object):
+    ''' the context manager returned by :func:`Instrumentation.stage` '''
+
+    def __init__(self, instrumentation, record):
+        self._instrumentation = instrumentation
+        self._record = record
+        self._start = None
+
+    def __enter__(self):
+        import time
+        self._start = time.time()
+        return self._record
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        import time
+        self._instrumentation.add_time(self._record.name,
+                                       time.time() - self._start)
+        return False
+
+
+def _peak_memory():
+    ''' return the peak resident set size of this process in kB, or None
+        if it is not available '''
+    try:
+        import resource
+    except ImportError:
+        return None
+    import sys
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == "darwin":
+        # reported in bytes rather than kB
+        peak //= 1024
+    return peak
+
+
+class AnalysisDatabase(object):
+    ''' An SQLite database holding analysed (and optionally linked) files,
+        so that downstream tools can load the results, or query them, in a
+        fraction of the time it takes to parse the code again. The files,
+        modules, subroutines, calls (with the lines of each call site and
+        the subroutine each is linked to) and statement counts are stored,
+        along with the modification time and size of each file when it was
+        saved (see :func:`signatures`).
+        Names are indexed, so callers, callees and unresolved calls can be
+        found directly with SQL.
+
+        For example:
+
+        >>> AnalysisDatabase("nemo.db").save(parsed, link)
+        >>> ...
+        >>> link = Link()
+        >>> files = AnalysisDatabase("nemo.db").load(link)
+        >>> link.dot("sbc")
+
+    :param path: the database file. It is created if it does not exist.
+    :type path: str.
+    '''
+
+    # increment this whenever the layout of the tables changes
+    _FORMAT = 3
+
+    _SCHEMA = """
+        CREATE TABLE meta (key TEXT PRIMARY KEY, value TEXT);
+        CREATE TABLE statement_types (idx INTEGER PRIMARY KEY, name TEXT);
+        CREATE TABLE files (
+            id INTEGER PRIMARY KEY, path TEXT, n_lines INTEGER,
+            is_empty INTEGER, scanned INTEGER, statement_counts BLOB,
+            mtime REAL, size INTEGER);
+        CREATE TABLE modules (
+            id INTEGER PRIMARY KEY, file_id INTEGER, name TEXT, lname TEXT,
+            start_line INTEGER, end_line INTEGER, uses TEXT,
+            category_counts BLOB);
+        CREATE TABLE subroutines (
+            id INTEGER PRIMARY KEY, file_id INTEGER, module_id INTEGER,
+            name TEXT, lname TEXT, module TEXT, start_line INTEGER,
+            end_line INTEGER, uses TEXT, category_counts BLOB, kind TEXT);
+        CREATE TABLE calls (
+            id INTEGER PRIMARY KEY, subroutine_id INTEGER, name TEXT,
+            lname TEXT, lines BLOB, link_id INTEGER, ambiguous INTEGER,
+            reference INTEGER);
+        CREATE INDEX subroutines_lname ON subroutines (lname);
+        CREATE INDEX calls_lname ON calls (lname);
+        CREATE INDEX calls_subroutine ON calls (subroutine_id);
+        CREATE INDEX calls_link ON calls (link_id);
+        """
+
+    def __init__(self, path):
+        self._path = path
+
+    @property
+    def path(self):
+        return self._path
+
+    def _connect(self):
+        import sqlite3
+        connection = sqlite3.connect(self._path)
+        # names and paths are plain strings as elsewhere
+        connection.text_factory = str
+        return connection
+
+    def save(self, files, link=None):
+        ''' Replace the contents of the database with files. If the files
+            have been linked then pass the Link so that the links, and
+            which calls are ambiguous, are stored.
+
+        :param files: the analysed files.
+        :type files: list of :class:`File`
+        :param link: the Link used to transform files.
+        :type link: :class:`Link`
+        '''
+        import os
+        import sqlite3
+        connection = self._connect()
+        try:
+            tables = [row[0] for row in connection.execute(
+                "SELECT name FROM sqlite_master WHERE type='table'")]
+            for table in tables:
+                connection.execute("DROP TABLE " + table)
+            connection.executescript(self._SCHEMA)
+            meta = [("format", str(self._FORMAT)),
+                    ("linked", "1" if link is not None else "0")]
+            names = None
+            if any(not my_file.scanned for my_file in files):
+                meta.append(("fparser", _fparser_version()))
+                names = statement_types().names
+                connection.executemany(
+                    "INSERT INTO statement_types VALUES (?, ?)",
+                    enumerate(names))
+            connection.executemany("INSERT INTO meta VALUES (?, ?)", meta)
+
+            file_rows = []
+            module_rows = []
+            subroutine_rows = []
+            call_rows = []
+            subroutine_ids = {}
+            module_ids = {}
+            for my_file in files:
+                file_id = len(file_rows) + 1
+                try:
+                    info = os.stat(my_file.path)
+                    signature = (info.st_mtime, info.st_size)
+                except OSError:
+                    signature = (None, None)
+                file_rows.append(
+                    (file_id, my_file.path, my_file.n_lines,
+                     int(my_file.is_empty), int(my_file.scanned),
+                     _to_blob(my_file.statement_counts)) + signature)
+                for module in my_file.modules:
+                    module_ids[id(module)] = len(module_rows) + 1
+                    module_rows.append(
+                        (len(module_rows) + 1, file_id, module.name,
+                         module.name.lower(), module.start_line,
+                         module.end_line, " ".join(module.uses),
+                         _to_blob(module.category_counts)))
+                subroutines = [(None, subroutine) for subroutine
+                               in my_file.subroutines]
+                for module in my_file.modules:
+                    subroutines.extend((module_ids[id(module)], subroutine)
+                                       for subroutine in module.subroutines)
+                for module_id, subroutine in subroutines:
+                    subroutine_ids[id(subroutine)] = len(subroutine_rows) + 1
+                    subroutine_rows.append(
+                        (len(subroutine_rows) + 1, file_id, module_id,
+                         subroutine.name, subroutine.name.lower(),
+                         subroutine.module, subroutine.start_line,
+                         subroutine.end_line, " ".join(subroutine.uses),
+                         _to_blob(subroutine.category_counts),
+                         subroutine.kind))
+            for my_file in files:
+                for subroutine in my_file.all_subroutines:
+                    caller_id = subroutine_ids[id(subroutine)]
+                    for call in subroutine.calls:
+                        link_id = None
+                        ambiguous = 0
+                        if link is not None and call.link is not None:
+                            link_id = subroutine_ids.get(id(call.link))
+                            ambiguous = int(link.is_ambiguous(call))
+                        call_rows.append(
+                            (len(call_rows) + 1, caller_id, call.name,
+                             call.name.lower(), sqlite3.Binary(
+                                 call.lines.tostring()), link_id, ambiguous,
+                             int(call.is_reference)))
+            connection.executemany(
+                "INSERT INTO files VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                file_rows)
+            connection.executemany(
+                "INSERT INTO modules VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                module_rows)
+            connection.executemany(
+                "INSERT INTO subroutines VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, "
+                "?, ?)", subroutine_rows)
+            connection.executemany(
+                "INSERT INTO calls VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                call_rows)
+            connection.commit()
+        finally:
+            connection.close()
+
+    def _meta(self, connection):
+        meta = dict(connection.execute("SELECT key, value FROM meta"))
+        if meta.get("format") != str(self._FORMAT):
+            raise RuntimeError(
+                "database '{0}' has an unsupported format".format(self._path))
+        return meta
+
+    def load(self, link=None):
+        ''' Return the files stored in the database, as released
+            :class:`File` objects whose calls are linked as they were when
+            saved. If a Link is given it is set up (see
+            :func:`Link.restore`) so that it can be used without running
+            its transform method. '''
+        connection = self._connect()
+        try:
+            meta = self._meta(connection)
+            remap = None
+            stored_names = [row[0] for row in connection.execute(
+                "SELECT name FROM statement_types ORDER BY idx")]
+            if stored_names:
+                names = statement_types().names
+                if stored_names != names:
+                    # the counts were made with another fparser so map
+                    # them to the current table by statement name
+                    positions = dict((name, idx) for idx, name in
+                                     enumerate(names))
+                    other = statement_types().other_index
+                    remap = [positions.get(name, other)
+                             for name in stored_names]
+
+            files = []
+            file_by_id = {}
+            for file_id, path, n_lines, is_empty, scanned, counts in \
+                    connection.execute(
+                        "SELECT id, path, n_lines, is_empty, scanned, "
+                        "statement_counts FROM files ORDER BY id"):
+                my_file = File()
+                my_file._parsed = True
+                my_file._parsed_ok = True
+                my_file._path = path
+                my_file._n_lines = n_lines
+                my_file._is_empty = bool(is_empty)
+                my_file._scanned = bool(scanned)
+                my_file._statement_counts = _from_blob(counts)
+                if remap is not None:
+                    my_file._statement_counts = _remap_counts(
+                        my_file._statement_counts, remap)
+                files.append(my_file)
+                file_by_id[file_id] = my_file
+
+            module_by_id = {}
+            for module_id, file_id, name, _, start_line, end_line, uses, \
+                    counts in connection.execute(
+                        "SELECT * FROM modules ORDER BY id"):
+                module = Module()
+                module._name = intern(str(name))
+                module._start_line = start_line
+                module._end_line = end_line
+                module._uses = _split_names(uses)
+                module._category_counts = _from_blob(counts)
+                file_by_id[file_id]._modules.append(module)
+                module_by_id[module_id] = module
+
+            subroutine_by_id = {}
+            for sub_id, file_id, module_id, name, _, module_name, \
+                    start_line, end_line, uses, counts, kind in \
+                    connection.execute(
+                        "SELECT * FROM subroutines ORDER BY id"):
+                subroutine = _UNIT_CLASSES[kind]()
+                subroutine._name = intern(str(name))
+                if module_name is not None:
+                    subroutine._module = intern(str(module_name))
+                subroutine._start_line = start_line
+                subroutine._end_line = end_line
+                subroutine._uses = _split_names(uses)
+                subroutine._category_counts = _from_blob(counts)
+                if module_id is None:
+                    file_by_id[file_id]._subroutines.append(subroutine)
+                else:
+                    module_by_id[module_id].subroutines.append(subroutine)
+                subroutine_by_id[sub_id] = subroutine
+
+            ambiguous_calls = []
+            for _, sub_id, name, _, lines, link_id, ambiguous, reference \
+                    in connection.execute("SELECT * FROM calls ORDER BY id"):
+                call = Call()
+                call._name = intern(str(name))
+                call._reference = bool(reference)
+                call._lines.fromstring(str(lines))
+                caller = subroutine_by_id[sub_id]
+                call._caller = caller
+                caller.calls.append(call)
+                if link_id is not None:
+                    target = subroutine_by_id[link_id]
+                    call.link = target
+                    target.add_link(call)
+                    if ambiguous:
+                        ambiguous_calls.append(call)
+        finally:
+            connection.close()
+        if link is not None:
+            if meta.get("linked") != "1":
+                raise RuntimeError(
+                    "database '{0}' holds files that were not linked".format(
+                        self._path))
+            link.restore(files, ambiguous_calls)
+        return files
+
+    def signatures(self):
+        ''' Return a dictionary mapping the path of each stored file to
+            its (modification time, size) when the database was saved, so
+            that files changed since then can be found and updated (see
+            :func:`CodeAnalysis.update`). '''
+        connection = self._connect()
+        try:
+            self._meta(connection)
+            return dict((path, (mtime, size)) for path, mtime, size in
+                        connection.execute(
+                            "SELECT path, mtime, size FROM files"))
+        finally:
+            connection.close()
+
+    def query(self, sql, parameters=()):
+        ''' return the rows of an arbitrary SQL query on the database '''
+        connection = self._connect()
+        try:
+            return connection.execute(sql, parameters).fetchall()
+        finally:
+            connection.close()
+
+    def callers(self, name):
+        ''' Return (caller, caller module, path, line) for each call site
+            that calls a subroutine with the given name. '''
+        return self._call_sites(
+            "SELECT s.name, s.module, f.path, c.lines FROM calls c "
+            "JOIN subroutines s ON c.subroutine_id = s.id "
+            "JOIN files f ON s.file_id = f.id "
+            "WHERE c.lname = ? ORDER BY c.id", (name.lower(),))
+
+    def callees(self, name):
+        ''' Return (called name, linked subroutine module, linked
+            subroutine path, line) for each call site in the subroutines
+            with the given name. The module and path are None if the call
+            is not linked. '''
+        return self._call_sites(
+            "SELECT c.name, t.module, tf.path, c.lines FROM calls c "
+            "JOIN subroutines s ON c.subroutine_id = s.id "
+            "LEFT JOIN subroutines t ON c.link_id = t.id "
+            "LEFT JOIN files tf ON t.file_id = tf.id "
+            "WHERE s.lname = ? ORDER BY c.id", (name.lower(),))
+
+    def unresolved(self):
+        ''' Return (called name, caller, path, line) for each call site
+            that could not be linked. As for :func:`Link.unresolved`,
+            function references that did not match a function are not
+            included. '''
+        connection = self._connect()
+        try:
+            if self._meta(connection).get("linked") != "1":
+                raise RuntimeError(
+                    "database '{0}' holds files that were not linked".format(
+                        self._path))
+        finally:
+            connection.close()
+        return self._call_sites(
+            "SELECT c.name, s.name, f.path, c.lines FROM calls c "
+            "JOIN subroutines s ON c.subroutine_id = s.id "
+            "JOIN files f ON s.file_id = f.id "
+            "WHERE c.link_id IS NULL AND c.reference = 0 "
+            "ORDER BY c.lname, c.id")
+
+    def _call_sites(self, sql, parameters=()):
+        ''' run a query whose last column is the call lines and return a
+            row per call site '''
+        rows = []
+        for row in self.query(sql, parameters):
+            lines = array("i")
+            lines.fromstring(str(row[-1]))
+            for line in lines:
+                rows.append(tuple(row[:-1]) + (line,))
+        return rows
+
+
+def _to_blob(counts):
+    ''' return a count array as a portable (32 bit) blob '''
+    import sqlite3
+    return sqlite3.Binary(array("i", counts).tostring())
+
+
+def _from_blob(blob):
+    ''' return the count array stored by :func:`_to_blob` '''
+    counts = array("i")
+    counts.fromstring(str(blob))
+    return array("l", counts)
+
+
+def _remap_counts(counts, remap):
+    ''' return counts indexed by the current statement_types() table '''
+    result = statement_types().new_counts()
+    for idx, count in enumerate(counts):
+        result[remap[idx]] += count
+    return result
+
+
+def _split_names(names):
+    ''' return the interned names in a space separated string '''
+    return [intern(str(name)) for name in names.split()]
+
+
+_FPARSER_VERSION = None
+
+
+def _fparser_version():
+    ''' return the version of the installed fparser '''
+    global _FPARSER_VERSION
+    if _FPARSER_VERSION is None:
+        import fparser
+        version = getattr(fparser, "__version__", None)
+        if version is None:
+            try:
+                import pkg_resources
+                version = pkg_resources.get_distribution("fparser").version
+            except Exception:
+                version = "unknown"
+        _FPARSER_VERSION = version
+    return _FPARSER_VERSION
+
+
+class CodeAnalysisUtilBase(object):
+
+    @property
+    def name(self):
+        raise NotImplementedError("name method should be implemented")
+
+    @property
+    def description(self):
+        raise NotImplementedError("description method should be implemented")
+
+
+class CodeAnalysisTransform(CodeAnalysisUtilBase):
+
+    def transform(self, files):
+        raise NotImplementedError("transform method should be implemented")
+        return files
+
+
+class CodeAnalysisOperator(CodeAnalysisUtilBase):
+
+    def apply(self, files):
+        raise NotImplementedError("apply method should be implemented")
+
+
+class SymbolTable(object):
+    ''' An index of program units (subroutines, functions, main programs
+        and block data) by lower-cased name and by module, used to resolve
+        calls and function references in constant time. A CALL only
+        resolves to a subroutine and a function reference only to a
+        function. Every definition of a name is kept.
+        When a name is defined more than once, a call is resolved using
+        the scope of the calling subroutine: a definition in the same
+        module is preferred, then one in a module that is USEd (directly,
+        through the host module or through the modules that those USE) and
+        finally one that is outside any module. '''
+
+    def __init__(self):
+        # lower-cased name -> list of subroutines in the order added
+        self._definitions = {}
+        # lower-cased module name -> set of lower-cased used module names
+        self._module_uses = {}
+
+    def __contains__(self, name):
+        return name in self._definitions
+
+    def __getitem__(self, name):
+        ''' return the most recently added subroutine called name '''
+        return self._definitions[name][-1]
+
+    def __len__(self):
+        return len(self._definitions)
+
+    def names(self):
+        ''' return the lower-cased names in the table '''
+        return self._definitions.keys()
+
+    def definitions(self, name):
+        ''' return all of the subroutines with the (lower-cased) name '''
+        return self._definitions.get(name, [])
+
+    def add_file(self, my_file):
+        ''' add the modules and subroutines in my_file and return the
+            (lower-cased) names of the subroutines '''
+        for module in my_file.modules:
+            self._module_uses[module.name.lower()] = set(module.uses)
+        names = []
+        for subroutine in my_file.all_subroutines:
+            name = subroutine.name.lower()
+            self._definitions.setdefault(name, []).append(subroutine)
+            names.append(name)
+        return names
+
+    def remove_file(self, my_file):
+        ''' remove the modules and subroutines in my_file and return the
+            (lower-cased) names of the subroutines '''
+        for module in my_file.modules:
+            self._module_uses.pop(module.name.lower(), None)
+        names = []
+        for subroutine in my_file.all_subroutines:
+            name = subroutine.name.lower()
+            definitions = self._definitions.get(name, [])
+            if subroutine in definitions:
+                definitions.remove(subroutine)
+            if not definitions:
+                self._definitions.pop(name, None)
+            names.append(name)
+        return names
+
+    def _visible_modules(self, subroutine):
+        ''' return the set of modules whose subroutines are visible from
+            subroutine through use (or host) association '''
+        pending = list(subroutine.uses)
+        if subroutine.module is not None:
+            pending.append(subroutine.module.lower())
+        visible = set()
+        while pending:
+            module_name = pending.pop()
+            if module_name not in visible:
+                visible.add(module_name)
+                pending.extend(self._module_uses.get(module_name, ()))
+        return visible
+
+    def module_uses(self, name):
+        ''' return the set of modules USEd by the (lower-cased) module
+            name, or None if there is no such module '''
+        return self._module_uses.get(name)
+
+    def dependant_modules(self, names):
+        ''' return the set of modules in names together with every module
+            that USEs one of them, directly or indirectly '''
+        users = {}
+        for module_name, uses in self._module_uses.items():
+            for used in uses:
+                users.setdefault(used, []).append(module_name)
+        pending = list(names)
+        dependants = set()
+        while pending:
+            module_name = pending.pop()
+            if module_name not in dependants:
+                dependants.add(module_name)
+                pending.extend(users.get(module_name, ()))
+        return dependants
+
+    def resolve(self, name, caller=None, function=False):
+        ''' Return a tuple (subroutine, candidates) for a call to name
+            from the subroutine caller, or for a reference to the function
+            name if function is True. subroutine is None if there is no
+            definition. If the call is ambiguous, candidates holds the
+            definitions that could not be told apart and subroutine is the
+            last of them, otherwise candidates is empty. '''
+        definitions = self._definitions.get(name)
+        kind = "function" if function else "subroutine"
+        if definitions and (len(definitions) > 1 or
+                            definitions[0].kind != kind):
+            definitions = [sub for sub in definitions if sub.kind == kind]
+        if not definitions:
+            return None, []
+        if len(definitions) == 1 or caller is None:
+            candidates = definitions
+        else:
+            candidates = None
+            if caller.module is not None:
+                module_name = caller.module.lower()
+                candidates = [sub for sub in definitions if sub.module
+                              is not None and sub.module.lower() ==
+                              module_name]
+            if not candidates:
+                visible = self._visible_modules(caller)
+                candidates = [sub for sub in definitions if sub.module
+                              is not None and sub.module.lower() in visible]
+            if not candidates:
+                candidates = [sub for sub in definitions if sub.module is
+                              None]
+            if not candidates:
+                candidates = definitions
+        if len(candidates) == 1:
+            return candidates[0], []
+        return candidates[-1], list(candidates)
+
+
+class Link(CodeAnalysisTransform):
+
+    def __init__(self):
+        self._symbol_table = SymbolTable()
+        # the calls that could not be linked, indexed by name
+        self._unresolved = {}
+        # the calls that matched more than one subroutine, indexed by name
+        self._ambiguous = {}
+        # the function references that did not match a function, indexed
+        # by name. Most of these are array elements.
+        self._unmatched = {}
+        self._files = None
+        self._graph = None
+
+    @property
+    def name(self):
+        return "link"
+
+    @property
+    def description(self):
+        return ("links calls and subroutines. Modifies the files object to "
+                "add link information.")
+
+    @property
+    def symbol_table(self):
+        return self._symbol_table
+
+    def transform(self, files):
+
+        print "linking:",
+        self._files = files
+        self._graph = None
+
+        # create the symbol table
+        for my_file in self._files:
+            self._symbol_table.add_file(my_file)
+
+        for my_file in self._files:
+            for subroutine in my_file.all_subroutines:
+                self._resolve(subroutine.calls)
+
+        print "done"
+        return files
+
+    def restore(self, files, ambiguous_calls=()):
+        ''' Set up this Link for files whose calls have already been
+            linked (for example files loaded from an
+            :class:`AnalysisDatabase`), without resolving the calls again.
+
+        :param files: the linked files.
+        :type files: list of :class:`File`
+        :param ambiguous_calls: the calls that matched more than one
+                                subroutine.
+        :type ambiguous_calls: list of :class:`Call`
+        '''
+        self._files = files
+        self._graph = None
+        for my_file in self._files:
+            self._symbol_table.add_file(my_file)
+            for subroutine in my_file.all_subroutines:
+                for call in subroutine.calls:
+                    if call.link is None:
+                        index = self._unmatched if call.is_reference \
+                            else self._unresolved
+                        index.setdefault(call.name.lower(), []).append(call)
+        for call in ambiguous_calls:
+            self._ambiguous.setdefault(call.name.lower(), []).append(call)
+        return files
+
+    def is_ambiguous(self, call):
+        ''' return whether call matched more than one subroutine '''
+        return call in self._ambiguous.get(call.name.lower(), ())
+
+    def update(self, old_files, new_files):
+        ''' Incrementally re-link after some files have changed. The
+            subroutines and calls of old_files are removed from the symbol
+            table and the subroutines of new_files are added. Only the
+            calls made by new_files, the calls that were linked to the
+            subroutines of old_files and the calls that were unresolved,
+            ambiguous or linked to another definition of a changed name are
+            then (re-)resolved. If the USE list of a module has changed (or
+            a module has been added or removed), the calls made from the
+            units that can see that module, directly or through other
+            modules, are re-resolved too.
+
+        :param old_files: the files that have been removed or replaced.
+        :type old_files: list of :class:`File`
+        :param new_files: the files that have been added or replaced.
+        :type new_files: list of :class:`File`
+        '''
+        if self._files is None:
+            raise RuntimeError("run the transform method first")
+        self._graph = None
+
+        to_resolve = []
+        old_calls = set()
+        for my_file in old_files:
+            for subroutine in my_file.all_subroutines:
+                # forget the calls made by the old subroutine
+                for call in subroutine.calls:
+                    old_calls.add(id(call))
+                    self._unlink(call)
+                # calls to the old subroutine need to be re-resolved
+                for call in subroutine.link_calls:
+                    call.link = None
+                    to_resolve.append(call)
+                subroutine.link_calls[:] = []
+        old_uses = {}
+        for my_file in old_files:
+            for module in my_file.modules:
+                name = module.name.lower()
+                old_uses[name] = self._symbol_table.module_uses(name)
+        changed_names = set()
+        for my_file in old_files:
+            changed_names.update(self._symbol_table.remove_file(my_file))
+        for my_file in new_files:
+            changed_names.update(self._symbol_table.add_file(my_file))
+        changed_modules = set()
+        for my_file in new_files:
+            for module in my_file.modules:
+                name = module.name.lower()
+                if old_uses.pop(name, None) != \
+                   self._symbol_table.module_uses(name):
+                    changed_modules.add(name)
+        changed_modules.update(old_uses)
+        if changed_modules:
+            # what is visible from the users of these modules has changed
+            dependants = self._symbol_table.dependant_modules(
+                changed_modules)
+            for my_file in self._files:
+                for subroutine in my_file.all_subroutines:
+                    if (subroutine.module is not None and
+                            subroutine.module.lower() in dependants) or \
+                            not dependants.isdisjoint(subroutine.uses):
+                        for call in subroutine.calls:
+                            self._unlink(call)
+                            to_resolve.append(call)
+        for name in changed_names:
+            to_resolve.extend(self._unresolved.pop(name, []))
+            to_resolve.extend(self._ambiguous.pop(name, []))
+            to_resolve.extend(self._unmatched.pop(name, []))
+            # a new definition may make a resolved call ambiguous
+            for subroutine in self._symbol_table.definitions(name):
+                for call in subroutine.link_calls:
+                    to_resolve.append(call)
+                    call.link = None
+                subroutine.link_calls[:] = []
+        for my_file in new_files:
+            for subroutine in my_file.all_subroutines:
+                to_resolve.extend(subroutine.calls)
+        # calls from old subroutines are no longer part of the code and
+        # a call may have been added more than once
+        seen = old_calls
+        calls = []
+        for call in to_resolve:
+            if id(call) not in seen:
+                seen.add(id(call))
+                calls.append(call)
+        self._resolve(calls)
+
+    def _unlink(self, call):
+        ''' remove any link or unresolved/ambiguous/unmatched record for
+            call '''
+        name = call.name.lower()
+        if call.link is not None:
+            call.link.remove_link(call)
+            call.link = None
+        for index in [self._unresolved, self._ambiguous, self._unmatched]:
+            calls = index.get(name)
+            if calls is not None and call in calls:
+                calls.remove(call)
+                if not calls:
+                    del index[name]
+
+    def _resolve(self, calls):
+        ''' link each call to its subroutine (and each function reference
+            to its function), recording those that can not be linked or
+            are ambiguous '''
+        resolve = self._symbol_table.resolve
+        for call in calls:
+            name = call.name.lower()
+            my_subroutine, candidates = resolve(name, call.caller,
+                                                call.is_reference)
+            if my_subroutine is None:
+                if call.is_reference:
+                    self._unmatched.setdefault(name, []).append(call)
+                else:
+                    self._unresolved.setdefault(name, []).append(call)
+            else:
+                call.link = my_subroutine
+                my_subroutine.add_link(call)
+                if candidates:
+                    self._ambiguous.setdefault(name, []).append(call)
+
+    def unresolved(self):
+        ''' return the calls that could not be linked to a subroutine.
+            Function references that do not match a function are not
+            included as they are usually array elements. '''
+        result = []
+        for name in sorted(self._unresolved):
+            result.extend(self._unresolved[name])
+        return result
+
+    def ambiguous(self):
+        ''' return the calls that matched more than one subroutine. These
+            are linked to the last matching subroutine. '''
+        result = []
+        for name in sorted(self._ambiguous):
+            result.extend(self._ambiguous[name])
+        return result
+
+    def dot(self, sub_name="", stream=None):
+        ''' Write the call tree in the dot graph format. If sub_name is
+            given only the part of the tree reachable from that subroutine
+            is written.
+
+        :param sub_name: the (lower-cased) name of the root subroutine.
+        :type sub_name: str.
+        :param stream: the file-like object to write to. The default is
+                       stdout.
+        '''
+        if self._files is None:
+            raise RuntimeError("run the apply method first")
+
+        if sub_name not in self._symbol_table and sub_name != "":
+            raise RuntimeError("specified subroutine is not in the code")
+
+        if sub_name == "":
+            DotExporter().write(self.graph, stream)
+        else:
+            DotExporter().write(self.graph, stream,
+                                roots=[self.graph.node_id(
+                                    self._symbol_table[sub_name])])
+
+    @property
+    def graph(self):
+        ''' the :class:`CallGraph` of the linked code. It is built on
+            first use and rebuilt after the links change. '''
+        if self._files is None:
+            raise RuntimeError("run the transform method first")
+        if self._graph is None:
+            self._graph = CallGraph(self._files)
+        return self._graph
+
+    def info(self):
+        ''' print information about unresolved and ambiguous calls and
+            orphan subroutines (those that are never called) '''
+        if self._files is None:
+            raise RuntimeError("run the transform method first")
+        orphans = []
+        for my_file in self._files:
+            for subroutine in my_file.all_subroutines:
+                # main programs and block data are never called
+                if not subroutine.link_calls and \
+                   subroutine.kind in ["subroutine", "function"]:
+                    orphans.append(subroutine.name)
+        print "Link information ..."
+        print "    subroutine names            {0}".\
+            format(len(self._symbol_table))
+        print "    unresolved call names       {0}".\
+            format(len(self._unresolved))
+        print "    ambiguous call names        {0}".\
+            format(len(self._ambiguous))
+        print "    orphan subroutines          {0}".format(len(orphans))
+        print ""
+        print "    unresolved:", " ".join(sorted(self._unresolved))
+        print "    ambiguous:", " ".join(sorted(self._ambiguous))
+        print "    orphans:", " ".join(sorted(orphans))
+
+
+class CallGraph(object):
+    ''' A call graph engine built from linked files. Each subroutine is
+        given an integer id (in file order) and the edges are held in
+        compressed sparse row (CSR) arrays in both directions, so all of the
+        traversals below are iterative and run in time linear in the number
+        of nodes and edges that they visit.
+
+        For example:
+
+        >>> graph = link.graph
+        >>> for subroutine in graph.callees("sbc"):
+        ...     print subroutine.name
+
+    :param files: the files that have been transformed by :class:`Link`.
+    :type files: list of :class:`File`
+    '''
+
+    def __init__(self, files):
+        self._subroutines = []
+        self._paths = []  # node id -> path of the file holding it
+        self._ids = {}  # id(subroutine) -> node id
+        self._names = {}  # lower-cased name -> list of node ids
+        for my_file in files:
+            for subroutine in my_file.all_subroutines:
+                node = len(self._subroutines)
+                self._ids[id(subroutine)] = node
+                self._subroutines.append(subroutine)
+                self._paths.append(my_file.path)
+                self._names.setdefault(subroutine.name.lower(),
+                                       []).append(node)
+
+        # the unique edges out of each node with their number of call sites
+        n_nodes = len(self._subroutines)
+        out_edges = []
+        for subroutine in self._subroutines:
+            targets = {}
+            for call in subroutine.calls:
+                if call.link is not None:
+                    target = self._ids.get(id(call.link))
+                    if target is not None:
+                        targets[target] = targets.get(target, 0) + call.count
+            out_edges.append(sorted(targets.items()))
+
+        self._offsets = array("l", [0] * (n_nodes + 1))
+        self._targets = array("l")
+        self._weights = array("l")
+        in_degree = array("l", [0] * n_nodes)
+        for node, edges in enumerate(out_edges):
+            for target, weight in edges:
+                self._targets.append(target)
+                self._weights.append(weight)
+                in_degree[target] += 1
+            self._offsets[node + 1] = len(self._targets)
+
+        # the reverse (callers) CSR arrays
+        self._rev_offsets = array("l", [0] * (n_nodes + 1))
+        for node in range(n_nodes):
+            self._rev_offsets[node + 1] = self._rev_offsets[node] + \
+                in_degree[node]
+        self._rev_targets = array("l", [0] * len(self._targets))
+        fill = array("l", self._rev_offsets[:n_nodes])
+        for node in range(n_nodes):
+            for idx in range(self._offsets[node], self._offsets[node + 1]):
+                target = self._targets[idx]
+                self._rev_targets[fill[target]] = node
+                fill[target] += 1
+
+    def __len__(self):
+        return len(self._subroutines)
+
+    @property
+    def n_edges(self):
+        return len(self._targets)
+
+    def subroutine(self, node):
+        ''' return the subroutine with the node id '''
+        return self._subroutines[node]
+
+    def path(self, node):
+        ''' return the path of the file holding the subroutine with the
+            node id '''
+        return self._paths[node]
+
+    def node_id(self, subroutine):
+        ''' return the node id of the subroutine '''
+        return self._ids[id(subroutine)]
+
+    def node_ids(self, name):
+        ''' return the node ids of all subroutines called name '''
+        node_ids = self._names.get(name.lower())
+        if node_ids is None:
+            raise RuntimeError(
+                "specified subroutine '{0}' is not in the code".format(name))
+        return node_ids
+
+    def _roots(self, roots):
+        ''' convert a name, a subroutine or a list of node ids into a list
+            of node ids '''
+        if isinstance(roots, basestring):
+            return self.node_ids(roots)
+        if isinstance(roots, Subroutine):
+            return [self.node_id(roots)]
+        return list(roots)
+
+    def successors(self, node, reverse=False):
+        ''' return the node ids called by (or, if reverse is True, calling)
+            the node '''
+        if reverse:
+            return self._rev_targets[self._rev_offsets[node]:
+                                     self._rev_offsets[node + 1]]
+        return self._targets[self._offsets[node]:self._offsets[node + 1]]
+
+    def edges(self):
+        ''' generator returning (caller, callee, number of call sites) node
+            id tuples for every unique edge '''
+        for node in range(len(self._subroutines)):
+            for idx in range(self._offsets[node], self._offsets[node + 1]):
+                yield node, self._targets[idx], self._weights[idx]
+
+    def bfs(self, roots, reverse=False, max_depth=None):
+        ''' Generator returning (node id, depth) for each node reachable
+            from roots in breadth first order. Each node is returned once.
+
+        :param roots: a subroutine name, a Subroutine or a list of node ids.
+        :param reverse: follow the edges backwards (towards the callers).
+        :type reverse: bool.
+        :param max_depth: the maximum depth to traverse. 'None' (the
+                          default) means there is no limit.
+        :type max_depth: int.
+        '''
+        from collections import deque
+        seen = set()
+        queue = deque()
+        for root in self._roots(roots):
+            if root not in seen:
+                seen.add(root)
+                queue.append((root, 0))
+        while queue:
+            node, depth = queue.popleft()
+            yield node, depth
+            if max_depth is not None and depth >= max_depth:
+                continue
+            for target in self.successors(node, reverse):
+                if target not in seen:
+                    seen.add(target)
+                    queue.append((target, depth + 1))
+
+    def dfs(self, roots, reverse=False, max_depth=None):
+        ''' As :func:`bfs` but in depth first (pre-)order. '''
+        seen = set()
+        stack = []
+        for root in reversed(self._roots(roots)):
+            stack.append((root, 0))
+        while stack:
+            node, depth = stack.pop()
+            if node in seen:
+                continue
+            seen.add(node)
+            yield node, depth
+            if max_depth is not None and depth >= max_depth:
+                continue
+            successors = self.successors(node, reverse)
+            for idx in range(len(successors) - 1, -1, -1):
+                if successors[idx] not in seen:
+                    stack.append((successors[idx], depth + 1))
+
+    def callees(self, roots, transitive=True):
+        ''' return the subroutines called by roots (not including roots
+            unless they are called recursively). If transitive is False
+            only the direct callees are returned. '''
+        return self._related(roots, transitive, reverse=False)
+
+    def callers(self, roots, transitive=True):
+        ''' return the subroutines that call roots, as for
+            :func:`callees` '''
+        return self._related(roots, transitive, reverse=True)
+
+    def _related(self, roots, transitive, reverse):
+        roots = self._roots(roots)
+        seen = set()
+        pending = list(roots)
+        while pending:
+            node = pending.pop()
+            for target in self.successors(node, reverse):
+                if target not in seen:
+                    seen.add(target)
+                    if transitive:
+                        pending.append(target)
+        return [self._subroutines[node] for node in sorted(seen)]
+
+    def strongly_connected_components(self):
+        ''' Return the strongly connected components of the graph, as lists
+            of node ids, using an iterative version of Tarjan's algorithm.
+            The components are returned in reverse topological order
+            (callees before callers). '''
+        return _strongly_connected_components(self._offsets, self._targets)
+
+    def recursion(self):
+        ''' return a list of the groups of subroutines that are (directly
+            or mutually) recursive '''
+        result = []
+        for component in self.strongly_connected_components():
+            node = component[0]
+            if len(component) > 1 or node in self.successors(node):
+                result.append([self._subroutines[member]
+                               for member in sorted(component)])
+        return result
+
+    def shortest_path(self, source, target):
+        ''' Return the shortest chain of calls from source to target as a
+            list of subroutines (including both), or None if target can
+            not be reached from source. '''
+        from collections import deque
+        targets = set(self._roots(target))
+        parent = {}
+        queue = deque()
+        for root in self._roots(source):
+            parent[root] = None
+            queue.append(root)
+        while queue:
+            node = queue.popleft()
+            if node in targets:
+                path = []
+                while node is not None:
+                    path.append(self._subroutines[node])
+                    node = parent[node]
+                path.reverse()
+                return path
+            for successor in self.successors(node):
+                if successor not in parent:
+                    parent[successor] = node
+                    queue.append(successor)
+        return None
+
+    def subgraph(self, roots, max_depth=None, reverse=False):
+        ''' Return (nodes, edges) for the part of the graph reachable from
+            roots within max_depth calls. nodes is a list of node ids in
+            breadth first order and edges a list of (caller, callee, number
+            of call sites) node id tuples between them. '''
+        nodes = [node for node, depth in self.bfs(roots, reverse, max_depth)]
+        members = set(nodes)
+        edges = []
+        for node in nodes:
+            for idx in range(self._offsets[node], self._offsets[node + 1]):
+                target = self._targets[idx]
+                if target in members:
+                    edges.append((node, target, self._weights[idx]))
+        return nodes, edges
+
+
+class ModuleGraph(object):
+    ''' The USE dependencies between modules, built from the USE
+        statements that the analysis (or the :class:`Scanner`) already
+        records, so no further pass over the code is needed. A module
+        depends on the modules USEd by it and by the procedures it
+        contains. Modules that are USEd but not defined in the files (MPI
+        or netCDF, for example) are external and are not part of the
+        graph. As in :class:`CallGraph`, each module is given an integer id
+        (in file order) and the dependencies are held in CSR arrays.
+
+        The graph gives the order in which the modules must be compiled,
+        the batches of modules that can be compiled in parallel and the
+        length of the critical path, which limits how much a parallel
+        build can gain. The file dependencies can be written as Makefile
+        or Ninja fragments so that the build runs with as much parallelism
+        as the module structure allows.
+
+        For example:
+
+        >>> graph = ModuleGraph(parsed)
+        >>> for batch in graph.levels():
+        ...     print " ".join(batch)
+        >>> with open("depends.mk", "w") as depends:
+        ...     graph.makefile(depends)
+
+    :param files: the analysed files.
+    :type files: list of :class:`File`
+    '''
+
+    def __init__(self, files):
+        # node id -> lower-cased module name, module and defining file
+        self._names = []
+        self._modules = []
+        self._paths = []
+        self._ids = {}  # lower-cased name -> node id
+        # lower-cased name -> paths of the files defining it, for the
+        # modules that are defined more than once
+        self._duplicates = {}
+        self._external = set()
+        # path -> the lower-cased names of the modules the file uses
+        file_uses = []
+        for my_file in files:
+            for module in my_file.modules:
+                name = module.name.lower()
+                if name in self._ids:
+                    self._duplicates.setdefault(
+                        name, [self._paths[self._ids[name]]]).append(
+                            my_file.path)
+                    continue
+                self._ids[name] = len(self._names)
+                self._names.append(name)
+                self._modules.append(module)
+                self._paths.append(my_file.path)
+            used = set()
+            for unit in my_file.all_subroutines:
+                used.update(unit.uses)
+            for module in my_file.modules:
+                used.update(module.uses)
+            file_uses.append((my_file.path, used))
+
+        self._offsets = array("l", [0] * (len(self._names) + 1))
+        self._targets = array("l")
+        for node, module in enumerate(self._modules):
+            used = set(module.uses)
+            for subroutine in module.subroutines:
+                used.update(subroutine.uses)
+            used.discard(self._names[node])
+            targets = set()
+            for name in used:
+                target = self._ids.get(name)
+                if target is None:
+                    self._external.add(name)
+                else:
+                    targets.add(target)
+            self._targets.extend(sorted(targets))
+            self._offsets[node + 1] = len(self._targets)
+
+        # path -> the paths of the files defining the modules it uses
+        from collections import OrderedDict
+        self._file_dependencies = OrderedDict()
+        for file_path, used in file_uses:
+            dependencies = set()
+            for name in used:
+                node = self._ids.get(name)
+                if node is None:
+                    self._external.add(name)
+                elif self._paths[node] != file_path:
+                    dependencies.add(self._paths[node])
+            self._file_dependencies[file_path] = sorted(dependencies)
+
+    def __len__(self):
+        return len(self._names)
+
+    def __contains__(self, name):
+        return name.lower() in self._ids
+
+    @property
+    def n_edges(self):
+        return len(self._targets)
+
+    @property
+    def names(self):
+        ''' the lower-cased names of the modules in file order '''
+        return list(self._names)
+
+    def module(self, name):
+        ''' return the :class:`Module` called name '''
+        return self._modules[self._node(name)]
+
+    def path(self, name):
+        ''' return the path of the file defining the module name '''
+        return self._paths[self._node(name)]
+
+    def _node(self, name):
+        node = self._ids.get(name.lower())
+        if node is None:
+            raise RuntimeError(
+                "specified module '{0}' is not in the code".format(name))
+        return node
+
+    def dependencies(self, name):
+        ''' return the names of the modules that the module name uses '''
+        node = self._node(name)
+        return [self._names[self._targets[idx]] for idx in
+                range(self._offsets[node], self._offsets[node + 1])]
+
+    def dependents(self, name):
+        ''' return the names of the modules that use the module name '''
+        node = self._node(name)
+        return [self._names[other] for other in range(len(self._names))
+                if node in self._targets[self._offsets[other]:
+                                         self._offsets[other + 1]]]
+
+    def external(self):
+        ''' return the (sorted) names of the modules that are used but
+            not defined in the files '''
+        return sorted(self._external)
+
+    def duplicates(self):
+        ''' Return a map from the name of each module that is defined
+            in more than one file to the paths of those files. The first
+            definition is the one used in the graph. '''
+        return dict(self._duplicates)
+
+    def cycles(self):
+        ''' return a list of the groups of modules that depend on each
+            other. A correct code has none. '''
+        result = []
+        for component in _strongly_connected_components(self._offsets,
+                                                        self._targets):
+            if len(component) > 1:
+                result.append([self._names[node]
+                               for node in sorted(component)])
+        return result
+
+    def _check_cycles(self):
+        cycles = self.cycles()
+        if cycles:
+            raise RuntimeError(
+                "the modules have dependency cycles: {0}".format("; ".join(
+                    " ".join(cycle) for cycle in cycles)))
+
+    def _depths(self):
+        ''' return the level of each node: 0 for a module that uses no
+            other modules, otherwise one more than the highest level of
+            the modules it uses '''
+        self._check_cycles()
+        n_nodes = len(self._names)
+        depths = array("l", [-1] * n_nodes)
+        for start in range(n_nodes):
+            if depths[start] != -1:
+                continue
+            work = [start]
+            while work:
+                node = work[-1]
+                pending = [target for target in self._targets[
+                    self._offsets[node]:self._offsets[node + 1]]
+                           if depths[target] == -1]
+                if pending:
+                    work.extend(pending)
+                    continue
+                work.pop()
+                if depths[node] == -1:
+                    depths[node] = 1 + max(
+                        [depths[target] for target in self._targets[
+                            self._offsets[node]:self._offsets[node + 1]]] +
+                        [-1])
+        return depths
+
+    def levels(self):
+        ''' Return the modules as a list of batches. Every module in a
+            batch only uses modules in earlier batches, so the modules in
+            a batch can be compiled in parallel once the earlier batches
+            are done. A RuntimeError is raised if there are cycles. '''
+        depths = self._depths()
+        batches = [[] for _ in range(max(depths) + 1 if depths else 0)]
+        for node, depth in enumerate(depths):
+            batches[depth].append(self._names[node])
+        return batches
+
+    def compile_order(self):
+        ''' return the names of the modules in an order in which they
+            can be compiled: each module comes after the modules it uses.
+            A RuntimeError is raised if there are cycles. '''
+        return [name for batch in self.levels() for name in batch]
+
+    def critical_path(self, cost=None):
+        ''' Return (length, names) for the longest chain of module
+            dependencies, with names running from the module that is
+            compiled first to the one compiled last. No parallel build can
+            take less time than this chain. A RuntimeError is raised if
+            there are cycles.
+
+        :param cost: a function returning the cost of compiling a
+                     :class:`Module`, for example its number of lines. The
+                     default gives each module a cost of one, so the length
+                     is the number of levels.
+        :type cost: function
+        '''
+        n_nodes = len(self._names)
+        if n_nodes == 0:
+            return 0, []
+        depths = self._depths()
+        # visit the modules so that dependencies come first
+        order = sorted(range(n_nodes), key=depths.__getitem__)
+        total = [0] * n_nodes
+        previous = [None] * n_nodes
+        for node in order:
+            best = None
+            for target in self._targets[self._offsets[node]:
+                                        self._offsets[node + 1]]:
+                if best is None or total[target] > total[best]:
+                    best = target
+            previous[node] = best
+            total[node] = (1 if cost is None else
+                           cost(self._modules[node])) + \
+                (total[best] if best is not None else 0)
+        node = max(range(n_nodes), key=total.__getitem__)
+        length = total[node]
+        path = []
+        while node is not None:
+            path.append(self._names[node])
+            node = previous[node]
+        path.reverse()
+        return length, path
+
+    def file_dependencies(self):
+        ''' return an ordered map from the path of each file to the
+            (sorted) paths of the files defining the modules it uses '''
+        return self._file_dependencies
+
+    def makefile(self, stream=None, object_suffix=".o"):
+        ''' Write a Makefile fragment with a rule for each file that uses
+            modules from other files, making its object file depend on
+            theirs, to stream (stdout by default). For example "a.o: b.o".
+        '''
+        import os
+        if stream is None:
+            import sys
+            stream = sys.stdout
+
+        def target(file_path):
+            name = os.path.splitext(file_path)[0] + object_suffix
+            return name.replace("$", "$$").replace(" ", "\\ ")
+
+        lines = []
+        for file_path, dependencies in self._file_dependencies.items():
+            if dependencies:
+                lines.append("{0}: {1}\n".format(target(file_path), " ".join(
+                    target(dependency) for dependency in dependencies)))
+        stream.write("".join(lines))
+
+    def ninja(self, stream=None, rule="fc", object_suffix=".o"):
+        ''' Write a Ninja fragment with a build statement for each file,
+            using rule to compile it, with the object files of the files
+            it depends on as implicit dependencies, to stream (stdout by
+            default). For example "build a.o: fc a.f90 | b.o". '''
+        import os
+        if stream is None:
+            import sys
+            stream = sys.stdout
+
+        def escape(file_path):
+            return file_path.replace("$", "$$").replace(" ", "$ ").replace(
+                ":", "$:")
+
+        def target(file_path):
+            return escape(os.path.splitext(file_path)[0] + object_suffix)
+
+        lines = []
+        for file_path, dependencies in self._file_dependencies.items():
+            line = "build {0}: {1} {2}".format(target(file_path), rule,
+                                               escape(file_path))
+            if dependencies:
+                line += " | " + " ".join(target(dependency)
+                                         for dependency in dependencies)
+            lines.append(line + "\n")
+        stream.write("".join(lines))
+
+
+def _strongly_connected_components(offsets, targets):
+    ''' Return the strongly connected components of the graph held in
+        the CSR arrays offsets and targets, as lists of node ids, using an
+        iterative version of Tarjan's algorithm. The components are
+        returned in reverse topological order (successors first). '''
+    n_nodes = len(offsets) - 1
+    index = array("l", [-1] * n_nodes)
+    lowlink = array("l", [0] * n_nodes)
+    on_stack = array("b", [0] * n_nodes)
+    stack = []
+    components = []
+    counter = 0
+    for start in range(n_nodes):
+        if index[start] != -1:
+            continue
+        # each work item is (node, position in its successor list)
+        work = [(start, offsets[start])]
+        index[start] = lowlink[start] = counter
+        counter += 1
+        stack.append(start)
+        on_stack[start] = 1
+        while work:
+            node, pos = work[-1]
+            if pos < offsets[node + 1]:
+                work[-1] = (node, pos + 1)
+                target = targets[pos]
+                if index[target] == -1:
+                    index[target] = lowlink[target] = counter
+                    counter += 1
+                    stack.append(target)
+                    on_stack[target] = 1
+                    work.append((target, offsets[target]))
+                elif on_stack[target]:
+                    lowlink[node] = min(lowlink[node], index[target])
+            else:
+                work.pop()
+                if work:
+                    parent = work[-1][0]
+                    lowlink[parent] = min(lowlink[parent], lowlink[node])
+                if lowlink[node] == index[node]:
+                    component = []
+                    while True:
+                        member = stack.pop()
+                        on_stack[member] = 0
+                        component.append(member)
+                        if member == node:
+                            break
+                    components.append(component)
+    return components
+
+
+class GraphExporter(object):
+    ''' Base class for writing a :class:`CallGraph` to a file-like object.
+        Subclasses generate the output a line at a time and the lines are
+        written in chunks, so large graphs are written quickly without
+        building the whole output in memory. In streaming mode the stream
+        is also flushed after every chunk.
+
+    :param chunk_size: the number of lines to write at a time.
+    :type chunk_size: int.
+    :param streaming: flush the stream after each chunk.
+    :type streaming: bool.
+    '''
+
+    def __init__(self, chunk_size=4096, streaming=False):
+        self._chunk_size = chunk_size
+        self._streaming = streaming
+
+    def write(self, graph, stream=None, roots=None, max_depth=None):
+        ''' Write graph to stream (stdout by default). If roots is given
+            only the part of the graph reachable from roots (within
+            max_depth calls) is written.
+
+        :param graph: the graph to write.
+        :type graph: :class:`CallGraph`
+        :param stream: the file-like object to write to.
+        :param roots: a subroutine name, a Subroutine or a list of node ids.
+        :param max_depth: the maximum depth to traverse from roots.
+        :type max_depth: int.
+        '''
+        if stream is None:
+            import sys
+            stream = sys.stdout
+        if roots is None:
+            nodes = range(len(graph))
+            edges = graph.edges()
+        else:
+            nodes, edges = graph.subgraph(roots, max_depth=max_depth)
+        chunk = []
+        for line in self.lines(graph, nodes, edges):
+            chunk.append(line)
+            if len(chunk) >= self._chunk_size:
+                self._flush(stream, chunk)
+                chunk = []
+        self._flush(stream, chunk)
+
+    def _flush(self, stream, chunk):
+        if chunk:
+            stream.write("".join(chunk))
+        if self._streaming:
+            stream.flush()
+
+    def lines(self, graph, nodes, edges):
+        ''' generator returning the output lines (including the newline
+            characters) for the nodes and edges of graph '''
+        raise NotImplementedError("lines method should be implemented")
+
+    @staticmethod
+    def labels(graph, nodes):
+        ''' Return a map from node id to a unique label. The label is the
+            subroutine name unless more than one of the nodes has that name,
+            in which case it is qualified with the module name (if there is
+            one). Labels that are still shared are followed by the path of
+            the file in brackets and then, if need be, by "#" and a count
+            in node order. '''
+        def qualify(relabel):
+            ''' relabel each node whose label is shared with another '''
+            shared = {}
+            for node in nodes:
+                shared.setdefault(labels[node].lower(), []).append(node)
+            for same in shared.values():
+                if len(same) > 1:
+                    for index, node in enumerate(same, 1):
+                        labels[node] = relabel(node, index)
+
+        def module_label(node, index):
+            subroutine = graph.subroutine(node)
+            if subroutine.module is None:
+                return subroutine.name
+            return subroutine.module + "." + subroutine.name
+
+        labels = dict((node, graph.subroutine(node).name) for node in nodes)
+        qualify(module_label)
+        qualify(lambda node, index: "{0} ({1})".format(labels[node],
+                                                       graph.path(node)))
+        qualify(lambda node, index: "{0}#{1}".format(labels[node], index))
+        return labels
+
+
+class DotExporter(GraphExporter):
+    ''' write a :class:`CallGraph` in the dot graph format '''
+
+    def lines(self, graph, nodes, edges):
+        labels = dict((node, _dot_id(label)) for node, label in
+                      self.labels(graph, nodes).items())
+        yield "digraph G {\n"
+        for node in nodes:
+            yield labels[node] + ";\n"
+        for caller, callee, count in edges:
+            yield labels[caller] + " -> " + labels[callee] + ";\n"
+        yield "}\n"
+
+
+def _dot_id(name):
+    ''' return name as a quoted dot ID, so that qualified names such as
+        "m.s" and names such as "graph" that are dot keywords are valid '''
+    return '"' + name.replace("\\", "\\\\").replace('"', '\\"') + '"'
+
+
+class GraphMLExporter(GraphExporter):
+    ''' write a :class:`CallGraph` in the GraphML format. Nodes have name
+        and module attributes and edges have the number of call sites. '''
+
+    def lines(self, graph, nodes, edges):
+        from xml.sax.saxutils import escape
+        yield '<?xml version="1.0" encoding="UTF-8"?>\n'
+        yield ('<graphml xmlns="http://graphml.graphdrawing.org/xmlns">\n')
+        yield ('  <key id="name" for="node" attr.name="name" '
+               'attr.type="string"/>\n')
+        yield ('  <key id="module" for="node" attr.name="module" '
+               'attr.type="string"/>\n')
+        yield ('  <key id="calls" for="edge" attr.name="calls" '
+               'attr.type="int"/>\n')
+        yield '  <graph id="G" edgedefault="directed">\n'
+        for node in nodes:
+            subroutine = graph.subroutine(node)
+            line = '    <node id="n{0}"><data key="name">{1}</data>'.format(
+                node, escape(subroutine.name))
+            if subroutine.module is not None:
+                line += '<data key="module">{0}</data>'.format(
+                    escape(subroutine.module))
+            yield line + "</node>\n"
+        for caller, callee, count in edges:
+            yield ('    <edge source="n{0}" target="n{1}"><data key="calls">'
+                   '{2}</data></edge>\n'.format(caller, callee, count))
+        yield "  </graph>\n"
+        yield "</graphml>\n"
+
+
+class EdgeListExporter(GraphExporter):
+    ''' Write a :class:`CallGraph` as a compact edge list, either as CSV
+        (one "caller,callee,calls" line per edge) or as JSON (an object with
+        a list of node names and a list of [caller, callee, calls] edges
+        where caller and callee index the node list).
+
+    :param format: "csv" or "json".
+    :type format: str.
+    '''
+
+    def __init__(self, format="csv", chunk_size=4096, streaming=False):
+        if format not in ["csv", "json"]:
+            raise RuntimeError(
+                "unsupported edge list format '{0}'".format(format))
+        GraphExporter.__init__(self, chunk_size, streaming)
+        self._format = format
+
+    def lines(self, graph, nodes, edges):
+        labels = self.labels(graph, nodes)
+        if self._format == "csv":
+            yield "caller,callee,calls\n"
+            for caller, callee, count in edges:
+                yield "{0},{1},{2}\n".format(labels[caller], labels[callee],
+                                             count)
+            return
+        import json
+        positions = {}
+        yield '{"nodes": [\n'
+        for idx, node in enumerate(nodes):
+            positions[node] = idx
+            yield ("," if idx else "") + json.dumps(labels[node]) + "\n"
+        yield '], "edges": [\n'
+        for idx, (caller, callee, count) in enumerate(edges):
+            yield "{0}[{1}, {2}, {3}]\n".format("," if idx else "",
+                                                positions[caller],
+                                                positions[callee], count)
+        yield "]}\n"
+
+
+class AnalysisDiff(object):
+    ''' The differences between two analysed (and linked) versions of a
+        code: the subroutines (and other program units) that were added,
+        removed or changed, the call edges that were added or removed, the
+        calls that were rewired to a different subroutine, the modules
+        that were added or removed or whose USEs changed, and the change
+        in each of the :class:`Stats` totals.
+
+        Units are matched by kind, module and name. A unit is given a
+        hashed signature of its USEs, its calls (with the number of call
+        sites and the unit each call is linked to), its statement counts
+        and its length, and only the units whose signature differs are
+        compared in detail. Unit positions are not part of the signature,
+        so code that has only moved within a file does not show up as
+        changed.
+
+        If the file signatures of both versions are given (as they are by
+        :func:`from_databases`), a file at the same path with the same
+        signature in both is taken to be unchanged. Its units are only
+        hashed if one of their calls may now be linked differently, and
+        its statistics are worked out once for both versions.
+
+        For example:
+
+        >>> diff = AnalysisDiff.from_databases("nemo_3.4.db", "nemo_3.6.db")
+        >>> diff.info()
+        >>> with open("changes.dot", "w") as dot_file:
+        ...     diff.dot(dot_file)
+
+    :param old_files: the linked files of the old version.
+    :type old_files: list of :class:`File`
+    :param new_files: the linked files of the new version.
+    :type new_files: list of :class:`File`
+    :param old_signatures: a map from the path of each file of the old
+                           version to its signature, such as its
+                           (modification time, size).
+    :type old_signatures: dict
+    :param new_signatures: the file signatures of the new version.
+    :type new_signatures: dict
+    '''
+
+    def __init__(self, old_files, new_files, old_signatures=None,
+                 new_signatures=None):
+        unchanged = set()
+        if old_signatures is not None and new_signatures is not None:
+            unchanged = set(
+                path for path, signature in new_signatures.items()
+                if None not in signature and
+                old_signatures.get(path) == signature)
+            unchanged &= set(my_file.path for my_file in old_files)
+            unchanged &= set(my_file.path for my_file in new_files)
+        old = _DiffSide(old_files, unchanged)
+        new = _DiffSide(new_files, unchanged)
+
+        self._modules = {"added": sorted(set(new.module_uses) -
+                                         set(old.module_uses)),
+                         "removed": sorted(set(old.module_uses) -
+                                           set(new.module_uses)),
+                         "uses changed": []}
+        for name in sorted(set(new.module_uses) & set(old.module_uses)):
+            old_uses = old.module_uses[name]
+            new_uses = new.module_uses[name]
+            if old_uses != new_uses:
+                self._modules["uses changed"].append(
+                    (name, sorted(new_uses - old_uses),
+                     sorted(old_uses - new_uses)))
+
+        # A call in an unchanged file can only be linked differently if a
+        # unit of its name is in a changed file, or if the USEs of a module
+        # changed. Otherwise the units of unchanged files are unchanged.
+        names = set(key[2] for key in old.changed_keys) | \
+            set(key[2] for key in new.changed_keys)
+        recheck_all = bool(self._modules["uses changed"])
+
+        def compare(key):
+            if key in old.changed_keys or key in new.changed_keys or \
+               recheck_all:
+                return True
+            return any(call.name.lower() in names
+                       for call in new.units[key].calls)
+
+        self._added = [key for key in new.units if key not in old.units]
+        self._removed = [key for key in old.units if key not in new.units]
+        self._changed = [key for key in new.units if key in old.units and
+                         compare(key) and
+                         old.signature(key) != new.signature(key)]
+        self._n_unchanged = len(new.units) - len(self._added) - \
+            len(self._changed)
+
+        # only the calls of added, removed and changed units can differ
+        self._added_edges = []
+        self._removed_edges = []
+        self._rewired = []
+        for key in self._added:
+            for name, target in new.calls(key):
+                self._added_edges.append((key, target, name))
+        for key in self._removed:
+            for name, target in old.calls(key):
+                self._removed_edges.append((key, target, name))
+        for key in self._changed:
+            old_calls = old.calls(key)
+            new_calls = new.calls(key)
+            old_targets = dict(old_calls)
+            new_targets = dict(new_calls)
+            for name, target in new_calls:
+                if name not in old_targets:
+                    self._added_edges.append((key, target, name))
+                elif old_targets[name] != target:
+                    self._rewired.append((key, name, old_targets[name],
+                                          target))
+            for name, target in old_calls:
+                if name not in new_targets:
+                    self._removed_edges.append((key, target, name))
+
+        # the totals are sums over the files, so those of the unchanged
+        # files are only worked out once
+        unchanged_stats = Stats()
+        unchanged_stats.apply([my_file for my_file in new_files
+                               if my_file.path in unchanged], quiet=True)
+        unchanged_summary = unchanged_stats.summary()
+        old_summary = old.stats.summary()
+        new_summary = new.stats.summary()
+        self._stats = {}
+        for name, value in unchanged_summary.items():
+            self._stats[name] = (value + old_summary[name],
+                                 value + new_summary[name])
+
+    @classmethod
+    def from_databases(cls, old_path, new_path):
+        ''' return the diff of the analyses saved (linked) in two
+            :class:`AnalysisDatabase` files '''
+        old_database = AnalysisDatabase(old_path)
+        new_database = AnalysisDatabase(new_path)
+        return cls(old_database.load(), new_database.load(),
+                   old_database.signatures(), new_database.signatures())
+
+    @property
+    def added(self):
+        ''' the labels of the units that are only in the new version '''
+        return [_diff_label(key) for key in self._added]
+
+    @property
+    def removed(self):
+        ''' the labels of the units that are only in the old version '''
+        return [_diff_label(key) for key in self._removed]
+
+    @property
+    def changed(self):
+        ''' the labels of the units whose signature has changed '''
+        return [_diff_label(key) for key in self._changed]
+
+    @property
+    def added_edges(self):
+        ''' (caller, callee, called name) for each call that is only in
+            the new version. callee is None if the call is not linked. '''
+        return [(_diff_label(key), _diff_label(target), name)
+                for key, target, name in self._added_edges]
+
+    @property
+    def removed_edges(self):
+        ''' (caller, callee, called name) for each call that is only in
+            the old version. callee is None if the call was not linked. '''
+        return [(_diff_label(key), _diff_label(target), name)
+                for key, target, name in self._removed_edges]
+
+    @property
+    def rewired(self):
+        ''' (caller, called name, old callee, new callee) for each call
+            that is linked to a different unit in the new version '''
+        return [(_diff_label(key), name, _diff_label(old_target),
+                 _diff_label(new_target))
+                for key, name, old_target, new_target in self._rewired]
+
+    @property
+    def modules(self):
+        ''' a map holding the "added" and "removed" module names and
+            (name, added uses, removed uses) for each module whose USEs
+            have "uses changed" '''
+        return self._modules
+
+    @property
+    def stats(self):
+        ''' a map from each :func:`Stats.summary` total to its (old, new)
+            values '''
+        return self._stats
+
+    def summary(self):
+        ''' return the whole diff as a map that can be written as JSON '''
+        return {"units": {"added": self.added, "removed": self.removed,
+                          "changed": self.changed,
+                          "unchanged": self._n_unchanged},
+                "calls": {"added": self.added_edges,
+                          "removed": self.removed_edges,
+                          "rewired": self.rewired},
+                "modules": self._modules,
+                "stats": dict((name, {"old": old, "new": new,
+                                      "delta": new - old})
+                              for name, (old, new) in self._stats.items())}
+
+    def json(self, stream=None):
+        ''' write :func:`summary` as JSON to stream (stdout by default) '''
+        import json
+        if stream is None:
+            import sys
+            stream = sys.stdout
+        json.dump(self.summary(), stream, indent=1, sort_keys=True)
+        stream.write("\n")
+
+    def dot(self, stream=None):
+        ''' Write the changed part of the call graph in the dot graph
+            format to stream (stdout by default). Added units and calls are
+            green, removed ones red and dashed and changed units orange.
+            A rewired call is shown as a removed and an added call. The
+            callers and callees of changed calls are included, uncoloured,
+            for context. '''
+        if stream is None:
+            import sys
+            stream = sys.stdout
+        colours = {}
+        for key in self._changed:
+            colours[key] = "orange"
+        for key in self._added:
+            colours[key] = "green"
+        for key in self._removed:
+            colours[key] = "red"
+        edges = []
+        for key, target, _ in self._added_edges:
+            edges.append((key, target, "green"))
+        for key, target, _ in self._removed_edges:
+            edges.append((key, target, "red"))
+        for key, _, old_target, new_target in self._rewired:
+            edges.append((key, old_target, "red"))
+            edges.append((key, new_target, "green"))
+        edges = [edge for edge in edges if edge[1] is not None]
+        nodes = list(colours)
+        for key, target, _ in edges:
+            for node in [key, target]:
+                if node not in colours:
+                    colours[node] = None
+                    nodes.append(node)
+        lines = ["digraph G {\n"]
+        for node in nodes:
+            style = ""
+            if colours[node] is not None:
+                style = " [color={0}{1}]".format(
+                    colours[node],
+                    ", style=dashed" if colours[node] == "red" else "")
+            lines.append("\"{0}\"{1};\n".format(_diff_label(node), style))
+        written = set()
+        for key, target, colour in edges:
+            if (key, target, colour) not in written:
+                written.add((key, target, colour))
+                lines.append("\"{0}\" -> \"{1}\" [color={2}{3}];\n".format(
+                    _diff_label(key), _diff_label(target), colour,
+                    ", style=dashed" if colour == "red" else ""))
+        lines.append("}\n")
+        stream.write("".join(lines))
+
+    def info(self):
+        ''' print a summary of the differences '''
+        print "Diff information ..."
+        print "    units added                 {0}".format(len(self._added))
+        print "    units removed               {0}".format(len(self._removed))
+        print "    units changed               {0}".format(len(self._changed))
+        print "    units unchanged             {0}".format(self._n_unchanged)
+        print "    calls added                 {0}".format(
+            len(self._added_edges))
+        print "    calls removed               {0}".format(
+            len(self._removed_edges))
+        print "    calls rewired               {0}".format(len(self._rewired))
+        print "    modules added               {0}".format(
+            len(self._modules["added"]))
+        print "    modules removed             {0}".format(
+            len(self._modules["removed"]))
+        print "    modules with changed uses   {0}".format(
+            len(self._modules["uses changed"]))
+        print ""
+        for name in sorted(self._stats):
+            old, new = self._stats[name]
+            if old != new:
+                print "    {0:<28}{1} -> {2} ({3:+d})".format(name, old, new,
+                                                             new - old)
+
+
+class _DiffSide(object):
+    ''' The units, signatures, module USEs and stats of one version for
+        :class:`AnalysisDiff`. The stats only cover the files whose paths
+        are not in unchanged, and changed_keys holds the keys of their
+        units. '''
+
+    def __init__(self, files, unchanged=frozenset()):
+        from collections import OrderedDict
+        # key -> unit, in file order
+        self.units = OrderedDict()
+        self.changed_keys = set()
+        self._keys = {}  # id(unit) -> key
+        # lower-cased module name -> set of lower-cased used module names
+        self.module_uses = {}
+        for my_file in files:
+            for module in my_file.modules:
+                uses = set(module.uses)
+                for subroutine in module.subroutines:
+                    uses.update(subroutine.uses)
+                self.module_uses.setdefault(module.name.lower(),
+                                            set()).update(uses)
+            changed = my_file.path not in unchanged
+            for unit in my_file.all_subroutines:
+                key = (unit.kind, unit.module.lower() if unit.module
+                       else None, unit.name.lower(), 0)
+                while key in self.units:
+                    # a unit defined more than once in the same scope
+                    key = key[:3] + (key[3] + 1,)
+                self.units[key] = unit
+                self._keys[id(unit)] = key
+                if changed:
+                    self.changed_keys.add(key)
+        self._signatures = {}
+        self.stats = Stats()
+        self.stats.apply([my_file for my_file in files
+                          if my_file.path not in unchanged], quiet=True)
+
+    def signature(self, key):
+        ''' return the hashed signature of the unit with key '''
+        signature = self._signatures.get(key)
+        if signature is None:
+            unit = self.units[key]
+            signature = hash((
+                tuple(unit.uses), tuple(sorted(
+                    (name, call.count, target) for name, target, call in
+                    self._calls(key))),
+                tuple(unit.category_counts),
+                unit.end_line - unit.start_line))
+            self._signatures[key] = signature
+        return signature
+
+    def calls(self, key):
+        ''' return (called name, target key) for each call made by the
+            unit with key. The name of a function reference ends in "()" to
+            tell it apart from a CALL of the same name. '''
+        return [(name, target) for name, target, _ in self._calls(key)]
+
+    def _calls(self, key):
+        ''' return (called name, target key, Call) for each call made by
+            the unit with key. References that are not linked to a function
+            are array elements rather than calls so are left out. '''
+        result = []
+        for call in self.units[key].calls:
+            if call.is_reference and call.link is None:
+                continue
+            name = call.name.lower()
+            if call.is_reference:
+                name += "()"
+            target = None
+            if call.link is not None:
+                target = self._keys.get(id(call.link))
+            result.append((name, target, call))
+        return result
+
+
+def _diff_label(key):
+    ''' return the label of a unit key for :class:`AnalysisDiff` '''
+    if key is None:
+        return None
+    kind, module, name, occurrence = key
+    label = name if module is None else module + "." + name
+    if kind != "subroutine":
+        label += " ({0})".format(kind)
+    if occurrence:
+        label += " #{0}".format(occurrence + 1)
+    return label
+
+
+class Profile(object):
+    ''' Runtime profile data read from the text output of a profiler: the
+        exclusive (self) time, and where the profiler gives them the
+        inclusive time and number of calls, of each routine, and the time
+        and number of calls along each caller to callee edge. Each reader
+        makes a single pass over its input a line at a time, so large
+        profiles are not held in memory. Several profiles can be read into
+        the same object, in which case their values are added together.
+
+        For example:
+
+        >>> profile = Profile()
+        >>> profile.read_gprof("gprof.txt")
+        >>> overlay = ProfileOverlay(link, profile)
+
+    '''
+
+    # the (lower-cased) CSV column names accepted for each value
+    _CSV_COLUMNS = {
+        "name": ["name", "routine", "function", "subroutine", "symbol"],
+        "self": ["self", "exclusive", "excl", "self time", "self_time",
+                 "exclusive time", "exclusive_time"],
+        "total": ["total", "inclusive", "incl", "total time", "total_time",
+                  "inclusive time", "inclusive_time"],
+        "calls": ["calls", "count", "ncalls", "n_calls"]}
+
+    # "%time cumulative self [calls self/call total/call] name"
+    _GPROF_FLAT = re.compile(
+        r"^\s*[\d.]+\s+[\d.]+\s+([\d.]+)\s+(?:(\d+)\s+[\d.]+\s+[\d.]+\s+)?"
+        r"(\S.*?)\s*$")
+    # "[index] %time self children [called] name [index]"
+    _GPROF_PRIMARY = re.compile(
+        r"^\[\d+\]\s+[\d.]+\s+([\d.]+)\s+([\d.]+)\s+(?:([\d+]+)\s+)?"
+        r"(\S.*?)\s+\[\d+\]\s*$")
+    # "self children called[/total] name [index]"
+    _GPROF_CALLEE = re.compile(
+        r"^\s+([\d.]+)\s+([\d.]+)\s+(\d+)(?:/\d+)?\s+(\S.*?)\s+\[\d+\]\s*$")
+    # "[children%] self% command object [.] symbol"
+    _PERF = re.compile(
+        r"^\s*([\d.]+)%\s+(?:([\d.]+)%\s+)?.*?\[[.kgHu]\]\s+(\S+)")
+
+    def __init__(self):
+        # routine name -> exclusive time, inclusive time and calls
+        self._self = {}
+        self._total = {}
+        self._calls = {}
+        # (caller name, callee name) -> [time, calls]
+        self._edges = {}
+        self._unit = "s"
+
+    @property
+    def unit(self):
+        ''' the unit of the times: "s" for seconds or "%" for a percentage
+            of the samples (as given by perf) '''
+        return self._unit
+
+    @property
+    def routines(self):
+        ''' the names of the routines in the profile '''
+        return sorted(set(self._self) | set(self._total))
+
+    def exclusive(self, name):
+        return self._self.get(name, 0.0)
+
+    def inclusive(self, name):
+        ''' return the inclusive time of the routine, or None if the
+            profiler did not give it '''
+        return self._total.get(name)
+
+    def calls(self, name):
+        ''' return the number of calls of the routine, or None if the
+            profiler did not give it '''
+        return self._calls.get(name)
+
+    @property
+    def edges(self):
+        ''' a map from (caller name, callee name) to [time, calls], where
+            time is the time spent in the callee (and its callees) on
+            behalf of the caller '''
+        return self._edges
+
+    def _add(self, name, self_time=None, total=None, calls=None):
+        if self_time is not None:
+            self._self[name] = self._self.get(name, 0.0) + self_time
+        if total is not None:
+            self._total[name] = self._total.get(name, 0.0) + total
+        if calls is not None:
+            self._calls[name] = self._calls.get(name, 0) + calls
+
+    def read_gprof(self, source):
+        ''' Read the flat profile and/or call graph written by gprof from
+            source (a path or a file-like object). The exclusive times and
+            calls are taken from the flat profile if there is one and the
+            inclusive times and edges from the call graph. Cycles as a
+            whole and <spontaneous> callers are skipped. '''
+        stream, close = _open_source(source)
+        try:
+            section = None
+            in_flat = set()
+            caller = None
+            for line in stream:
+                heading = line.strip()
+                if heading.startswith("Flat profile"):
+                    section = "flat"
+                elif heading.startswith("Call graph"):
+                    section = "graph"
+                elif heading.startswith("Index by function name"):
+                    section = None
+                elif section == "flat":
+                    match = self._GPROF_FLAT.match(line)
+                    if match:
+                        name = _gprof_name(match.group(3))
+                        calls = match.group(2)
+                        if calls is not None:
+                            calls = int(calls)
+                        self._add(name, float(match.group(1)), None, calls)
+                        in_flat.add(name)
+                elif section == "graph":
+                    if line.startswith("---"):
+                        caller = None
+                        continue
+                    match = self._GPROF_PRIMARY.match(line)
+                    if match:
+                        caller = None
+                        if "as a whole" in match.group(4):
+                            continue
+                        caller = _gprof_name(match.group(4))
+                        self_time = float(match.group(1))
+                        total = self_time + float(match.group(2))
+                        if caller in in_flat:
+                            self._add(caller, total=total)
+                            continue
+                        calls = match.group(3)
+                        if calls is not None:
+                            # recursive calls are given as "n+m"
+                            calls = sum(int(part) for part in
+                                        calls.split("+") if part)
+                        self._add(caller, self_time, total, calls)
+                        continue
+                    if caller is None:
+                        continue
+                    match = self._GPROF_CALLEE.match(line)
+                    if match:
+                        callee = _gprof_name(match.group(4))
+                        edge = self._edges.setdefault((caller, callee),
+                                                      [0.0, 0])
+                        edge[0] += float(match.group(1)) + \
+                            float(match.group(2))
+                        edge[1] += int(match.group(3))
+        finally:
+            if close:
+                stream.close()
+
+    def read_perf(self, source):
+        ''' Read the output of "perf report --stdio" from source (a path or
+            a file-like object). The times are percentages of the samples.
+            If perf was run with --children the first percentage is taken
+            as the inclusive time. perf gives no call counts or edges. '''
+        stream, close = _open_source(source)
+        try:
+            self._unit = "%"
+            for line in stream:
+                if line.startswith("#"):
+                    continue
+                match = self._PERF.match(line)
+                if match is None:
+                    continue
+                if match.group(2) is None:
+                    self._add(match.group(3), float(match.group(1)))
+                else:
+                    self._add(match.group(3), float(match.group(2)),
+                              float(match.group(1)))
+        finally:
+            if close:
+                stream.close()
+
+    def read_csv(self, source):
+        ''' Read a CSV timing dump from source (a path or a file-like
+            object), as written by many timing libraries and by profilers
+            such as TAU. The first row must name the columns: a name column
+            (name, routine, function, subroutine or symbol) and at least
+            one of an exclusive time (self or exclusive), inclusive time
+            (total or inclusive) or calls (calls or count) column. Times
+            are in seconds. '''
+        import csv
+        stream, close = _open_source(source)
+        try:
+            rows = csv.reader(stream)
+            header = next(rows, None)
+            if header is None:
+                return
+            header = [column.strip().lower() for column in header]
+            columns = {}
+            for value, names in self._CSV_COLUMNS.items():
+                for idx, column in enumerate(header):
+                    if column in names:
+                        columns[value] = idx
+                        break
+            if "name" not in columns or len(columns) < 2:
+                raise RuntimeError(
+                    "the CSV profile needs a name column and a time or calls "
+                    "column but found '{0}'".format(",".join(header)))
+
+            def number(row, value, kind):
+                idx = columns.get(value)
+                if idx is None or idx >= len(row) or not row[idx].strip():
+                    return None
+                return kind(row[idx])
+
+            for row in rows:
+                if len(row) <= columns["name"]:
+                    continue
+                self._add(row[columns["name"]].strip(),
+                          number(row, "self", float),
+                          number(row, "total", float),
+                          number(row, "calls", int))
+        finally:
+            if close:
+                stream.close()
+
+
+def _open_source(source):
+    ''' return (stream, whether to close it) for a path or a file-like
+        object '''
+    if isinstance(source, basestring):
+        return open(source, "rU"), True
+    return source, False
+
+
+def _gprof_name(name):
+    ''' remove any cycle annotation from a gprof routine name '''
+    return re.sub(r"\s*<cycle \d+>", "", name).strip()
+
+
+_GFORTRAN_SYMBOL = re.compile(r"^__(\w+?)_MOD_(\w+)$")
+_IFORT_SYMBOL = re.compile(r"^(\w+?)_mp_(\w+?)_$")
+
+
+def _fortran_symbol(symbol):
+    ''' Return (module, name) for the compiler symbol of a Fortran
+        procedure, lower-cased, where module is None if the symbol names
+        no module. The gfortran ("__m_MOD_s") and Intel ("m_mp_s_") module
+        procedure conventions are recognised. Any trailing underscores
+        added to procedures outside modules are left for the caller to
+        try removing. '''
+    symbol = symbol.split("@")[0].strip()
+    match = _GFORTRAN_SYMBOL.match(symbol)
+    if match is None:
+        match = _IFORT_SYMBOL.match(symbol)
+    if match is not None:
+        return match.group(1).lower(), match.group(2).lower()
+    return None, symbol.lower()
+
+
+class ProfileOverlay(object):
+    ''' A :class:`Profile` mapped onto a linked call graph. Each profiled
+        routine is matched to a program unit through the :class:`Link`
+        symbol table once the compiler's name mangling is removed, and the
+        inclusive time of every unit and the time along every call edge
+        are then computed.
+
+        Exclusive times come from the profile. The inclusive time of a
+        unit is taken from the profile if it gives one and is otherwise
+        the unit's exclusive time plus the time along its call edges. The
+        time along an edge is taken from the profile's call graph if it
+        has edges into the callee and otherwise the callee's inclusive
+        time is shared between its callers by their number of call sites.
+        Units are visited callees first, one strongly connected component
+        at a time, and edges within a (recursive) component carry no time.
+
+        For example:
+
+        >>> overlay = ProfileOverlay(link, profile)
+        >>> overlay.report()
+        >>> with open("heat.dot", "w") as dot_file:
+        ...     overlay.dot(dot_file)
+
+    :param link: the Link used to transform the profiled code.
+    :type link: :class:`Link`
+    :param profile: the profile to map.
+    :type profile: :class:`Profile`
+    '''
+
+    def __init__(self, link, profile):
+        graph = link.graph
+        self._graph = graph
+        self._profile = profile
+        n_nodes = len(graph)
+        self._exclusive = array("d", [0.0] * n_nodes)
+        self._inclusive = array("d", [0.0] * n_nodes)
+        self._calls = {}
+        measured = array("b", [0] * n_nodes)
+        # routine name -> node id of each mapped routine
+        self._mapped = {}
+        self._unmapped = []
+        self._unmapped_time = 0.0
+        for routine in profile.routines:
+            node = self._map(routine, link.symbol_table)
+            if node is None:
+                self._unmapped.append(routine)
+                self._unmapped_time += profile.exclusive(routine)
+                continue
+            self._mapped[routine] = node
+            self._exclusive[node] += profile.exclusive(routine)
+            if profile.inclusive(routine) is not None:
+                self._inclusive[node] += profile.inclusive(routine)
+                measured[node] = 1
+            if profile.calls(routine) is not None:
+                self._calls[node] = self._calls.get(node, 0) + \
+                    profile.calls(routine)
+
+        # the measured time along each edge between mapped routines
+        self._measured_edges = {}
+        for (caller, callee), (time, _) in profile.edges.items():
+            key = (self._mapped.get(caller), self._mapped.get(callee))
+            if None not in key:
+                self._measured_edges[key] = \
+                    self._measured_edges.get(key, 0.0) + time
+        self._has_measured_edges = set(
+            callee for _, callee in self._measured_edges)
+
+        # the call sites into each node from outside its component
+        components = graph.strongly_connected_components()
+        self._component = array("l", [0] * n_nodes)
+        for idx, component in enumerate(components):
+            for node in component:
+                self._component[node] = idx
+        self._in_sites = array("l", [0] * n_nodes)
+        self._sites = {}
+        for caller, callee, sites in graph.edges():
+            if self._component[caller] != self._component[callee]:
+                self._in_sites[callee] += sites
+                self._sites[(caller, callee)] = sites
+
+        # the components are in reverse topological order, callees first
+        self._edge_times = {}
+        for component in components:
+            for node in component:
+                inclusive = self._exclusive[node]
+                for callee in graph.successors(node):
+                    if (node, callee) in self._sites:
+                        inclusive += self._edge_time(node, callee)
+                if not measured[node]:
+                    self._inclusive[node] = inclusive
+
+    def _map(self, routine, symbol_table):
+        ''' return the node id of the unit for a profiled routine, or None
+            if there is not exactly one matching unit '''
+        module, name = _fortran_symbol(routine)
+        if module is None and name == "main__":
+            # the gfortran main program
+            programs = [node for node in range(len(self._graph)) if
+                        self._graph.subroutine(node).kind == "program"]
+            if len(programs) == 1:
+                return programs[0]
+            return None
+        # try the name as it is, then without the underscores that
+        # compilers add to procedures outside modules
+        candidates = [name]
+        if module is None:
+            candidates.extend(name[:-idx] for idx in [1, 2]
+                              if name.endswith("_" * idx) and len(name) > idx)
+        for candidate in candidates:
+            definitions = symbol_table.definitions(candidate)
+            if module is not None:
+                definitions = [subroutine for subroutine in definitions if
+                               subroutine.module is not None and
+                               subroutine.module.lower() == module]
+            if len(definitions) == 1:
+                return self._graph.node_id(definitions[0])
+            if definitions:
+                return None
+        return None
+
+    def _edge_time(self, caller, callee):
+        ''' compute and record the time along an edge between components '''
+        if callee in self._has_measured_edges:
+            time = self._measured_edges.get((caller, callee), 0.0)
+        else:
+            time = self._inclusive[callee] * self._sites[(caller, callee)] / \
+                float(self._in_sites[callee])
+        self._edge_times[(caller, callee)] = time
+        return time
+
+    @property
+    def unmapped(self):
+        ''' the profiled routines that could not be matched to a single
+            unit (system and library routines, for example) '''
+        return list(self._unmapped)
+
+    @property
+    def unmapped_time(self):
+        ''' the exclusive time of the unmapped routines '''
+        return self._unmapped_time
+
+    @property
+    def total_time(self):
+        ''' the total exclusive time in the profile '''
+        return sum(self._exclusive) + self._unmapped_time
+
+    def exclusive(self, subroutine):
+        return self._exclusive[self._graph.node_id(subroutine)]
+
+    def inclusive(self, subroutine):
+        return self._inclusive[self._graph.node_id(subroutine)]
+
+    def calls(self, subroutine):
+        ''' return the number of calls of the subroutine, or None if the
+            profile does not give it '''
+        return self._calls.get(self._graph.node_id(subroutine))
+
+    def edge_time(self, caller, callee):
+        ''' return the time spent in callee on behalf of caller '''
+        return self._edge_times.get((self._graph.node_id(caller),
+                                     self._graph.node_id(callee)), 0.0)
+
+    def ranked(self, top=10, inclusive=False):
+        ''' return (subroutine, time) for the top units by exclusive (or
+            inclusive) time '''
+        times = self._inclusive if inclusive else self._exclusive
+        nodes = sorted((node for node in range(len(times)) if times[node]),
+                       key=lambda node: (-times[node], node))[:top]
+        return [(self._graph.subroutine(node), times[node])
+                for node in nodes]
+
+    def hot_path(self, root=None):
+        ''' Return the hot path as a list of (subroutine, inclusive time)
+            tuples. The path starts at root (a name or a Subroutine), by
+            default the unit with the most inclusive time, and follows the
+            call edge that carries the most time from each unit until
+            there is none. '''
+        graph = self._graph
+        if root is None:
+            if not len(graph):
+                return []
+            nodes = range(len(graph))
+        elif isinstance(root, basestring):
+            nodes = graph.node_ids(root)
+        else:
+            nodes = [graph.node_id(root)]
+        node = max(nodes, key=self._inclusive.__getitem__)
+        path = [(graph.subroutine(node), self._inclusive[node])]
+        visited = set([node])
+        while True:
+            best = None
+            best_time = 0.0
+            for callee in graph.successors(node):
+                time = self._edge_times.get((node, callee), 0.0)
+                if callee not in visited and time > best_time:
+                    best, best_time = callee, time
+            if best is None:
+                return path
+            node = best
+            visited.add(node)
+            path.append((graph.subroutine(node), self._inclusive[node]))
+
+    def report(self, top=10, stream=None):
+        ''' write the top units by exclusive and by inclusive time and the
+            hot path to stream (stdout by default) '''
+        if stream is None:
+            import sys
+            stream = sys.stdout
+        unit = self._profile.unit
+        total = self.total_time or 1.0
+        lines = [
+            "Profile overlay ...\n",
+            "    total time              {0:.6g}{1}\n".format(
+                self.total_time, unit),
+            "    mapped routines         {0}\n".format(len(self._mapped)),
+            "    unmapped routines       {0} ({1:.6g}{2})\n".format(
+                len(self._unmapped), self._unmapped_time, unit)]
+        for title, inclusive in [("exclusive", False), ("inclusive", True)]:
+            lines.append("  top {0} by {1} time ...\n".format(top, title))
+            for subroutine, time in self.ranked(top, inclusive):
+                lines.append("    {0:>12.6g}{1} {2:6.1f}%  {3}\n".format(
+                    time, unit, 100.0 * time / total,
+                    _qualified_name(subroutine)))
+        lines.append("  hot path ...\n")
+        for depth, (subroutine, time) in enumerate(self.hot_path()):
+            lines.append("    {0:>12.6g}{1} {2:6.1f}%  {3}{4}\n".format(
+                time, unit, 100.0 * time / total, "  " * depth,
+                _qualified_name(subroutine)))
+        stream.write("".join(lines))
+
+    def dot(self, stream=None, threshold=0.01):
+        ''' Write the call graph in the dot graph format to stream (stdout
+            by default) with each unit coloured from blue (cold) to red
+            (hot) by its inclusive time and each edge labelled with, and
+            drawn as wide as, the time along it. Units with less than
+            threshold of the total time are left out. '''
+        if stream is None:
+            import sys
+            stream = sys.stdout
+        graph = self._graph
+        unit = self._profile.unit
+        total = self.total_time or 1.0
+        nodes = [node for node in range(len(graph)) if
+                 self._inclusive[node] > 0.0 and
+                 self._inclusive[node] >= threshold * total]
+        members = set(nodes)
+        lines = ["digraph G {\n", "node [style=filled];\n"]
+        for node in nodes:
+            fraction = min(self._inclusive[node] / total, 1.0)
+            lines.append(
+                "{0} [label=\"{1}\\n{2:.3g}{3} ({4:.1f}%)\\nself {5:.3g}{3}\""
+                ", fillcolor=\"{6:.3f} 0.600 1.000\"];\n".format(
+                    node, _qualified_name(graph.subroutine(node)),
+                    self._inclusive[node], unit, 100.0 * fraction,
+                    self._exclusive[node], 0.667 * (1.0 - fraction)))
+        for (caller, callee), time in sorted(self._edge_times.items()):
+            if caller in members and callee in members and time > 0.0:
+                lines.append(
+                    "{0} -> {1} [label=\"{2:.3g}{3}\", penwidth={4:.2f}];\n"
+                    "".format(caller, callee, time, unit,
+                              1.0 + 4.0 * min(time / total, 1.0)))
+        lines.append("}\n")
+        stream.write("".join(lines))
+
+
+def _qualified_name(subroutine):
+    ''' return the name of a unit, qualified by its module if it has one '''
+    if subroutine.module is None:
+        return subroutine.name
+    return subroutine.module + "." + subroutine.name
+
+
+class StatementTypes(object):
+    ''' A table, built once, that gives each fparser statement type an
+        integer index and a category. Statements are then counted by
+        incrementing integer arrays rather than by inspecting the names of
+        their types. The indices only depend on the installed fparser, so
+        counts made in different processes (or stored in the parse cache)
+        can be combined. Use :func:`statement_types` to get the table. '''
+
+    COMMENT, DECLARATION, CODE, OTHER = range(4)
+    CATEGORY_NAMES = ["comments", "declarations", "code statements", "other"]
+
+    def __init__(self):
+        import inspect
+        from fparser import base_classes, statements, typedecl_statements, \
+            block_statements, readfortran
+        types = []
+        for module in [base_classes, block_statements, statements,
+                       typedecl_statements]:
+            for obj in vars(module).values():
+                if inspect.isclass(obj) and obj.__module__ == \
+                   module.__name__ and issubclass(obj, base_classes.Statement):
+                    types.append(obj)
+        # lines that fparser could not match are left in the ast as is
+        types.append(readfortran.Line)
+        types.sort(key=lambda obj: (obj.__module__, obj.__name__))
+        self._index = {}
+        self._names = []
+        self._categories = array("b")
+        for idx, type_statement in enumerate(types):
+            self._index[type_statement] = idx
+            self._names.append(type_statement.__name__)
+            self._categories.append(self._category(type_statement))
+        # any other type
+        self._other = len(types)
+        self._names.append("Other")
+        self._categories.append(self.OTHER)
+
+    def _category(self, type_statement):
+        from fparser import statements
+        module = type_statement.__module__
+        if type_statement is statements.Comment:
+            return self.COMMENT
+        if module == "fparser.typedecl_statements":
+            return self.DECLARATION
+        if module in ["fparser.statements", "fparser.block_statements"]:
+            return self.CODE
+        return self.OTHER
+
+    def __len__(self):
+        return len(self._names)
+
+    def index(self, type_statement):
+        ''' return the index of type_statement '''
+        return self._index.get(type_statement, self._other)
+
+    @property
+    def index_map(self):
+        ''' the map from type to index (for use in inner loops) '''
+        return self._index
+
+    @property
+    def other_index(self):
+        ''' the index used for any type not in the table '''
+        return self._other
+
+    @property
+    def names(self):
+        ''' the class name for each index '''
+        return self._names
+
+    @property
+    def categories(self):
+        ''' the category for each index '''
+        return self._categories
+
+    def new_counts(self):
+        ''' return a zeroed array for counting statements by index '''
+        return array("l", [0]) * len(self._names)
+
+
+_STATEMENT_TYPES = None
+
+
+def statement_types():
+    ''' return the (shared) :class:`StatementTypes` table '''
+    global _STATEMENT_TYPES
+    if _STATEMENT_TYPES is None:
+        _STATEMENT_TYPES = StatementTypes()
+    return _STATEMENT_TYPES
+
+
+def _new_category_counts():
+    ''' return a zeroed array for counting statements by category '''
+    return array("l", [0]) * len(StatementTypes.CATEGORY_NAMES)
+
+
+class Stats(CodeAnalysisOperator):
+    ''' Statistics about the code. The statement counts come from the
+        analysis of each file so no further walk of the ast is needed.
+        As well as the totals reported by :func:`info`, per-file,
+        per-module and per-subroutine breakdowns are available from
+        :func:`breakdown`. '''
+
+    # the fields of each breakdown row
+    BREAKDOWN_FIELDS = ["name", "lines", "comments", "declarations",
+                        "code statements", "calls"]
+
+    def __init__(self):
+        self._n_files_ok = 0
+        self._n_files_empty = 0
+        self._n_files_failed = 0
+        self._n_modules = 0
+        self._n_modules_no_subroutines = 0
+        self._n_subroutines_outside_modules = 0
+        self._n_subroutines_in_modules = 0
+        self._n_functions = 0
+        self._n_programs = 0
+        self._n_block_data = 0
+        self._n_statements = 0
+        self._statement_counts = None
+        self._applied = False
+        self._n_comments = 0
+        self._n_type_decls = 0
+        self._n_code_statements = 0
+        self._breakdown = {"file": [], "module": [], "subroutine": []}
+
+    @property
+    def name(self):
+        return "Statistics"
+
+    @property
+    def description(self):
+        return "Statistics about the code"
+
+    def apply(self, files, quiet=False):
+        ''' determine stats about the code. Progress is printed unless
+            quiet is set. '''
+
+        import sys
+        if not quiet:
+            print "Creating stats:",
+            sys.stdout.flush()
+        types = statement_types()
+        categories = types.categories
+        if self._statement_counts is None:
+            self._statement_counts = types.new_counts()
+        totals = self._statement_counts
+        for my_file in files:
+            if not my_file.parsed_ok:
+                self._n_files_failed += 1
+            else:
+                self._n_files_ok += 1
+                if my_file.is_empty:
+                    self._n_files_empty += 1
+                else:
+                    self._n_modules += len(my_file.modules)
+                    self._n_subroutines_outside_modules \
+                        += self._count_units(my_file.subroutines)
+                    for my_module in my_file.modules:
+                        n_subroutines = self._count_units(
+                            my_module.subroutines)
+                        if n_subroutines == 0:
+                            self._n_modules_no_subroutines += 1
                         else:
-                            self._statement_count_bin[type_statement] += 1
-                        if "fparser.statements.Comment" in str(type_statement):
-                            self._n_comments += 1
-                        elif "fparser.typedecl_statements." in \
-                             str(type_statement):
-                            self._n_type_decls += 1
-                        elif "fparser.statements." in str(type_statement) \
-                             or "fparser.block_statements." in \
-                             str(type_statement):
-                            self._n_code_statements += 1
+                            self._n_subroutines_in_modules += n_subroutines
+
+                    # use the statement counts of the current file
+                    file_categories = _new_category_counts()
+                    for idx, count in enumerate(my_file.statement_counts):
+                        if count:
+                            totals[idx] += count
+                            file_categories[categories[idx]] += count
+                    self._add_breakdown(my_file, file_categories)
+        self._n_statements = sum(totals)
+        category_totals = _new_category_counts()
+        for idx, count in enumerate(totals):
+            category_totals[categories[idx]] += count
+        self._n_comments = category_totals[StatementTypes.COMMENT]
+        self._n_type_decls = category_totals[StatementTypes.DECLARATION]
+        self._n_code_statements = category_totals[StatementTypes.CODE]
         self._applied = True
-        print "done"
-        sys.stdout.flush()
+        if not quiet:
+            print "done"
+            sys.stdout.flush()
+
+    def _count_units(self, units):
+        ''' count the functions, programs and block data in units and
+            return the number of subroutines '''
+        n_subroutines = 0
+        for unit in units:
+            if unit.kind == "subroutine":
+                n_subroutines += 1
+            elif unit.kind == "function":
+                self._n_functions += 1
+            elif unit.kind == "program":
+                self._n_programs += 1
+            else:
+                self._n_block_data += 1
+        return n_subroutines
+
+    def _add_breakdown(self, my_file, file_categories):
+        ''' add the breakdown rows for a file and its contents '''
+        n_file_calls = 0
+        for subroutine in my_file.all_subroutines:
+            n_calls = _n_call_sites(subroutine)
+            n_file_calls += n_calls
+            self._breakdown["subroutine"].append(
+                self._row(subroutine.name, subroutine, n_calls))
+        for module in my_file.modules:
+            n_calls = sum(_n_call_sites(subroutine)
+                          for subroutine in module.subroutines)
+            self._breakdown["module"].append(
+                self._row(module.name, module, n_calls))
+        self._breakdown["file"].append(
+            (my_file.path, my_file.n_lines,
+             file_categories[StatementTypes.COMMENT],
+             file_categories[StatementTypes.DECLARATION],
+             file_categories[StatementTypes.CODE], n_file_calls))
+
+    @staticmethod
+    def _row(name, unit, n_calls):
+        counts = unit.category_counts
+        return (name, unit.end_line - unit.start_line + 1,
+                counts[StatementTypes.COMMENT],
+                counts[StatementTypes.DECLARATION],
+                counts[StatementTypes.CODE], n_calls)
+
+    def breakdown(self, level="file"):
+        ''' Return a list of rows, one per file, module or subroutine
+            depending on level. Each row is a tuple with the fields given
+            by BREAKDOWN_FIELDS. The subroutine level also has a row for
+            each function, main program and block data. Statements are
+            counted in the innermost unit that contains them, but a module
+            counts all of the statements it contains.
+
+        :param level: "file", "module" or "subroutine".
+        :type level: str.
+        '''
+        if not self._applied:
+            raise RuntimeError("method apply must be called first")
+        if level not in self._breakdown:
+            raise RuntimeError("unknown breakdown level '{0}'".format(level))
+        return self._breakdown[level]
+
+    def summary(self):
+        ''' return a map holding the totals that :func:`info` prints '''
+        if not self._applied:
+            raise RuntimeError("method apply must be called first")
+        return {"files": self._n_files_ok + self._n_files_failed,
+                "files successfully parsed":
+                self._n_files_ok - self._n_files_empty,
+                "files failed to parse": self._n_files_failed,
+                "files that are empty": self._n_files_empty,
+                "modules": self._n_modules,
+                "modules without subroutines":
+                self._n_modules_no_subroutines,
+                "subroutines outside modules":
+                self._n_subroutines_outside_modules,
+                "subroutines inside modules": self._n_subroutines_in_modules,
+                "functions": self._n_functions,
+                "programs": self._n_programs,
+                "block data": self._n_block_data,
+                "statements": self._n_statements,
+                "comments": self._n_comments,
+                "declarations": self._n_type_decls,
+                "code statements": self._n_code_statements}
 
     @property
     def info(self):
         if not self._applied:
-            raise RuntimeError("method info must be called first")
+            raise RuntimeError("method apply must be called first")
 
         print "Total number of ..."
         print "    files                       {0}".\
@@ -337,7 +4653,8 @@ class Stats(CodeAnalysisOperator):
             format(self._n_files_failed)
         print "    files that are empty        {0}".format(self._n_files_empty)
         print ""
-        # TBD print "    programs              {0}".format(0)
+        print "    programs                    {0}".format(self._n_programs)
+        print "    block data                  {0}".format(self._n_block_data)
         print "    modules                     {0}".format(self._n_modules)
         print "    modules with subroutines    {0}".\
             format(self._n_modules-self._n_modules_no_subroutines)
@@ -351,6 +4668,7 @@ class Stats(CodeAnalysisOperator):
             format(self._n_subroutines_outside_modules)
         print "    subroutines inside modules  {0}".\
             format(self._n_subroutines_in_modules)
+        print "    functions                   {0}".format(self._n_functions)
         print ""
         print "    statements                  {0}".format(self._n_statements)
         print "    comments                    {0}".format(self._n_comments)
@@ -359,12 +4677,158 @@ class Stats(CodeAnalysisOperator):
             format(self._n_code_statements)
         print ""
         print "   ",
-        for statement in sorted(self._statement_count_bin,
-                                key=self._statement_count_bin.__getitem__,
-                                reverse=True):
-            print str(statement).split("'")[1].split(".")[2], \
-                self._statement_count_bin[statement],
+        names = statement_types().names
+        counts = self._statement_counts
+        for idx in sorted([idx for idx in range(len(counts)) if counts[idx]],
+                          key=counts.__getitem__, reverse=True):
+            print names[idx], counts[idx],
+        print ""
+
+
+class LoopNests(CodeAnalysisOperator):
+    ''' The DO loop nests in the code and a ranking of the nests that are
+        candidates for OpenMP parallelisation or vectorisation. A candidate
+        is a counted loop nest that makes no calls and has no OpenMP or
+        OpenACC directives, and that is not inside a loop with directives.
+        The calls are the CALL statements and the references that the
+        :class:`Link` matched to a function, so the files should be linked
+        first. Any other subscripted name is taken to be an array (from a
+        USEd module, for example). Candidates are ranked by nest depth,
+        then by whether the nest is perfect and then by the number of
+        statements in it. Loops are found when a file is analysed, so files
+        that have been scanned or loaded from an :class:`AnalysisDatabase`
+        have none.
+
+        For example:
+
+        >>> link.transform(files)
+        >>> nests = LoopNests()
+        >>> nests.apply(files)
+        >>> nests.info(top=20)
+
+    '''
+
+    # the fields of each report row
+    REPORT_FIELDS = ["path", "unit", "start line", "end line", "depth",
+                     "perfect", "statements", "variables", "arrays"]
+
+    def __init__(self):
+        # (file path, unit, outermost loop) for each nest
+        self._nests = []
+        self._applied = False
+
+    @property
+    def name(self):
+        return "Loop nests"
+
+    @property
+    def description(self):
+        return "DO loop nests and parallelisation candidates"
+
+    def apply(self, files):
+        ''' find the loop nests in the code '''
+        for my_file in files:
+            if not my_file.parsed_ok:
+                continue
+            for unit in my_file.all_subroutines:
+                for loop in unit.loops:
+                    self._nests.append((my_file.path, unit, loop))
+        self._applied = True
+
+    @property
+    def nests(self):
+        ''' (file path, unit, outermost loop) for each loop nest '''
+        if not self._applied:
+            raise RuntimeError("method apply must be called first")
+        return self._nests
+
+    @staticmethod
+    def _functions(unit):
+        ''' the lower-cased names referenced by unit that are linked to a
+            function '''
+        return set(call.name.lower() for call in unit.calls
+                   if call.is_reference and call.link is not None)
+
+    def calls(self, unit, loop):
+        ''' return the lower-cased names of the subroutines called and the
+            functions referenced in loop (and the loops in it) in unit '''
+        functions = self._functions(unit)
+        return sorted(set(loop.calls) | set(
+            name for name in loop.references if name in functions))
+
+    def arrays(self, unit, loop):
+        ''' return the lower-cased names of the arrays subscripted in loop
+            (and the loops in it) in unit '''
+        functions = self._functions(unit)
+        return sorted(set(loop.arrays) | set(
+            name for name in loop.references if name not in functions))
+
+    def candidates(self, min_depth=1):
+        ''' Return (file path, unit, loop) for each candidate nest with at
+            least min_depth levels, best first. A nest that is not a
+            candidate itself may contain one. '''
+        found = []
+        for file_path, unit, nest in self.nests:
+            loops = [nest]
+            while loops:
+                loop = loops.pop()
+                if loop._directives:
+                    # the loops inside are covered by the directives
+                    continue
+                if loop.is_counted and not self.calls(unit, loop) and \
+                   not loop.directives:
+                    if loop.nest_depth >= min_depth:
+                        found.append((file_path, unit, loop))
+                else:
+                    loops.extend(loop.loops)
+        found.sort(key=lambda candidate: (
+            -candidate[2].nest_depth, not candidate[2].is_perfect,
+            -candidate[2].n_statements, candidate[0],
+            candidate[2].start_line))
+        return found
+
+    def report(self, min_depth=1):
+        ''' return a row for each candidate nest, best first, with the
+            fields given by REPORT_FIELDS '''
+        rows = []
+        for file_path, unit, loop in self.candidates(min_depth):
+            rows.append((file_path, _qualified_name(unit), loop.start_line,
+                         loop.end_line, loop.nest_depth, loop.is_perfect,
+                         loop.n_statements,
+                         [inner.variable for inner in loop.walk()
+                          if inner.variable is not None],
+                         self.arrays(unit, loop)))
+        return rows
+
+    def info(self, top=20, min_depth=1):
+        ''' print a summary of the loop nests and the top candidates '''
+        loops = [loop for _, _, nest in self.nests for loop in nest.walk()]
+        candidates = self.candidates(min_depth)
+        print "Loop nest information ..."
+        print "    loops                       {0}".format(len(loops))
+        print "    loop nests                  {0}".format(len(self._nests))
+        print "    deepest nest                {0}".format(
+            max([nest.nest_depth for _, _, nest in self._nests] or [0]))
+        print "    nests with calls            {0}".format(
+            len([nest for _, unit, nest in self._nests
+                 if self.calls(unit, nest)]))
+        print "    nests with directives       {0}".format(
+            len([nest for _, _, nest in self._nests if nest.directives]))
+        print "    candidate nests             {0}".format(len(candidates))
         print ""
+        for row in self.report(min_depth)[:top]:
+            print "    {0}:{1}-{2} {3}".format(row[0], row[2], row[3], row[1])
+            print "        depth {0}{1}, {2} statements, arrays: {3}".format(
+                row[4], " (perfect)" if row[5] else "", row[6],
+                " ".join(row[8]))
+
+
+def _n_call_sites(subroutine):
+    ''' return the number of CALL sites in subroutine and, if it has been
+        linked, of references to functions. References that are not linked
+        are array elements. '''
+    return sum(call.count for call in subroutine.calls
+               if not call.is_reference or call.link is not None)
 
 
 class File(object):
@@ -374,14 +4838,45 @@ class File(object):
         self._modules = []  # a list of modules contained in this file
         self._subroutines = []  # a list of subroutines contained in this file
         self._ast = None
+        self._path = None
         self._parsed = False
         self._parsed_ok = None
         self._is_empty = False
+        # the number of times each statement type occurs, indexed by
+        # the statement_types() table
+        self._statement_counts = None
+        self._n_lines = 0
+        # why the file could not be parsed, if it could not
+        self._failure = None
+        # whether the file was built by the Scanner rather than fparser
+        self._scanned = False
+        # the directives in a fixed form file, which fparser drops, kept
+        # from parse until analyse
+        self._fixed_form_directives = None
+
+    @property
+    def path(self):
+        return self._path
 
     @property
     def parsed(self):
         return self._parsed
 
+    @property
+    def failure(self):
+        ''' None if the file was parsed successfully (or has not been
+            parsed), otherwise the reason it failed: "error" if fparser
+            failed, "memory" if it ran out of memory, "timeout" if it took
+            too long or "killed" if the process parsing it died '''
+        return self._failure
+
+    @property
+    def scanned(self):
+        ''' whether this file was built by the :class:`Scanner` rather
+            than parsed by fparser. Scanned files have no statement
+            counts. '''
+        return self._scanned
+
     @property
     def is_empty(self):
         if not self._parsed:
@@ -406,36 +4901,91 @@ class File(object):
             raise RuntimeError("Error")
         return self._modules
 
-    def parse(self, file_path):
-        ''' parse the file provided using fparser '''
+    @property
+    def all_subroutines(self):
+        ''' the subroutines outside modules followed by the subroutines
+            inside each module '''
+        result = list(self.subroutines)
+        for module in self._modules:
+            result.extend(module.subroutines)
+        return result
+
+    @property
+    def statement_counts(self):
+        ''' an array holding the number of times each statement type
+            occurs in this file, indexed by the :func:`statement_types`
+            table '''
+        if not self._parsed:
+            raise RuntimeError("Error")
+        if self._statement_counts is None:
+            self._statement_counts = statement_types().new_counts()
+            if self._parsed_ok:
+                visitor = _AnalysisVisitor()
+                visitor.visit(self._ast)
+                self._statement_counts = visitor.statement_counts
+        return self._statement_counts
+
+    @property
+    def n_lines(self):
+        ''' the number of the last line holding a statement '''
+        return self._n_lines
+
+    def parse(self, file_path, source=None):
+        ''' Parse the file provided using fparser. If source is given it
+            is parsed from memory rather than read from file_path. '''
         self._parsed = True
+        self._path = file_path
         try:
+            import os
             import fparser
             from fparser import parsefortran
             from fparser import api as fpapi
             fparser.parsefortran.FortranParser.cache.clear()
-            self._ast = fpapi.parse(file_path, ignore_comments=False,
-                                    analyze=False)
+            if source is None:
+                with open(file_path, "r") as source_file:
+                    source = source_file.read()
+            # fparser treats a string that is not a file name as source
+            # but only works out its form from a file, so do that here. As
+            # for a file, INCLUDEs are looked for next to it first.
+            isfree, isstrict = _source_info(file_path, source)
+            self._ast = fpapi.parse(
+                source, isfree=isfree, isstrict=isstrict,
+                include_dirs=[os.path.dirname(file_path), "."],
+                ignore_comments=False, analyze=False)
             if self._ast is None:
                 ''' parser does not necessarily throw an error if it fails
                     to parse. Instead it may return an empty ast. '''
                 self._parsed_ok = False
+                self._failure = "error"
             else:
                 self._parsed_ok = True
-            return self._parsed_ok
         except KeyboardInterrupt:
             print "Control-C pressed, aborting"
             exit(1)
+        except MemoryError:
+            self._parsed_ok = False
+            self._failure = "memory"
+            return self._parsed_ok
         except:
             self._parsed_ok = False
+            self._failure = "error"
             return self._parsed_ok
+        # outside the try above so that a problem here is not taken for a
+        # failure to parse
+        if self._parsed_ok and not isfree:
+            self._find_fixed_form_directives(source)
+        return self._parsed_ok
+
+    def _find_fixed_form_directives(self, source):
+        ''' fparser drops the comments in fixed form source, so keep the
+            OpenMP and OpenACC directives of the fixed form source for
+            analyse '''
+        self._fixed_form_directives = _fixed_form_directives(
+            source.splitlines())
 
     def analyse(self):
         ''' Creates program, module function and/or subroutine objects as
             appropriate '''
-        import fparser
-        from fparser import api
-
         if not self._parsed:
             raise RuntimeError("Cannot analyse when you have not yet parsed")
         if not self._parsed_ok:
@@ -444,29 +4994,947 @@ class File(object):
         if len(self._ast.content) == 0:
             print "Analysis found nothing in the file."
             self._is_empty = True
+            self._statement_counts = statement_types().new_counts()
             return
 
-        for child, depth in api.walk(self._ast, -1):
-            if isinstance(child, fparser.block_statements.Program):
-                pass
-                #print "  FOUND MAIN PROGRAM", child.name
-            if isinstance(child, fparser.block_statements.Module):
+        visitor = _AnalysisVisitor()
+        visitor.visit(self._ast)
+        self._modules = visitor.modules
+        self._subroutines = visitor.subroutines
+        self._statement_counts = visitor.statement_counts
+        if self._fixed_form_directives:
+            _add_directives(self.all_subroutines, self._fixed_form_directives)
+        self._fixed_form_directives = None
+        last = self._ast.content[-1]
+        # a comment's content is its text rather than a list of statements
+        if isinstance(getattr(last, "content", None), list):
+            self._n_lines = _line_span(last)[1]
+        else:
+            self._n_lines = getattr(last, "item", last).span[1]
+
+    def copy(self, file_path):
+        ''' Return a copy of the analysis of this file for an identical
+            file at file_path, so a source that is found in more than one
+            place only needs to be parsed once. The file is released (see
+            :func:`release`) first, and must not have been linked yet. '''
+        import cPickle as pickle
+        self.release()
+        my_file = pickle.loads(pickle.dumps(self, pickle.HIGHEST_PROTOCOL))
+        my_file._path = file_path
+        return my_file
+
+    def release(self):
+        ''' Drop all references to the fparser ast, keeping only the
+            analysed summary. This makes the file (and its modules,
+            subroutines and calls) small and picklable. '''
+        if self._parsed:
+            # make sure the statement counts are kept before the ast goes
+            self.statement_counts
+        self._ast = None
+        for module in self._modules:
+            module.release()
+        for subroutine in self._subroutines:
+            subroutine.release()
+
+
+# an fparser mode header such as "-*- fix -*-", which sets the form of a
+# file whatever its extension
+_MODE_HEADER = re.compile(r"-\*-\s*(fortran|f77|fix|f90|f95|f03|f08|pyf)"
+                          r"\s*-\*-", re.I)
+# the extensions that fparser takes to mean strict Fortran 77
+_FIXED_EXTENSIONS = [".for", ".ftn", ".f77", ".f"]
+
+
+def _source_info(file_path, source):
+    ''' Return (isfree, isstrict) for the source of file_path, as
+        fparser's sourceinfo.get_source_info does when it reads the file.
+        The public get_source_info_str gives the form of a string, but it
+        does not know the file name, so .pyf files, and files with a fixed
+        form extension and no mode header, are handled here. '''
+    import os
+    from fparser.sourceinfo import get_source_info_str
+    extension = os.path.splitext(file_path)[1]
+    if extension == ".pyf":
+        return True, True
+    first_line = source.split("\n", 1)[0]
+    if _MODE_HEADER.search(first_line):
+        return get_source_info_str(first_line)
+    if extension.lower() in _FIXED_EXTENSIONS:
+        return False, True
+    if not first_line.strip():
+        # get_source_info_str looks for a header on the first line that
+        # is not blank, but a file's header must be on its first line
+        source = "!" + source
+    return get_source_info_str(source)
+
+
+class _AnalysisVisitor(object):
+    ''' Builds the module, program unit and call hierarchy of an fparser
+        ast, and counts its statements, in a single pass over the ast. Each
+        statement is visited exactly once. Subroutines and functions are
+        added to the module they are contained in, or to self.subroutines
+        if they are not in a module, as are main programs and block data.
+        Subroutines and functions contained in other units are added
+        alongside their host. The units in interface blocks are not
+        definitions so are only counted. Calls and function references are
+        added to the innermost unit that contains them. The DO loops in each unit
+        are added to it as :class:`Loop` nests, along with the OpenMP and
+        OpenACC directives that precede or are inside them. '''
+
+    def __init__(self):
+        self.modules = []
+        self.subroutines = []
+        self._types = statement_types()
+        # the number of times each statement type occurs
+        self.statement_counts = self._types.new_counts()
+        # the call object for each (unit, called name, is reference)
+        self._calls = {}
+        # id(module or unit) -> the lower-cased names of the variables
+        # declared in it or visible from its host
+        self._declared = {}
+
+    def visit(self, ast, module=None, subroutine=None, references=True,
+              loop=None):
+        ''' visit all of the statements contained in ast (but not ast
+            itself), adding what is found to module, subroutine and loop if
+            they are supplied. Function references are only looked for if
+            references is True. '''
+        from fparser import block_statements, statements
+        from fparser.base_classes import BeginStatement
+        unit_classes = {block_statements.Subroutine: Subroutine,
+                        block_statements.Function: Function,
+                        block_statements.Program: Program,
+                        block_statements.BlockData: BlockData}
+        counts = self.statement_counts
+        index_map = self._types.index_map
+        other = self._types.other_index
+        categories = self._types.categories
+        # the directives found since the last statement
+        directives = []
+        for child in ast.content:
+            if isinstance(child, statements.Comment):
+                directive = _directive(child.content)
+                if directive is not None:
+                    directives.append(directive)
+            elif directives and not isinstance(child, block_statements.Do):
+                # a directive that is not on a loop belongs to the loop
+                # (if any) containing it
+                if loop is not None:
+                    loop._directives.extend(directives)
+                directives = []
+            idx = index_map.get(type(child), other)
+            counts[idx] += 1
+            category = categories[idx]
+            unit_class = unit_classes.get(type(child))
+            # a module counts everything it contains, whereas a unit only
+            # counts statements that are not in a contained unit
+            if module is not None:
+                module.category_counts[category] += 1
+            if subroutine is not None and unit_class is None:
+                subroutine.category_counts[category] += 1
+            scope = subroutine if subroutine is not None else module
+            interface = isinstance(child, block_statements.Interface)
+            if references and scope is not None and unit_class is None \
+               and not interface:
+                text = getattr(child.item, "line", None)
+                if text:
+                    self._add_references(child.item.span[0], text,
+                                         subroutine, scope, loop)
+            # the action of a logical IF is part of the IF statement
+            if loop is not None and references and not isinstance(
+                    child, (statements.Comment, block_statements.EndDo)):
+                loop._n_statements += 1
+            if isinstance(child, statements.Call):
+                if subroutine is not None:
+                    # one object per called name in each subroutine
+                    key = (id(subroutine), child.designator.lower(), False)
+                    my_call = self._calls.get(key)
+                    if my_call is None:
+                        my_call = Call()
+                        my_call.parse(child)
+                        my_call.analyse()
+                        my_call._caller = subroutine
+                        subroutine.calls.append(my_call)
+                        self._calls[key] = my_call
+                    else:
+                        my_call.add_site(child)
+                    if loop is not None:
+                        loop.add_call(child.designator)
+            elif isinstance(child, block_statements.Module):
                 my_module = Module()
                 my_module.parse(child)
-                my_module.analyse()
-                self._modules.append(my_module)
-                #print "  FOUND MODULE", child.name
-            if isinstance(child, fparser.block_statements.Subroutine):
-                my_subroutine = Subroutine()
+                my_module.category_counts[category] += 1
+                self.modules.append(my_module)
+                self._declared[id(my_module)] = set()
+                self.visit(child, module=my_module)
+            elif isinstance(child, statements.Use):
+                name = intern(str(child.name.lower()))
+                if subroutine is not None:
+                    subroutine.uses.append(name)
+                elif module is not None:
+                    module.uses.append(name)
+            elif interface:
+                # the units in an interface block only describe procedures
+                # defined elsewhere, so they are counted but not analysed
+                self._count(child, module, subroutine)
+            elif unit_class is not None:
+                my_subroutine = unit_class()
                 my_subroutine.parse(child)
-                my_subroutine.analyse()
-                self._subroutines.append(my_subroutine)
-            if isinstance(child, fparser.block_statements.Function):
-                pass
-                #print "  FOUND FUNCTION", child.name
-            if isinstance(child, fparser.block_statements.BlockData):
+                my_subroutine.category_counts[category] += 1
+                if module is not None:
+                    my_subroutine._module = module.name
+                if subroutine is not None:
+                    # host association
+                    my_subroutine.uses.extend(subroutine.uses)
+                if module is not None:
+                    module.subroutines.append(my_subroutine)
+                else:
+                    self.subroutines.append(my_subroutine)
+                self._declared[id(my_subroutine)] = set(
+                    self._declared.get(id(scope), ()))
+                self.visit(child, module=module, subroutine=my_subroutine)
+            elif isinstance(child, block_statements.Do) and \
+                    subroutine is not None:
+                my_loop = Loop()
+                my_loop.parse(child, 1 if loop is None else loop.depth + 1)
+                my_loop._directives.extend(directives)
+                directives = []
+                if loop is None:
+                    subroutine.loops.append(my_loop)
+                else:
+                    loop.loops.append(my_loop)
+                self.visit(child, module=module, subroutine=subroutine,
+                           references=references, loop=my_loop)
+            elif isinstance(child, BeginStatement):
+                # the action of a logical IF is on the same line as the
+                # condition so its references have already been found
+                self.visit(child, module=module, subroutine=subroutine,
+                           references=references and not
+                           isinstance(child, block_statements.If),
+                           loop=loop)
+        if directives and loop is not None:
+            loop._directives.extend(directives)
+
+    def _count(self, ast, module, subroutine):
+        ''' count the statements contained in ast without analysing them '''
+        from fparser.base_classes import BeginStatement
+        index_map = self._types.index_map
+        other = self._types.other_index
+        categories = self._types.categories
+        for child in ast.content:
+            idx = index_map.get(type(child), other)
+            self.statement_counts[idx] += 1
+            if module is not None:
+                module.category_counts[categories[idx]] += 1
+            if subroutine is not None:
+                subroutine.category_counts[categories[idx]] += 1
+            if isinstance(child, BeginStatement):
+                self._count(child, module, subroutine)
+
+    def _add_references(self, line, text, subroutine, scope, loop=None):
+        ''' record the variables declared, or the functions referenced,
+            by the statement text on line, and the arrays and functions it
+            references in loop if that is supplied '''
+        declared = self._declared.setdefault(id(scope), set())
+        names = _declared_names(text)
+        if names is not None:
+            declared.update(names)
+        elif subroutine is not None:
+            if loop is not None:
+                loop._arrays.update(_array_references(text, declared))
+            for name in _function_references(text, declared):
+                if loop is not None:
+                    loop.add_reference(name)
+                key = (id(subroutine), name.lower(), True)
+                my_call = self._calls.get(key)
+                if my_call is None:
+                    my_call = Call()
+                    my_call.parse_reference(name, line)
+                    my_call._caller = subroutine
+                    subroutine.calls.append(my_call)
+                    self._calls[key] = my_call
+                else:
+                    my_call._lines.append(line)
+
+
+def _line_span(ast):
+    ''' return the first and last line numbers of a block statement '''
+    start = ast.item.span[0]
+    end = ast.content[-1].item.span[1] if ast.content else ast.item.span[1]
+    return start, end
+
+
+class Scanner(object):
+    ''' A fast, line oriented scanner that finds the modules, program
+        units, USE statements, CALL sites and function references of a
+        Fortran file without parsing it with fparser. It handles free and
+        fixed form source, comments, continuation lines and multiple
+        statements on a line. The result is a :class:`File` that can be
+        linked in the same way as a parsed (and released) file, but which
+        has no statement counts. Subroutines and functions in interface
+        blocks are not definitions so are ignored, and calls and references
+        are added to the innermost unit that contains them, as for a full
+        parse.
+
+        For example:
+
+        >>> my_file = Scanner().scan("sbc.f90")
+        >>> [sub.name for sub in my_file.all_subroutines]
+    '''
+
+    _FIXED_FORM_EXTENSIONS = [".f", ".for", ".ftn", ".f77"]
+    # the kinds of scope that a bare END statement can close
+    _UNITS = ["subroutine", "function", "module", "submodule", "program",
+              "blockdata"]
+
+    def scan(self, file_path, source=None):
+        ''' Return a :class:`File` for file_path built from its source. If
+            source is given it is used rather than reading file_path. '''
+        my_file = File()
+        my_file._parsed = True
+        my_file._path = file_path
+        my_file._scanned = True
+        if source is None:
+            try:
+                with open(file_path, "rU") as source_file:
+                    source = source_file.read()
+            except (IOError, OSError):
                 pass
-                #print "  FOUND BLOCK DATA", child.name
+        if source is None:
+            my_file._parsed_ok = False
+            my_file._failure = "error"
+            return my_file
+        lines = source.splitlines()
+        my_file._parsed_ok = True
+        # there are no statement types without an fparser ast
+        my_file._statement_counts = array("l")
+        if self.is_free_form(file_path, lines):
+            statements = _free_form_statements(lines)
+        else:
+            statements = _fixed_form_statements(lines)
+        builder = _ScanBuilder()
+        for line_number, statement in statements:
+            builder.add(line_number, statement)
+        builder.finish()
+        my_file._modules = builder.modules
+        my_file._subroutines = builder.subroutines
+        my_file._n_lines = builder.last_line
+        my_file._is_empty = not any(line.strip() for line in lines)
+        return my_file
+
+    def is_free_form(self, file_path, lines):
+        ''' Return whether the source is in free form. Files with a fixed
+            form extension are still taken to be free form if a statement
+            starts in the label field. '''
+        import os
+        extension = os.path.splitext(file_path)[1].lower()
+        if extension not in self._FIXED_FORM_EXTENSIONS:
+            return True
+        for line in lines:
+            if not line or line[0] in "cC*!#\t" or not line.strip():
+                continue
+            label = line[:5]
+            if label.strip() and not label.strip().isdigit():
+                return True
+        return False
+
+
+def _strip_comment(text, quote=None):
+    ''' Return the text before any "!" comment and the quote character of
+        a string that is still open at the end of text, if any. quote is
+        the string (if any) that is open at the start of text. '''
+    if quote is None and "!" not in text and "'" not in text and \
+       '"' not in text:
+        return text, None
+    for idx, char in enumerate(text):
+        if quote is not None:
+            if char == quote:
+                quote = None
+        elif char == "'" or char == '"':
+            quote = char
+        elif char == "!":
+            return text[:idx], None
+    return text, quote
+
+
+def _split_statements(text):
+    ''' split text into the statements separated by ";" '''
+    if ";" not in text:
+        text = text.strip()
+        return [text] if text else []
+    statements = []
+    quote = None
+    start = 0
+    for idx, char in enumerate(text):
+        if quote is not None:
+            if char == quote:
+                quote = None
+        elif char == "'" or char == '"':
+            quote = char
+        elif char == ";":
+            statements.append(text[start:idx])
+            start = idx + 1
+    statements.append(text[start:])
+    return [statement.strip() for statement in statements
+            if statement.strip()]
+
+
+def _free_form_statements(lines):
+    ''' generator returning (first line number, statement) for each
+        statement in free form source '''
+    parts = []
+    start = None
+    quote = None
+    for number, line in enumerate(lines, 1):
+        if quote is None and not parts and line.lstrip().startswith("#"):
+            # a preprocessor directive
+            continue
+        text, quote = _strip_comment(line, quote)
+        text = text.strip()
+        if not text:
+            # comments and blank lines do not end a continued statement
+            continue
+        if parts and text.startswith("&"):
+            text = text[1:]
+        if start is None:
+            start = number
+        if text.endswith("&"):
+            parts.append(text[:-1])
+            continue
+        parts.append(text)
+        for statement in _split_statements("".join(parts)):
+            yield start, statement
+        parts = []
+        start = None
+        quote = None
+    if parts:
+        for statement in _split_statements("".join(parts)):
+            yield start, statement
+
+
+def _fixed_form_statements(lines):
+    ''' generator returning (first line number, statement) for each
+        statement in fixed form source '''
+    parts = []
+    start = None
+    quote = None
+    for number, line in enumerate(lines, 1):
+        if not line.strip() or line[0] in "cC*!#":
+            continue
+        if line[0] == "\t":
+            # tab format: a digit after the tab marks a continuation
+            continuation = len(line) > 1 and line[1] in "123456789"
+            text = line[2:] if continuation else line[1:]
+        else:
+            continuation = len(line) > 5 and not line[:5].strip() and \
+                line[5] not in " 0"
+            if not continuation and line[:6].lstrip().startswith("!"):
+                continue
+            text = line[6:72]
+        if not continuation:
+            if parts:
+                for statement in _split_statements("".join(parts)):
+                    yield start, statement
+            parts = []
+            start = number
+            quote = None
+        elif start is None:
+            start = number
+        text, quote = _strip_comment(text, quote)
+        parts.append(text)
+    if parts:
+        for statement in _split_statements("".join(parts)):
+            yield start, statement
+
+
+class _ScanBuilder(object):
+    ''' Builds the module, program unit and call hierarchy of a file from
+        its statements, as :class:`_AnalysisVisitor` does from an fparser
+        ast. The open scopes are kept on a stack of [kind, object] pairs,
+        where the object is None for scopes that are not recorded. '''
+
+    _LABEL = re.compile(r"^\d+\s*")
+    _END_UNIT = re.compile(
+        r"^end\s*(subroutine|function|module|submodule|program|interface|"
+        r"block\s*data)\b", re.I)
+    _END = re.compile(r"^end$", re.I)
+    _CALL = re.compile(r"^call\s+(\w+(?:\s*%\s*\w+)*)", re.I)
+    _IF = re.compile(r"^if\s*\(", re.I)
+    _USE = re.compile(
+        r"^use\b\s*(?:,\s*(?:non_)?intrinsic\s*)?(?:::)?\s*(\w+)", re.I)
+    _MODULE = re.compile(r"^module\s+(\w+)$", re.I)
+    _SUBMODULE = re.compile(r"^submodule\s*\(", re.I)
+    _PROGRAM = re.compile(r"^program\s+(\w+)", re.I)
+    _BLOCK_DATA = re.compile(r"^block\s*data\b\s*(\w*)", re.I)
+    _INTERFACE = re.compile(r"^(?:abstract\s+)?interface\b", re.I)
+    _PREFIX = (r"(?:recursive|pure|impure|elemental|module|non_recursive|"
+               r"integer|real|logical|complex|character|double\s*precision|"
+               r"double\s*complex|(?:type|class)\s*\([^)]*\))"
+               r"(?:\s*\*\s*\w+|\s*\([^)]*\))?")
+    _SUBROUTINE = re.compile(r"^(?:" + _PREFIX + r"\s*)*subroutine\s+(\w+)",
+                             re.I)
+    _FUNCTION = re.compile(r"^(?:" + _PREFIX +
+                           r"\s*)*function\s+(\w+)\s*\(", re.I)
+
+    def __init__(self):
+        self.modules = []
+        self.subroutines = []
+        self.last_line = 0
+        self._stack = []
+        # the call object for each (unit, called name, is reference)
+        self._calls = {}
+        # id(module or unit) -> the lower-cased names of the variables
+        # declared in it or visible from its host
+        self._declared = {}
+
+    def _innermost(self, kind):
+        ''' return the innermost recorded object of the kind of scope '''
+        for scope_kind, obj in reversed(self._stack):
+            if scope_kind == kind and obj is not None:
+                return obj
+        return None
+
+    def _unit(self):
+        ''' return the innermost recorded program unit '''
+        for scope_kind, obj in reversed(self._stack):
+            if scope_kind != "module" and obj is not None:
+                return obj
+        return None
+
+    def _in_interface(self):
+        for scope_kind, _ in self._stack:
+            if scope_kind == "interface":
+                return True
+        return False
+
+    def _close(self, kind, line_number):
+        ''' close the innermost scope of the kind (or, if kind is None,
+            the innermost program unit) and any scopes inside it '''
+        for idx in range(len(self._stack) - 1, -1, -1):
+            scope_kind = self._stack[idx][0]
+            if scope_kind == kind or \
+               (kind is None and scope_kind in Scanner._UNITS):
+                for _, obj in self._stack[idx:]:
+                    if obj is not None:
+                        obj._end_line = line_number
+                del self._stack[idx:]
+                return
+
+    def add(self, line_number, statement):
+        ''' add the statement that starts on line_number '''
+        self.last_line = line_number
+        if statement[0].isdigit():
+            statement = self._LABEL.sub("", statement)
+            if not statement:
+                return
+        lower = statement[:10].lower()
+        if lower.startswith("end"):
+            match = self._END_UNIT.match(statement)
+            if match:
+                kind = match.group(1).lower().replace(" ", "")
+                self._close(kind, line_number)
+                return
+            if self._END.match(statement):
+                self._close(None, line_number)
+                return
+        if lower.startswith("use"):
+            match = self._USE.match(statement)
+            if match:
+                self._add_use(match.group(1))
+                return
+        elif lower.startswith("submodule"):
+            if self._SUBMODULE.match(statement):
+                self._stack.append(["submodule", None])
+                return
+        elif lower.startswith("module"):
+            match = self._MODULE.match(statement)
+            if match:
+                if match.group(1).lower() != "procedure":
+                    self._add_module(line_number, match.group(1))
+                return
+        elif lower.startswith("program"):
+            match = self._PROGRAM.match(statement)
+            if match:
+                self._add_unit(Program, "program", line_number,
+                               match.group(1))
+                return
+        elif lower.startswith("block"):
+            match = self._BLOCK_DATA.match(statement)
+            if match:
+                self._add_unit(BlockData, "blockdata", line_number,
+                               match.group(1))
+                return
+        elif lower.startswith(("interface", "abstract")):
+            if self._INTERFACE.match(statement):
+                self._stack.append(["interface", None])
+                return
+        else:
+            lower = statement.lower()
+            if "subroutine" in lower:
+                match = self._SUBROUTINE.match(statement)
+                if match:
+                    self._add_unit(Subroutine, "subroutine", line_number,
+                                   match.group(1))
+                    return
+            elif "function" in lower:
+                match = self._FUNCTION.match(statement)
+                if match:
+                    self._add_unit(Function, "function", line_number,
+                                   match.group(1))
+                    return
+        self._add_statement(line_number, statement)
+
+    def _add_statement(self, line_number, statement):
+        ''' add the declarations, function references and call in an
+            executable or declaration statement '''
+        if self._in_interface():
+            return
+        subroutine = self._unit()
+        scope = subroutine
+        if scope is None:
+            scope = self._innermost("module")
+            if scope is None:
+                return
+        declared = self._declared.setdefault(id(scope), set())
+        names = _declared_names(statement)
+        if names is not None:
+            declared.update(names)
+            return
+        if subroutine is None:
+            return
+        for name in _function_references(statement, declared):
+            key = (id(subroutine), name.lower(), True)
+            my_call = self._calls.get(key)
+            if my_call is None:
+                my_call = Call()
+                my_call._name = intern(name)
+                my_call._caller = subroutine
+                my_call._reference = True
+                subroutine.calls.append(my_call)
+                self._calls[key] = my_call
+            my_call._lines.append(line_number)
+        lower = statement[:4].lower()
+        if lower == "call":
+            self._add_call(line_number, statement)
+        elif lower.startswith("if"):
+            match = self._IF.match(statement)
+            if match:
+                rest = _after_parentheses(statement, match.end() - 1)
+                if rest.lower().startswith("call"):
+                    self._add_call(line_number, rest)
+
+    def _add_module(self, line_number, name):
+        my_module = Module()
+        my_module._name = intern(name)
+        my_module._start_line = line_number
+        self.modules.append(my_module)
+        self._stack.append(["module", my_module])
+
+    def _add_unit(self, unit_class, kind, line_number, name):
+        ''' open a program unit of unit_class '''
+        if self._in_interface():
+            self._stack.append([kind, None])
+            return
+        my_subroutine = unit_class()
+        my_subroutine._name = intern(name)
+        my_subroutine._start_line = line_number
+        module = self._innermost("module")
+        host = self._unit()
+        if module is not None:
+            my_subroutine._module = module.name
+            module.subroutines.append(my_subroutine)
+        else:
+            self.subroutines.append(my_subroutine)
+        if host is not None:
+            # host association
+            my_subroutine.uses.extend(host.uses)
+        scope = host if host is not None else module
+        self._declared[id(my_subroutine)] = set(
+            self._declared.get(id(scope), ()))
+        self._stack.append([kind, my_subroutine])
+
+    def _add_use(self, name):
+        if self._in_interface():
+            return
+        name = intern(name.lower())
+        subroutine = self._unit()
+        if subroutine is not None:
+            subroutine.uses.append(name)
+        else:
+            module = self._innermost("module")
+            if module is not None:
+                module.uses.append(name)
+
+    def _add_call(self, line_number, statement):
+        match = self._CALL.match(statement)
+        subroutine = self._unit()
+        if match is None or subroutine is None:
+            return
+        name = match.group(1).replace(" ", "")
+        key = (id(subroutine), name.lower(), False)
+        my_call = self._calls.get(key)
+        if my_call is None:
+            my_call = Call()
+            my_call._name = intern(name)
+            my_call._caller = subroutine
+            subroutine.calls.append(my_call)
+            self._calls[key] = my_call
+        my_call._lines.append(line_number)
+
+    def finish(self):
+        ''' close any scopes left open at the end of the file '''
+        for _, obj in self._stack:
+            if obj is not None:
+                obj._end_line = self.last_line
+        self._stack = []
+
+
+def _after_parentheses(text, start):
+    ''' return the text after the parenthesis that closes the one at
+        start, or "" if it is not closed '''
+    depth = 0
+    quote = None
+    for idx in range(start, len(text)):
+        char = text[idx]
+        if quote is not None:
+            if char == quote:
+                quote = None
+        elif char == "'" or char == '"':
+            quote = char
+        elif char == "(":
+            depth += 1
+        elif char == ")":
+            depth -= 1
+            if depth == 0:
+                return text[idx + 1:].strip()
+    return ""
+
+
+# the words that can be followed by "(" in an executable statement without
+# being a function reference: statement keywords and intrinsic procedures
+_NOT_FUNCTIONS = frozenset("""
+    if then else elseif while case select where elsewhere forall do call
+    read write print open close inquire rewind backspace endfile flush wait
+    allocate deallocate nullify return stop go goto format associate block
+    critical concurrent sync error change team extends result bind kind len
+    integer real double complex logical character type class procedure
+    abs achar acos acosh adjustl adjustr aimag aint all allocated anint any
+    asin asinh associated atan atan2 atanh bessel_j0 bessel_j1 bessel_jn
+    bessel_y0 bessel_y1 bessel_yn bit_size btest ceiling char cmplx
+    command_argument_count conjg cos cosh count cpu_time cshift
+    date_and_time dble dcmplx digits dim dot_product dprod dshiftl dshiftr
+    eoshift epsilon erf erfc erfc_scaled execute_command_line exp exponent
+    extends_type_of findloc float floor fraction gamma get_command
+    get_command_argument get_environment_variable huge hypot iachar iall
+    iand iany ibclr ibits ibset ichar ieor image_index index int ior
+    iparity is_contiguous is_iostat_end is_iostat_eor ishft ishftc lbound
+    lcobound leadz len_trim lge lgt lle llt log log10 log_gamma maskl maskr
+    matmul max maxexponent maxloc maxval merge merge_bits min minexponent
+    minloc minval mod modulo move_alloc mvbits nearest new_line nint norm2
+    not null num_images pack parity popcnt poppar precision present product
+    radix random_number random_seed range rank repeat reshape rrspacing
+    same_type_as scale scan selected_char_kind selected_int_kind
+    selected_real_kind set_exponent shape shifta shiftl shiftr sign sin sinh
+    size spacing spread sqrt storage_size sum system_clock tan tanh
+    this_image tiny trailz transfer transpose trim ubound ucobound unpack
+    verify alog alog10 amax0 amax1 amin0 amin1 amod cabs ccos cexp clog
+    csin csqrt dabs dacos dasin datan datan2 dcos dcosh ddim dexp dfloat
+    dint dlog dlog10 dmax1 dmin1 dmod dnint dsign dsin dsinh dsqrt dtan
+    dtanh iabs idim idint idnint ifix isign max0 max1 min0 min1 sngl
+    c_associated c_f_pointer c_f_procpointer c_funloc c_loc c_sizeof
+    """.split())
+
+_STRING = re.compile(r"'[^']*'|\"[^\"]*\"")
+_OPERATOR = re.compile(r"\.[a-z]+\.", re.I)
+_REFERENCE = re.compile(r"(?<![%\w])([a-z_]\w*)\s*\(", re.I)
+_DECLARATION = re.compile(
+    r"^(?:(integer|real|double\s*precision|double\s*complex|complex|"
+    r"logical|character)\b|(type|class|procedure)\s*\(|"
+    r"(dimension|common|allocatable|pointer|target|intrinsic)\b)", re.I)
+_LEADING_NAME = re.compile(r"^\s*(\w+)")
+
+
+def _declared_names(statement):
+    ''' Return the names declared by statement if it is a type
+        declaration, or a DIMENSION, COMMON, ALLOCATABLE, POINTER, TARGET or
+        INTRINSIC statement, otherwise None. Names declared in these ways
+        are variables (or intrinsics) rather than functions. '''
+    match = _DECLARATION.match(statement)
+    if match is None:
+        return None
+    text = _STRING.sub("''", statement)
+    if "::" in text:
+        text = text[text.index("::") + 2:]
+    elif match.group(3) is not None:
+        text = text[match.end():]
+        if match.group(3).lower() == "common":
+            text = re.sub(r"/\s*\w*\s*/", ",", text)
+    else:
+        # an old style declaration such as "real*8 x(3)" or "real(8) x"
+        text = text[match.end():].lstrip()
+        if match.group(2) is not None:
+            text = _after_parentheses(statement, match.end() - 1)
+        elif text.startswith("*"):
+            text = text[1:].lstrip()
+            if text.startswith("("):
+                text = _after_parentheses(text, 0)
+            else:
+                text = re.sub(r"^\w+", "", text)
+        elif text.startswith("("):
+            text = _after_parentheses(text, 0)
+    # remove array specs, lengths and initial values
+    previous = None
+    while previous != text:
+        previous = text
+        text = re.sub(r"\([^()]*\)|\[[^\[\]]*\]", "", text)
+    names = []
+    for entity in text.split(","):
+        match = _LEADING_NAME.match(entity)
+        if match:
+            names.append(match.group(1).lower())
+    return names
+
+
+def _function_references(statement, declared=()):
+    ''' Return the names that statement references as functions, in the
+        order they first appear. Without a full semantic analysis a
+        function reference can not be told apart from an array element,
+        so any name followed by "(" is returned unless it is a keyword or
+        intrinsic, is in declared (the lower-cased names of the variables
+        in scope), is the target of an assignment or is the subroutine in
+        a CALL. '''
+    if "(" not in statement:
+        return []
+    text = _OPERATOR.sub(" ", _STRING.sub("''", statement))
+    word = _LEADING_NAME.match(text)
+    word = word.group(1).lower() if word else ""
+    excluded = None
+    if word == "call":
+        match = _ScanBuilder._CALL.match(text)
+        if match is None:
+            return []
+        text = text[match.end():]
+    elif word == "if" and _ScanBuilder._IF.match(text):
+        # a logical IF holds a condition and an action statement
+        rest = _after_parentheses(text, text.index("("))
+        if rest and rest.lower() != "then":
+            text = text.rstrip()
+            names = _function_references(text[:len(text) - len(rest)],
+                                         declared)
+            for name in _function_references(rest, declared):
+                if name not in names:
+                    names.append(name)
+            return names
+    else:
+        excluded = _assignment_target(text)
+    names = []
+    for match in _REFERENCE.finditer(text):
+        name = match.group(1)
+        lower = name.lower()
+        if lower not in _NOT_FUNCTIONS and lower not in declared and \
+           lower != excluded and name not in names:
+            names.append(name)
+    return names
+
+
+def _assignment_target(text):
+    ''' return the lower-cased leading name of the variable assigned to
+        if text is an assignment, otherwise None '''
+    depth = 0
+    for idx, char in enumerate(text):
+        if char == "(" or char == "[":
+            depth += 1
+        elif char == ")" or char == "]":
+            depth -= 1
+        elif char == "=" and depth == 0:
+            if text[idx - 1:idx] in ["<", ">", "/", "="] or \
+               text[idx + 1:idx + 2] in ["=", ">"]:
+                return None
+            match = _LEADING_NAME.match(text)
+            return match.group(1).lower() if match else None
+    return None
+
+
+_DIRECTIVE = re.compile(r"^\s*\$(omp|acc)\b\s*(\w*)", re.I)
+
+
+def _directive(comment):
+    ''' Return the text of the OpenMP or OpenACC directive in the
+        comment, as "!$omp ..." or "!$acc ...", or None if there is none.
+        End directives are ignored as they close a directive that has
+        already been found. '''
+    match = _DIRECTIVE.match(comment)
+    if match is None or match.group(2).lower() == "end":
+        return None
+    return "!" + comment.strip()
+
+
+def _fixed_form_directives(lines):
+    ''' Return (line number, directive, line number of the next
+        statement) for each OpenMP or OpenACC directive in the lines of
+        fixed form source. A directive starts with a sentinel such as
+        "C$OMP", "*$ACC" or "!$OMP" in column 1 (or "!$OMP" after spaces)
+        and continues on lines with a character other than a space or zero
+        in column 6. '''
+    directives = []
+    # the index of the first directive waiting for its statement
+    first_waiting = 0
+    kept = False
+    for number, line in enumerate(lines, 1):
+        stripped = line.strip()
+        if line[:1] in "cC*!" and line[1:2] == "$":
+            text = line[1:]
+        elif stripped.startswith("!$"):
+            text = stripped[1:]
+        else:
+            text = None
+        if text is not None and _DIRECTIVE.match(text):
+            if line[:1] != " " and line[5:6] not in ["", " ", "0"]:
+                # a continuation of the previous directive line
+                if kept and len(directives) > first_waiting:
+                    start, directive, _ = directives[-1]
+                    directives[-1] = (start, directive + " " +
+                                      text[5:].strip(), None)
+            else:
+                directive = _directive(text)
+                kept = directive is not None
+                if kept:
+                    directives.append((number, directive, None))
+            continue
+        if not stripped or line[:1] in "cCdD*!" or stripped.startswith("!"):
+            continue
+        for idx in range(first_waiting, len(directives)):
+            directives[idx] = directives[idx][:2] + (number,)
+        first_waiting = len(directives)
+    return directives
+
+
+def _add_directives(units, directives):
+    ''' Add each (line number, directive, next statement line number)
+        directive to the loop in units that starts on the next statement
+        line or, if there is none, to the innermost loop containing the
+        directive. '''
+    loops = [loop for unit in units for nest in unit.loops
+             for loop in nest.walk()]
+    starts = dict((loop.start_line, loop) for loop in loops)
+    for number, directive, next_line in directives:
+        loop = starts.get(next_line)
+        if loop is None:
+            containing = [inner for inner in loops if
+                          inner.start_line <= number <= inner.end_line]
+            if not containing:
+                continue
+            loop = max(containing, key=lambda inner: inner.depth)
+        if directive not in loop._directives:
+            loop._directives.append(directive)
+
+
+def _array_references(statement, declared):
+    ''' return the lower-cased names of the declared variables that are
+        subscripted in the statement text '''
+    text = _STRING.sub("''", statement)
+    return set(name.lower() for name in _REFERENCE.findall(text)
+               if name.lower() in declared)
 
 
 class Module(object):
@@ -474,84 +5942,269 @@ class Module(object):
     def __init__(self):
         # a list of subroutines contained in this module
         self._subroutines = []
+        self._ast = None
+        self._name = None
+        self._start_line = None
+        self._end_line = None
+        # the lower-cased names of the modules used by this module
+        self._uses = []
+        # the number of statements in each StatementTypes category
+        self._category_counts = _new_category_counts()
 
     @property
     def name(self):
-        return self._ast.name
+        return self._name
+
+    @property
+    def uses(self):
+        return self._uses
+
+    @property
+    def category_counts(self):
+        return self._category_counts
 
     @property
     def subroutines(self):
         return self._subroutines
 
+    @property
+    def start_line(self):
+        return self._start_line
+
+    @property
+    def end_line(self):
+        return self._end_line
+
     def parse(self, ast):
         self._ast = ast
+        self._name = intern(str(ast.name))
+        self._start_line, self._end_line = _line_span(ast)
+
+    def release(self):
+        ''' drop the reference to the fparser ast '''
+        self._ast = None
+        for subroutine in self._subroutines:
+            subroutine.release()
 
     def analyse(self):
-        from fparser import api
-        import fparser
-        for stmt, depth in api.walk(self._ast, -1):
-            if isinstance(stmt, fparser.block_statements.Subroutine):
-                my_subroutine = Subroutine()
-                my_subroutine.parse(stmt)
-                my_subroutine.analyse()
-                self._subroutines.append(my_subroutine)
+        _AnalysisVisitor().visit(self._ast, module=self)
+
+
+class _Compact(object):
+    ''' Base class for the analysis objects that there can be very many
+        of. These use __slots__ rather than a per-object dict and intern
+        their names so that each distinct name is only stored once. This
+        class allows them to be pickled with any protocol. '''
+    __slots__ = ()
+
+    def __getstate__(self):
+        state = {}
+        for cls in type(self).__mro__:
+            for slot in getattr(cls, "__slots__", ()):
+                state[slot] = getattr(self, slot)
+        return state
+
+    def __setstate__(self, state):
+        for slot, value in state.items():
+            if slot == "_name" and value is not None:
+                value = intern(value)
+            setattr(self, slot, value)
 
 
-class Subroutine(object):
+class Subroutine(_Compact):
+    ''' A subroutine. This is also the base class of the other program
+        units (functions, main programs and block data), which are held,
+        indexed and linked in the same way; kind says which it is. '''
+    __slots__ = ("_calls", "_link_calls", "_ast", "_name", "_start_line",
+                 "_end_line", "_module", "_uses", "_category_counts",
+                 "_loops")
+
+    kind = "subroutine"
+
     def __init__(self):
-        self._calls = []  # a list of the calls made by this subroutine
+        # a list of the calls made by this subroutine, one per called name
+        self._calls = []
         self._link_calls = []  # a list of calls that call this subroutine
+        self._ast = None
+        self._name = None
+        self._start_line = None
+        self._end_line = None
+        # the name of the module containing this subroutine, if any
+        self._module = None
+        # the lower-cased names of the modules used by this subroutine
+        # (including those used by a host subroutine)
+        self._uses = []
+        # the number of statements in each StatementTypes category
+        self._category_counts = _new_category_counts()
+        # the outermost DO loops in this subroutine
+        self._loops = []
 
     def parse(self, ast):
         self._ast = ast
+        self._name = intern(str(ast.name))
+        self._start_line, self._end_line = _line_span(ast)
+
+    def release(self):
+        ''' drop the references to the fparser ast '''
+        self._ast = None
+        for call in self._calls:
+            call.release()
 
     def analyse(self):
-        from fparser import api
-        import fparser
-        for stmt, depth in api.walk(self._ast, -1):
-            if isinstance(stmt, fparser.statements.Call):
-                # currently one object per call even if they call the same
-                # subroutine
-                my_call = Call()
-                my_call.parse(stmt)
-                my_call.analyse()
-                self._calls.append(my_call)
+        _AnalysisVisitor().visit(self._ast, subroutine=self)
 
     @property
     def name(self):
-        return self._ast.name
+        return self._name
+
+    @property
+    def start_line(self):
+        return self._start_line
+
+    @property
+    def end_line(self):
+        return self._end_line
+
+    @property
+    def module(self):
+        return self._module
+
+    @property
+    def uses(self):
+        return self._uses
+
+    @property
+    def category_counts(self):
+        return self._category_counts
 
     @property
     def calls(self):
         return self._calls
 
+    @property
+    def loops(self):
+        ''' the outermost DO loops, each with the loops nested in it '''
+        return self._loops
+
+    @property
+    def link_calls(self):
+        return self._link_calls
+
     def add_link(self, call):
         self._link_calls.append(call)
 
-    def call_tree(self):
-        unique_names = []
-        print self.name + ";"
+    def remove_link(self, call):
+        self._link_calls.remove(call)
+
+    def call_tree(self, stream=None):
+        ''' write this subroutine and the subroutines it calls in the dot
+            graph format to stream (stdout by default) '''
+        if stream is None:
+            import sys
+            stream = sys.stdout
+        unique_names = set()
+        lines = [self.name + ";\n"]
         for call in self.calls:
             if call.link is not None:
                 if call.link.name not in unique_names:
-                    unique_names.append(call.link.name)
-                    print self.name, "->", call.link.name + ";"
+                    unique_names.add(call.link.name)
+                    lines.append(self.name + " -> " + call.link.name + ";\n")
+        stream.write("".join(lines))
+
+
+class Function(Subroutine):
+    ''' a function. Functions are only linked to function references. '''
+    __slots__ = ()
 
+    kind = "function"
 
-class Call(object):
+
+class Program(Subroutine):
+    ''' a main program '''
+    __slots__ = ()
+
+    kind = "program"
+
+
+class BlockData(Subroutine):
+    ''' a block data program unit '''
+    __slots__ = ()
+
+    kind = "block data"
+
+
+# the class of each kind of program unit
+_UNIT_CLASSES = dict((cls.kind, cls) for cls in
+                     [Subroutine, Function, Program, BlockData])
+
+
+class Call(_Compact):
+    ''' A call from a subroutine (or other program unit) to a named
+        subroutine, or a reference to a named function in an expression.
+        Repeated calls to (or references to) the same name from the same
+        unit share one Call object, which records the line of each call
+        site. '''
+    __slots__ = ("_link_subroutine", "_stmt", "_name", "_lines", "_caller",
+                 "_reference")
 
     def __init__(self):
         self._link_subroutine = None
+        self._caller = None  # the subroutine making the call
+        self._stmt = None
+        self._name = None
+        self._lines = array("i")
+        # whether this is a function reference rather than a CALL
+        self._reference = False
 
     def parse(self, stmt):
         self._stmt = stmt
+        self._name = intern(str(stmt.designator))
+        self._lines.append(stmt.item.span[0])
+
+    def parse_reference(self, name, line):
+        ''' set this up as a reference to the function name on line '''
+        self._name = intern(str(name))
+        self._lines.append(line)
+        self._reference = True
+
+    def add_site(self, stmt):
+        ''' record another call site with the same name '''
+        self._lines.append(stmt.item.span[0])
+
+    def release(self):
+        ''' drop the reference to the fparser statement '''
+        self._stmt = None
 
     def analyse(self):
         pass
 
     @property
     def name(self):
-        return self._stmt.designator
+        return self._name
+
+    @property
+    def is_reference(self):
+        ''' whether this is a function reference rather than a CALL '''
+        return self._reference
+
+    @property
+    def caller(self):
+        return self._caller
+
+    @property
+    def line(self):
+        ''' the line of the first call site '''
+        return self._lines[0]
+
+    @property
+    def lines(self):
+        ''' the lines of all of the call sites '''
+        return self._lines
+
+    @property
+    def count(self):
+        ''' the number of call sites '''
+        return len(self._lines)
 
     @property
     def link(self):
@@ -560,3 +6213,158 @@ class Call(object):
     @link.setter
     def link(self, subroutine):
         self._link_subroutine = subroutine
+
+
+class Loop(_Compact):
+    ''' A DO loop in a program unit and the loops nested within it. The
+        arrays, calls, references, directives and statements are those of
+        this loop and the loops nested within it. A subscripted name that
+        is not declared in the unit (or its host) is a reference: it is a
+        function reference if the :class:`Link` matches it to a function
+        and is otherwise an array from a USEd module (see
+        :class:`LoopNests`). '''
+    __slots__ = ("_kind", "_variable", "_bounds", "_start_line", "_end_line",
+                 "_depth", "_loops", "_arrays", "_calls", "_references",
+                 "_directives", "_n_statements")
+
+    _CONTROL = re.compile(r"^\s*(?:\w+\s*:\s*)?do\b\s*(?:\d+\s*,?)?\s*(.*?)"
+                          r"\s*$", re.I)
+    _COUNTED = re.compile(r"^(\w+)\s*=\s*(.*)$")
+
+    def __init__(self):
+        # "do", "do while" or "do concurrent"
+        self._kind = "do"
+        self._variable = None
+        self._bounds = None
+        self._start_line = None
+        self._end_line = None
+        self._depth = 1
+        self._loops = []  # the loops directly nested in this one
+        # the lower-cased names of the declared arrays subscripted, the
+        # subroutines called and the other names subscripted directly in
+        # this loop
+        self._arrays = set()
+        self._calls = []
+        self._references = []
+        self._directives = []
+        self._n_statements = 0
+
+    def parse(self, ast, depth=1):
+        self._start_line, self._end_line = _line_span(ast)
+        self._depth = depth
+        match = self._CONTROL.match(ast.item.line)
+        control = match.group(1) if match else ""
+        lower = control.lower()
+        if lower.startswith("while"):
+            self._kind = "do while"
+            self._bounds = control[len("while"):].strip()
+        elif lower.startswith("concurrent"):
+            self._kind = "do concurrent"
+            self._bounds = control[len("concurrent"):].strip()
+        else:
+            match = self._COUNTED.match(control)
+            if match:
+                self._variable = intern(str(match.group(1).lower()))
+                self._bounds = match.group(2)
+
+    def add_call(self, name):
+        ''' record a CALL to name in this loop '''
+        name = intern(str(name.lower()))
+        if name not in self._calls:
+            self._calls.append(name)
+
+    def add_reference(self, name):
+        ''' record a reference to the undeclared name in this loop '''
+        name = intern(str(name.lower()))
+        if name not in self._references:
+            self._references.append(name)
+
+    def walk(self):
+        ''' generator returning this loop and the loops nested within it,
+            outermost first '''
+        loops = [self]
+        while loops:
+            loop = loops.pop()
+            yield loop
+            loops.extend(reversed(loop.loops))
+
+    @property
+    def kind(self):
+        return self._kind
+
+    @property
+    def variable(self):
+        ''' the lower-cased loop variable, or None if there is none '''
+        return self._variable
+
+    @property
+    def bounds(self):
+        ''' the loop control after the variable (for example "1, n"), the
+            condition of a DO WHILE or the header of a DO CONCURRENT. None
+            for a DO with no loop control. '''
+        return self._bounds
+
+    @property
+    def is_counted(self):
+        ''' whether the loop has an iteration count (it is not a DO WHILE
+            or a DO with no loop control) '''
+        return self._variable is not None or self._kind == "do concurrent"
+
+    @property
+    def start_line(self):
+        return self._start_line
+
+    @property
+    def end_line(self):
+        return self._end_line
+
+    @property
+    def depth(self):
+        ''' the depth of this loop in its nest, where the outermost loop
+            is 1 '''
+        return self._depth
+
+    @property
+    def loops(self):
+        return self._loops
+
+    @property
+    def nest_depth(self):
+        ''' the number of levels in the nest starting at this loop '''
+        return max(loop.depth for loop in self.walk()) - self._depth + 1
+
+    @property
+    def is_perfect(self):
+        ''' whether every loop in the nest but the innermost contains
+            nothing but the next loop '''
+        for loop in self.walk():
+            if loop.loops and (len(loop.loops) > 1 or
+                               loop._n_statements > 1):
+                return False
+        return True
+
+    @property
+    def arrays(self):
+        ''' the declared arrays subscripted '''
+        return sorted(set().union(*[loop._arrays for loop in self.walk()]))
+
+    @property
+    def calls(self):
+        ''' the names in CALL statements '''
+        return sorted(set(name for loop in self.walk()
+                          for name in loop._calls))
+
+    @property
+    def references(self):
+        ''' the subscripted names that are not declared '''
+        return sorted(set(name for loop in self.walk()
+                          for name in loop._references))
+
+    @property
+    def directives(self):
+        return [directive for loop in self.walk()
+                for directive in loop._directives]
+
+    @property
+    def n_statements(self):
+        return sum(loop._n_statements for loop in self.walk())
@@ -0,0 +1,310 @@
+# BSD 3-Clause License
+#
+# Copyright (c) 2017, Science and Technology Facilities Council
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# * Neither the name of the copyright holder nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+'''Benchmarks for the Fortran Code Analyser. A synthetic Fortran tree is
+    generated with a given number of files, modules per file, subroutines
+    per module, call fan-out and call depth. Each stage of the pipeline
+    (directory scan, parse, analyse, stats, link and dot output) is then
+    timed, along with the resident memory before and after it and the peak
+    memory of the process so far, and the results are written as JSON so
+    that they can be compared across changes and tree sizes.
+
+    For example:
+
+    $ python benchmark.py --files 100 1000 --output results.json
+
+'''
+import os
+import sys
+import time
+
+
+def generate_corpus(directory, n_files=10, n_modules=2, n_subroutines=5,
+                    fan_out=2, depth=4, files_per_dir=100, seed=0):
+    ''' Write a synthetic Fortran tree to directory. Each file holds
+        n_modules modules and each module n_subroutines subroutines. The
+        modules are split into depth levels and every subroutine in a level
+        calls up to fan_out (randomly chosen) subroutines in the next level
+        down, USEing their modules, so the call tree is depth deep and the
+        module dependencies have no cycles.
+
+    :param directory: the directory to write the files to. It is created if
+                      it does not exist.
+    :type directory: str.
+    :param files_per_dir: the number of files in each sub-directory.
+    :type files_per_dir: int.
+    :param seed: the seed used to choose the calls.
+    :type seed: int.
+    :return: a map with the number of files, modules, subroutines, calls
+             and lines written.
+    '''
+    import random
+    rand = random.Random(seed)
+    module_names = []
+    for file_idx in range(n_files):
+        for mod_idx in range(n_modules):
+            module_names.append("bench_m{0}_{1}".format(file_idx, mod_idx))
+    n_total = len(module_names)
+    depth = max(1, min(depth, n_total))
+    # the level of each module and the subroutines in each level
+    levels = [idx * depth // n_total for idx in range(n_total)]
+    level_subroutines = [[] for _ in range(depth)]
+    for idx, module_name in enumerate(module_names):
+        for sub_idx in range(n_subroutines):
+            level_subroutines[levels[idx]].append(
+                (module_name, "{0}_s{1}".format(module_name, sub_idx)))
+
+    totals = {"files": 0, "modules": 0, "subroutines": 0, "calls": 0,
+              "lines": 0}
+    for file_idx in range(n_files):
+        sub_dir = os.path.join(directory,
+                               "d{0}".format(file_idx // files_per_dir))
+        if not os.path.isdir(sub_dir):
+            os.makedirs(sub_dir)
+        lines = ["! synthetic benchmark file {0}".format(file_idx)]
+        for mod_idx in range(n_modules):
+            idx = file_idx * n_modules + mod_idx
+            module_name = module_names[idx]
+            level = levels[idx]
+            callees = []
+            if level + 1 < depth:
+                callees = level_subroutines[level + 1]
+            lines.extend(["module " + module_name, "  implicit none",
+                          "contains"])
+            for sub_idx in range(n_subroutines):
+                targets = rand.sample(callees, min(fan_out, len(callees)))
+                lines.extend(_subroutine_lines(
+                    "{0}_s{1}".format(module_name, sub_idx), targets))
+                totals["subroutines"] += 1
+                totals["calls"] += len(targets)
+            lines.append("end module " + module_name)
+            totals["modules"] += 1
+        file_path = os.path.join(sub_dir, "bench_f{0}.f90".format(file_idx))
+        with open(file_path, "w") as source:
+            source.write("\n".join(lines) + "\n")
+        totals["files"] += 1
+        totals["lines"] += len(lines)
+    return totals
+
+
+def _subroutine_lines(name, targets):
+    ''' return the lines of a subroutine called name that calls each of the
+        (module name, subroutine name) targets '''
+    lines = ["  subroutine {0}(n, a)".format(name)]
+    for module_name in sorted(set(module for module, _ in targets)):
+        lines.append("    use " + module_name)
+    lines.extend(["    integer, intent(in) :: n",
+                  "    real, intent(inout) :: a(n)",
+                  "    integer :: i",
+                  "    ! scale and shift the field",
+                  "    do i = 1, n",
+                  "      a(i) = 2.0 * a(i) + 1.0",
+                  "    end do"])
+    for _, target in targets:
+        lines.append("    call {0}(n, a)".format(target))
+    lines.append("  end subroutine " + name)
+    return lines
+
+
+def _cpu_time():
+    ''' return the user and system time in seconds used by this process and
+        by any child processes that it has waited for '''
+    times = os.times()
+    return times[0] + times[1] + times[2] + times[3]
+
+
+def _resident_memory():
+    ''' return the current resident set size of this process in kB, or
+        None if it is not available '''
+    try:
+        with open("/proc/self/statm") as statm:
+            pages = int(statm.read().split()[1])
+    except (IOError, OSError, IndexError, ValueError):
+        return None
+    return pages * os.sysconf("SC_PAGE_SIZE") // 1024
+
+
+class _Timer(object):
+    ''' records the wall time, cpu time and memory of named stages. The
+        resident memory is taken before and after each stage, and the peak
+        is that of the whole process so far, not of the stage alone. '''
+
+    def __init__(self):
+        self.stages = []
+
+    def time(self, name, function, *args):
+        ''' call function(*args), record its cost and return its result.
+            Anything the function prints is discarded. '''
+        from CodeAnalysis import _peak_memory
+        stdout = sys.stdout
+        memory_before = _resident_memory()
+        start_wall = time.time()
+        start_cpu = _cpu_time()
+        with open(os.devnull, "w") as devnull:
+            sys.stdout = devnull
+            try:
+                result = function(*args)
+            finally:
+                sys.stdout = stdout
+        self.stages.append(
+            {"stage": name,
+             "wall": time.time() - start_wall,
+             "cpu": _cpu_time() - start_cpu,
+             "memory_before_kb": memory_before,
+             "memory_after_kb": _resident_memory(),
+             "process_peak_memory_kb": _peak_memory()})
+        return result
+
+
+def run(directory, workers=None):
+    ''' Run the analysis pipeline over directory, timing each stage.
+
+    :param directory: the root of the Fortran tree.
+    :type directory: str.
+    :param workers: as for :func:`CodeAnalysis.CodeAnalysis.parse`. If more
+                    than one worker is used the parse and analyse stages
+                    are timed together as "parse+analyse".
+    :type workers: int.
+    :return: a list of maps, one per stage, with the wall and cpu time in
+             seconds, the resident memory in kB before and after the stage
+             and the peak memory in kB of the process once the stage
+             completes, along with the number of files found and parsed.
+    '''
+    from CodeAnalysis import CodeAnalysis, Stats, Link, File
+    timer = _Timer()
+    analysis = CodeAnalysis()
+    analysis.add_directory(directory)
+    paths = timer.time("discover", analysis.discover)
+
+    if workers is not None and workers > 1:
+        files = timer.time(
+            "parse+analyse",
+            lambda: list(CodeAnalysis._parse_files(paths, workers)))
+    else:
+        def parse():
+            files = []
+            for file_path in paths:
+                my_file = File()
+                my_file.parse(file_path)
+                files.append(my_file)
+            return files
+
+        def analyse(files):
+            for my_file in files:
+                if my_file.parsed_ok:
+                    my_file.analyse()
+
+        files = timer.time("parse", parse)
+        timer.time("analyse", analyse, files)
+    files = [my_file for my_file in files if my_file.parsed_ok]
+
+    stats = Stats()
+    timer.time("stats", stats.apply, files)
+    link = Link()
+    timer.time("link", link.transform, files)
+    with open(os.devnull, "w") as devnull:
+        timer.time("dot", link.dot, "", devnull)
+    return timer.stages, len(paths), len(files)
+
+
+def main(argv=None):
+    ''' generate and benchmark one synthetic tree per value of --files '''
+    import argparse
+    import json
+    import shutil
+    import tempfile
+    parser = argparse.ArgumentParser(
+        description="Benchmark the analysis pipeline on synthetic Fortran "
+        "trees.")
+    parser.add_argument("--files", type=int, nargs="+", default=[100],
+                        help="the number of files (one tree per value)")
+    parser.add_argument("--modules", type=int, default=2,
+                        help="the number of modules per file")
+    parser.add_argument("--subroutines", type=int, default=5,
+                        help="the number of subroutines per module")
+    parser.add_argument("--fan-out", type=int, default=2,
+                        help="the number of calls made by each subroutine")
+    parser.add_argument("--depth", type=int, default=4,
+                        help="the depth of the call tree")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--workers", type=int, default=None,
+                        help="the number of parsing processes")
+    parser.add_argument("--directory", default=None,
+                        help="where to generate the trees. The default is "
+                        "a temporary directory that is removed afterwards")
+    parser.add_argument("--output", default=None,
+                        help="the JSON results file (default stdout)")
+    args = parser.parse_args(argv)
+
+    import CodeAnalysis
+    results = {"python": sys.version.split()[0],
+               "fparser": CodeAnalysis._fparser_version(),
+               "runs": []}
+    root = args.directory
+    if root is None:
+        root = tempfile.mkdtemp(prefix="fanalyser_bench_")
+    try:
+        for n_files in args.files:
+            directory = os.path.join(root, "files_{0}".format(n_files))
+            if os.path.isdir(directory):
+                shutil.rmtree(directory)
+            corpus = generate_corpus(
+                directory, n_files=n_files, n_modules=args.modules,
+                n_subroutines=args.subroutines, fan_out=args.fan_out,
+                depth=args.depth, seed=args.seed)
+            stages, n_found, n_parsed = run(directory, args.workers)
+            results["runs"].append(
+                {"corpus": corpus,
+                 "parameters": {"files": n_files, "modules": args.modules,
+                                "subroutines": args.subroutines,
+                                "fan_out": args.fan_out,
+                                "depth": args.depth, "seed": args.seed,
+                                "workers": args.workers},
+                 "files_found": n_found,
+                 "files_parsed": n_parsed,
+                 "stages": stages})
+            sys.stderr.write("{0} files: {1}\n".format(n_files, ", ".join(
+                "{0} {1:.3f}s".format(stage["stage"], stage["wall"])
+                for stage in stages)))
+    finally:
+        if args.directory is None:
+            shutil.rmtree(root)
+
+    if args.output is None:
+        json.dump(results, sys.stdout, indent=2, sort_keys=True)
+        sys.stdout.write("\n")
+    else:
+        with open(args.output, "w") as output:
+            json.dump(results, output, indent=2, sort_keys=True)
+
+
+if __name__ == "__main__":
+    main()
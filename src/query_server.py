@@ -0,0 +1,368 @@
+# BSD 3-Clause License
+#
+# Copyright (c) 2017, Science and Technology Facilities Council
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# * Neither the name of the copyright holder nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+'''A query server for the Fortran Code Analyser. The server parses (or
+    loads from an :class:`CodeAnalysis.AnalysisDatabase`) and links a tree
+    once and keeps the result in memory. It answers dot, callers, callees,
+    unresolved and stats queries over HTTP on localhost, and it polls the
+    source directories so that changed, added and removed files are
+    re-analysed and re-linked in the background.
+
+    For example, to start a server and then query it:
+
+    $ python query_server.py serve /home/rupert/proj/nemo --port 8765 &
+    $ python query_server.py callers sbc --port 8765
+    $ python query_server.py dot sbc --port 8765 > sbc.dot
+    $ python query_server.py shutdown --port 8765
+
+    The server is unauthenticated: any process that can connect to the
+    port can query the tree or shut the server down. It listens on
+    localhost by default and should not be exposed more widely. Queries
+    are GET requests and, so that a plain link cannot stop the server,
+    shutdown is only accepted as a POST.
+
+'''
+import os
+import sys
+import json
+import threading
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from SocketServer import ThreadingMixIn
+from urlparse import urlparse, parse_qs
+
+from CodeAnalysis import CodeAnalysis, Link, Stats, AnalysisDatabase
+
+
+class QueryServer(object):
+    ''' Keeps a parsed and linked tree in memory and answers queries on it.
+        All queries and updates hold a lock, so a query always sees a
+        consistently linked tree.
+
+    :param code_analysis: the analysis holding the directories to serve.
+    :type code_analysis: :class:`CodeAnalysis.CodeAnalysis`
+    :param host: the address to listen on.
+    :type host: str.
+    :param port: the port to listen on.
+    :type port: int.
+    :param poll_interval: the number of seconds between checks for changed
+                          files. 'None' turns off the checks.
+    :type poll_interval: float.
+    :param database: an optional database to load the tree from, rather
+                     than parsing it. Files that have changed since the
+                     database was saved are re-analysed after it is
+                     loaded. If it does not exist the tree is parsed and
+                     then saved to it.
+    :type database: str.
+    :param workers: as for :func:`CodeAnalysis.CodeAnalysis.parse`.
+    :type workers: int.
+    :param cache: as for :func:`CodeAnalysis.CodeAnalysis.parse`.
+    :type cache: :class:`CodeAnalysis.ParseCache`
+    '''
+
+    def __init__(self, code_analysis, host="127.0.0.1", port=8765,
+                 poll_interval=2.0, database=None, workers=None, cache=None):
+        self._code_analysis = code_analysis
+        self._address = (host, port)
+        self._poll_interval = poll_interval
+        self._database = database
+        self._workers = workers
+        self._cache = cache
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._files = None
+        self._link = None
+        # path -> (mtime, size) of each file when it was last analysed
+        self._signatures = {}
+        self._n_updates = 0
+        # the summary of the stats query, until the tree changes
+        self._stats = None
+        self._http = None
+
+    def load(self):
+        ''' parse (or load) and link the tree '''
+        analysis = self._code_analysis
+        link = Link()
+        self._stats = None
+        signatures = None
+        if self._database is not None and os.path.exists(self._database):
+            database = AnalysisDatabase(self._database)
+            files = database.load(link)
+            analysis.set_files(files)
+            signatures = database.signatures()
+        else:
+            files = analysis.parse(workers=self._workers, cache=self._cache)
+            for my_file in files:
+                my_file.release()
+            link.transform(files)
+            if self._database is not None:
+                AnalysisDatabase(self._database).save(files, link)
+        self._files = files
+        self._link = link
+        if signatures is None:
+            self._signatures = self._scan_signatures()
+        else:
+            # re-analyse the files edited since the database was saved
+            self._signatures = signatures
+            self.check()
+
+    def _scan_signatures(self):
+        signatures = {}
+        for file_path in self._code_analysis.discover():
+            try:
+                info = os.stat(file_path)
+            except OSError:
+                continue
+            signatures[file_path] = (info.st_mtime, info.st_size)
+        return signatures
+
+    def check(self):
+        ''' Re-analyse any files that have been changed, added or removed
+            since the last check and return their paths. '''
+        signatures = self._scan_signatures()
+        changed = [file_path for file_path, signature in signatures.items()
+                   if self._signatures.get(file_path) != signature]
+        changed.extend(file_path for file_path in self._signatures
+                       if file_path not in signatures)
+        if changed:
+            changed.sort()
+            with self._lock:
+                self._code_analysis.update(changed, link=self._link,
+                                           workers=self._workers,
+                                           cache=self._cache)
+                for my_file in self._files:
+                    my_file.release()
+                self._stats = None
+                self._n_updates += 1
+        self._signatures = signatures
+        return changed
+
+    def _watch(self):
+        while not self._stop.wait(self._poll_interval):
+            try:
+                self.check()
+            except Exception as excinfo:
+                sys.stderr.write("query server: update failed: {0}\n".format(
+                    excinfo))
+
+    def serve_forever(self):
+        ''' load the tree and then answer queries until :func:`shutdown`
+            is called '''
+        if self._files is None:
+            self.load()
+        if self._poll_interval is not None:
+            watcher = threading.Thread(target=self._watch)
+            watcher.daemon = True
+            watcher.start()
+        self._http = _ThreadingHTTPServer(self._address, _Handler)
+        self._http.query_server = self
+        print "query server listening on {0}:{1}".format(
+            *self._http.server_address)
+        sys.stdout.flush()
+        try:
+            self._http.serve_forever()
+        finally:
+            self._stop.set()
+            self._http.server_close()
+
+    def shutdown(self):
+        ''' stop serving. This must be called from another thread. '''
+        self._stop.set()
+        if self._http is not None:
+            self._http.shutdown()
+
+    def query(self, command, name=None, transitive=True):
+        ''' Answer a query and return (content type, body).
+
+        :param command: one of "dot", "callers", "callees", "unresolved",
+                        "stats" or "status".
+        :type command: str.
+        :param name: the subroutine name for dot, callers and callees.
+        :type name: str.
+        :param transitive: for callers and callees, whether to include the
+                           indirect ones.
+        :type transitive: bool.
+        '''
+        with self._lock:
+            if command == "dot":
+                from StringIO import StringIO
+                stream = StringIO()
+                self._link.dot(name.lower() if name else "", stream)
+                return "text/vnd.graphviz", stream.getvalue()
+            if command in ["callers", "callees"]:
+                if not name:
+                    raise RuntimeError("a subroutine name is required")
+                graph = self._link.graph
+                if command == "callers":
+                    subroutines = graph.callers(name, transitive)
+                else:
+                    subroutines = graph.callees(name, transitive)
+                result = [_describe(subroutine) for subroutine in subroutines]
+            elif command == "unresolved":
+                result = [dict(_describe(call.caller), call=call.name,
+                               lines=list(call.lines))
+                          for call in self._link.unresolved()]
+            elif command == "stats":
+                if self._stats is None:
+                    stats = Stats()
+                    stats.apply(self._files, quiet=True)
+                    self._stats = stats.summary()
+                result = self._stats
+            elif command == "status":
+                result = {"files": len(self._files),
+                          "subroutines": len(self._link.graph),
+                          "call edges": self._link.graph.n_edges,
+                          "updates": self._n_updates}
+            else:
+                raise RuntimeError("unknown query '{0}'".format(command))
+        return "application/json", json.dumps(result, indent=1) + "\n"
+
+
+def _describe(subroutine):
+    return {"name": subroutine.name, "kind": subroutine.kind,
+            "module": subroutine.module, "start_line": subroutine.start_line}
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class _Handler(BaseHTTPRequestHandler):
+    ''' maps GET /<command>?name=<name>&transitive=0 onto
+        :func:`QueryServer.query` and POST /shutdown onto
+        :func:`QueryServer.shutdown` '''
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        command = url.path.strip("/")
+        parameters = parse_qs(url.query)
+        name = parameters.get("name", [None])[0]
+        transitive = parameters.get("transitive", ["1"])[0] != "0"
+        if command == "shutdown":
+            self._reply(405, "text/plain", "shutdown must be a POST\n")
+            return
+        try:
+            content_type, body = self.server.query_server.query(
+                command, name, transitive)
+        except RuntimeError as excinfo:
+            self._reply(400, "text/plain", str(excinfo) + "\n")
+            return
+        self._reply(200, content_type, body)
+
+    def do_POST(self):
+        if urlparse(self.path).path.strip("/") != "shutdown":
+            self._reply(405, "text/plain", "only shutdown is a POST\n")
+            return
+        self._reply(200, "text/plain", "shutting down\n")
+        threading.Thread(target=self.server.query_server.shutdown).start()
+
+    def _reply(self, status, content_type, body):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # keep the terminal for the analysis output
+        pass
+
+
+def request(command, name=None, transitive=True, host="127.0.0.1",
+            port=8765):
+    ''' send a query (or a shutdown, which is sent as a POST) to a running
+        server and return the body of the reply '''
+    import urllib
+    import urllib2
+    parameters = {}
+    if name is not None:
+        parameters["name"] = name
+    if not transitive:
+        parameters["transitive"] = "0"
+    url = "http://{0}:{1}/{2}".format(host, port, command)
+    if parameters:
+        url += "?" + urllib.urlencode(parameters)
+    data = "" if command == "shutdown" else None
+    try:
+        return urllib2.urlopen(url, data).read()
+    except urllib2.HTTPError as excinfo:
+        raise RuntimeError(excinfo.read().strip())
+
+
+def main(argv=None):
+    ''' the server and client command line '''
+    import argparse
+    parser = argparse.ArgumentParser(
+        description="Serve, or query, a resident call graph.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    commands = parser.add_subparsers(dest="command")
+    serve = commands.add_parser("serve", help="start a server")
+    serve.add_argument("directories", nargs="+")
+    serve.add_argument("--poll-interval", type=float, default=2.0,
+                       help="seconds between checks for changed files "
+                       "(0 turns the checks off)")
+    serve.add_argument("--database", default=None,
+                       help="load the analysis from (or save it to) this "
+                       "database")
+    serve.add_argument("--workers", type=int, default=None)
+    for command in ["dot", "callers", "callees"]:
+        query = commands.add_parser(command)
+        query.add_argument("name", nargs="?" if command == "dot" else None)
+        if command != "dot":
+            query.add_argument("--direct", action="store_true",
+                               help="only the direct " + command)
+    for command in ["unresolved", "stats", "status", "shutdown"]:
+        commands.add_parser(command)
+    args = parser.parse_args(argv)
+
+    if args.command == "serve":
+        analysis = CodeAnalysis()
+        for directory in args.directories:
+            analysis.add_directory(directory)
+        server = QueryServer(analysis, args.host, args.port,
+                             args.poll_interval or None, args.database,
+                             args.workers)
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        return
+    try:
+        sys.stdout.write(request(args.command, getattr(args, "name", None),
+                                 not getattr(args, "direct", False),
+                                 args.host, args.port))
+    except RuntimeError as excinfo:
+        print "RuntimeError: {0}".format(excinfo)
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
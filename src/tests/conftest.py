@@ -0,0 +1,113 @@
+# BSD 3-Clause License
+#
+# Copyright (c) 2017, Science and Technology Facilities Council
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# * Neither the name of the copyright holder nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+'''Shared set up for the Fortran Code Analyser tests. The analyser modules
+    live in the directory above this one, and most tests write a small
+    Fortran tree to a temporary directory and analyse it.
+
+'''
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))))
+
+
+def write_sources(tmpdir, sources):
+    ''' write each file name -> source pair in sources to tmpdir and return
+        the paths, sorted '''
+    paths = []
+    for name, source in sources.items():
+        path = tmpdir.join(name)
+        path.write(source, ensure=True)
+        paths.append(str(path))
+    return sorted(paths)
+
+
+def parse_files(paths):
+    ''' parse and analyse each path and return the released files '''
+    from CodeAnalysis import File
+    files = []
+    for path in paths:
+        my_file = File()
+        assert my_file.parse(path)
+        my_file.analyse()
+        my_file.release()
+        files.append(my_file)
+    return files
+
+
+def find_unit(files, name, module=None):
+    ''' return the unit called name (in module) from files '''
+    for my_file in files:
+        for unit in my_file.all_subroutines:
+            if unit.name.lower() == name and unit.module == module:
+                return unit
+    raise AssertionError("unit '{0}' not found".format(name))
+
+
+def link_summary(files, link):
+    ''' return a description of how the calls in files are linked that
+        does not depend on object identity or on the case of names: a
+        sorted list of (caller module, caller, called name, is reference,
+        lines, target module, target) with the targets None for unlinked
+        calls, and the sorted names of the unresolved and the ambiguous
+        calls '''
+    def lower(name):
+        return name.lower() if name is not None else None
+    calls = []
+    for my_file in files:
+        for unit in my_file.all_subroutines:
+            for call in unit.calls:
+                target = call.link
+                calls.append((lower(unit.module), unit.name.lower(),
+                              call.name.lower(), call.is_reference,
+                              list(call.lines),
+                              lower(target.module) if target else None,
+                              target.name.lower() if target else None))
+    return (sorted(calls),
+            sorted(call.name.lower() for call in link.unresolved()),
+            sorted(call.name.lower() for call in link.ambiguous()))
+
+
+def describe_files(files):
+    ''' return a description of the analysis of files that does not depend
+        on object identity, for comparing two analyses of the same files '''
+    return [(my_file.path, my_file.parsed_ok, my_file.failure,
+             list(my_file.statement_counts) if my_file.parsed_ok else None,
+             [(module.name, module.start_line, module.end_line,
+               list(module.uses)) for module in my_file.modules],
+             [(unit.kind, unit.name, unit.module, unit.start_line,
+               unit.end_line, list(unit.uses), list(unit.category_counts),
+               [(call.name, call.is_reference, list(call.lines))
+                for call in unit.calls])
+              for unit in my_file.all_subroutines])
+            for my_file in files]
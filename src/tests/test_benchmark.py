@@ -0,0 +1,66 @@
+# BSD 3-Clause License
+#
+# Copyright (c) 2017, Science and Technology Facilities Council
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# * Neither the name of the copyright holder nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+'''Smoke tests for the benchmark script on a small synthetic tree.'''
+import json
+import benchmark
+
+STAGES = ["discover", "parse", "analyse", "stats", "link", "dot"]
+
+
+def test_run(tmpdir):
+    ''' every stage of a serial run is timed over the whole corpus '''
+    directory = str(tmpdir.join("tree"))
+    corpus = benchmark.generate_corpus(directory, n_files=3, n_modules=2,
+                                       n_subroutines=2, depth=2)
+    assert corpus["files"] == 3
+    stages, n_found, n_parsed = benchmark.run(directory)
+    assert (n_found, n_parsed) == (3, 3)
+    assert [stage["stage"] for stage in stages] == STAGES
+    for stage in stages:
+        assert stage["wall"] >= 0 and stage["cpu"] >= 0
+        assert set(stage) == set(["stage", "wall", "cpu", "memory_before_kb",
+                                  "memory_after_kb",
+                                  "process_peak_memory_kb"])
+
+
+def test_main(tmpdir):
+    ''' main writes one run per --files value to the JSON output '''
+    output = str(tmpdir.join("results.json"))
+    benchmark.main(["--files", "2", "3", "--modules", "1",
+                    "--subroutines", "2", "--depth", "2",
+                    "--directory", str(tmpdir.join("trees")),
+                    "--output", output])
+    with open(output) as results_file:
+        results = json.load(results_file)
+    assert [run["files_parsed"] for run in results["runs"]] == [2, 3]
+    assert [stage["stage"] for stage in results["runs"][0]["stages"]] == \
+        STAGES
@@ -0,0 +1,100 @@
+# BSD 3-Clause License
+#
+# Copyright (c) 2017, Science and Technology Facilities Council
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# * Neither the name of the copyright holder nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+'''Tests for the persistent parse cache.'''
+from conftest import write_sources
+from CodeAnalysis import CodeAnalysis, Instrumentation, ParseCache
+
+SOURCES = {"a.f90": '''subroutine a(x)
+  real :: x
+  call b(x)
+end subroutine a
+''',
+           "b.f90": '''subroutine b(x)
+  real :: x
+  x = 2.0 * x
+end subroutine b
+'''}
+
+
+def test_cache_hits_recorded(tmpdir):
+    ''' files loaded from the cache are recorded per file, flagged as
+        cached, and are not counted as parsed '''
+    paths = write_sources(tmpdir.mkdir("src"), SOURCES)
+    cache = ParseCache(str(tmpdir.join("cache")))
+    parsed = list(CodeAnalysis._parse_files(paths, cache=cache))
+
+    instrumentation = Instrumentation(memory=False)
+    cached = list(CodeAnalysis._parse_files(paths, cache=cache,
+                                            instrumentation=instrumentation))
+    assert [my_file.path for my_file in cached] == paths
+    assert [record.path for record in instrumentation.files] == paths
+    for my_file, record in zip(parsed, instrumentation.files):
+        assert record.cached
+        assert record.parsed_ok
+        assert record.n_bytes == 0
+        assert record.n_statements == sum(my_file.statement_counts)
+    assert instrumentation.counters["cache hits"] == 2
+    assert "bytes read" not in instrumentation.counters
+    assert [stage.name for stage in instrumentation.stages] == ["cache"]
+
+
+def test_invalidate_removed_entry(tmpdir, monkeypatch):
+    ''' invalidating entries that another process has already removed is
+        not an error '''
+    paths = write_sources(tmpdir.mkdir("src"), SOURCES)
+    cache = ParseCache(str(tmpdir.join("cache")))
+    list(CodeAnalysis._parse_files(paths, cache=cache))
+    entries = cache._entries()
+    assert len(entries) == 2
+    cache.invalidate(paths[0])
+    cache.invalidate(paths[0])
+    # the entry listing is taken before another process clears the cache
+    monkeypatch.setattr(cache, "_entries", lambda: entries)
+    cache.invalidate()
+    monkeypatch.undo()
+    assert cache._entries() == []
+    assert cache.get(paths[1]) is None
+
+
+def test_broken_link_not_cached(tmpdir):
+    ''' a file that can not be read is reported as failed and is not
+        cached, rather than stopping the parse '''
+    source = tmpdir.mkdir("src")
+    write_sources(source, SOURCES)
+    source.join("gone.f90").mksymlinkto(source.join("missing.f90"))
+    cache = ParseCache(str(tmpdir.join("cache")))
+    analysis = CodeAnalysis()
+    analysis.add_directory(str(source))
+    files = analysis.parse(cache=cache)
+    assert sorted(my_file.path.split("/")[-1] for my_file in files) == \
+        ["a.f90", "b.f90"]
+    assert len(cache._entries()) == 2
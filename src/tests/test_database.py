@@ -0,0 +1,97 @@
+# BSD 3-Clause License
+#
+# Copyright (c) 2017, Science and Technology Facilities Council
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# * Neither the name of the copyright holder nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+'''Tests for saving analysed files to, and loading them from, an
+    AnalysisDatabase.'''
+from conftest import write_sources, parse_files, link_summary
+from CodeAnalysis import AnalysisDatabase, Link
+
+SOURCES = {
+    "ma.f90": '''module ma
+  use mb
+contains
+  subroutine s1(x)
+    real :: x(10)
+    integer :: i
+    ! a comment
+    do i = 1, 10
+      x(i) = twice(x(i))
+    end do
+    call s2(x)
+    call s2(x)
+    call missing(x)
+  end subroutine s1
+  real function twice(y)
+    real :: y
+    twice = 2.0 * y
+  end function twice
+end module ma
+''',
+    "mb.f90": '''module mb
+end module mb
+''',
+    "s2.f90": '''subroutine s2(x)
+  real :: x(10)
+end subroutine s2
+''',
+    "s2_again.f90": '''subroutine s2(x)
+  real :: x(10)
+end subroutine s2
+''',
+    "empty.f90": "\n"}
+
+
+def _describe(files):
+    return [(my_file.path, my_file.parsed_ok, my_file.is_empty,
+             my_file.n_lines, list(my_file.statement_counts),
+             [(module.name, module.start_line, module.end_line,
+               sorted(module.uses)) for module in my_file.modules],
+             [(unit.kind, unit.name, unit.module, unit.start_line,
+               unit.end_line, sorted(unit.uses), list(unit.category_counts))
+              for unit in my_file.all_subroutines])
+            for my_file in files]
+
+
+def test_round_trip(tmpdir):
+    ''' the files, and how they are linked, are the same after being saved
+        and loaded again '''
+    files = parse_files(write_sources(tmpdir.mkdir("src"), SOURCES))
+    link = Link()
+    link.transform(files)
+    database = AnalysisDatabase(str(tmpdir.join("analysis.db")))
+    database.save(files, link)
+
+    loaded_link = Link()
+    loaded = database.load(loaded_link)
+    assert _describe(loaded) == _describe(files)
+    summary = link_summary(loaded, loaded_link)
+    assert summary == link_summary(files, link)
+    assert summary[1:] == (["missing"], ["s2"])
@@ -0,0 +1,90 @@
+# BSD 3-Clause License
+#
+# Copyright (c) 2017, Science and Technology Facilities Council
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# * Neither the name of the copyright holder nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+'''Tests for parsing each unique source only once.'''
+import os
+from conftest import write_sources, find_unit
+from CodeAnalysis import CodeAnalysis, Link
+
+SOURCES = {
+    "d1/a.f90": '''subroutine a(x)
+  real :: x
+  call b(x)
+end subroutine a
+''',
+    "d1/b.f90": '''subroutine b(x)
+  real :: x
+  x = 2.0 * x
+end subroutine b
+''',
+    "d2/c.f90": '''subroutine c(x)
+  real :: x
+  call a(x)
+end subroutine c
+'''}
+
+
+def _parse(*directories):
+    analysis = CodeAnalysis(dedup=True)
+    for directory in directories:
+        analysis.add_directory(str(directory))
+    files = analysis.parse()
+    link = Link()
+    link.transform(files)
+    return files, link
+
+
+def test_overlapping_directories(tmpdir):
+    ''' a file reached through overlapping directories or a symbolic link
+        is analysed once '''
+    write_sources(tmpdir, SOURCES)
+    tmpdir.join("link.f90").mksymlinkto(tmpdir.join("d1", "a.f90"))
+    files, link = _parse(tmpdir, tmpdir.join("d1"))
+    # which path is kept depends on the order the directories are walked
+    assert sorted(os.path.relpath(os.path.realpath(my_file.path),
+                                  os.path.realpath(str(tmpdir)))
+                  for my_file in files) == ["d1/a.f90", "d1/b.f90",
+                                            "d2/c.f90"]
+    assert not link.ambiguous()
+    assert not link.unresolved()
+
+
+def test_identical_content_copied(tmpdir):
+    ''' a different file with the same content as one already analysed
+        is given a copy of its analysis '''
+    write_sources(tmpdir.mkdir("v1"), SOURCES)
+    write_sources(tmpdir.mkdir("v2"), {"d1/b.f90": SOURCES["d1/b.f90"]})
+    files, _ = _parse(tmpdir.join("v1"), tmpdir.join("v2"))
+    assert len(files) == 4
+    copy = files[-1]
+    assert copy.path == str(tmpdir.join("v2", "d1", "b.f90"))
+    assert [unit.name for unit in copy.all_subroutines] == ["b"]
+    assert find_unit(files[:-1], "b") is not find_unit([copy], "b")
@@ -0,0 +1,128 @@
+# BSD 3-Clause License
+#
+# Copyright (c) 2017, Science and Technology Facilities Council
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# * Neither the name of the copyright holder nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+'''Tests for the comparison of two analysed versions of a code.'''
+from conftest import write_sources, parse_files
+import CodeAnalysis
+from CodeAnalysis import AnalysisDiff, Link
+
+OLD = {"a.f90": '''subroutine a(x)
+  real :: x
+  call b(x)
+end subroutine a
+''',
+       "b.f90": '''subroutine b(x)
+  real :: x
+  x = 2.0 * x
+end subroutine b
+'''}
+
+NEW = dict(OLD)
+NEW["a.f90"] = '''subroutine a(x)
+  real :: x
+  call b(x)
+  call b(x)
+end subroutine a
+'''
+
+
+def test_diff_is_quiet(tmpdir, capsys):
+    ''' comparing two versions prints nothing, the stats of each version
+        are worked out quietly '''
+    old_files = parse_files(write_sources(tmpdir.mkdir("old"), OLD))
+    new_files = parse_files(write_sources(tmpdir.mkdir("new"), NEW))
+    Link().transform(old_files)
+    Link().transform(new_files)
+    capsys.readouterr()
+    diff = AnalysisDiff(old_files, new_files)
+    assert capsys.readouterr().out == ""
+    assert diff.changed == ["a"]
+
+
+TREE = {"ma.f90": '''module ma
+contains
+  subroutine init
+  end subroutine init
+end module ma
+''',
+        "c.f90": '''subroutine c
+  use ma
+  call d
+end subroutine c
+''',
+        "d.f90": '''subroutine d
+end subroutine d
+''',
+        "e.f90": '''subroutine e
+  call init
+end subroutine e
+'''}
+
+# ma gains a d, so the call in the unchanged c.f90 is rewired to it
+MA = '''module ma
+contains
+  subroutine init
+  end subroutine init
+  subroutine d
+  end subroutine d
+end module ma
+'''
+
+
+def test_unchanged_files_skipped(tmpdir, monkeypatch):
+    ''' given the file signatures only the units of changed files, and
+        those whose calls may be linked differently, are hashed, and the
+        diff is the same as that of the whole analyses '''
+    paths = write_sources(tmpdir, TREE)
+    old_files = parse_files(paths)
+    Link().transform(old_files)
+    tmpdir.join("ma.f90").write(MA)
+    new_files = parse_files(paths)
+    Link().transform(new_files)
+    full = AnalysisDiff(old_files, new_files).summary()
+    assert full["calls"]["rewired"] == [("c", "d", "d", "ma.d")]
+
+    hashed = []
+    signature = CodeAnalysis._DiffSide.signature
+
+    def recording_signature(side, key):
+        hashed.append(key[2])
+        return signature(side, key)
+
+    monkeypatch.setattr(CodeAnalysis._DiffSide, "signature",
+                        recording_signature)
+    old_signatures = dict((path, (1.0, 10)) for path in paths)
+    new_signatures = dict(old_signatures)
+    new_signatures[str(tmpdir.join("ma.f90"))] = (2.0, 20)
+    diff = AnalysisDiff(old_files, new_files, old_signatures,
+                        new_signatures)
+    assert diff.summary() == full
+    assert sorted(set(hashed)) == ["c", "e", "init"]
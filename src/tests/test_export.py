@@ -0,0 +1,100 @@
+# BSD 3-Clause License
+#
+# Copyright (c) 2017, Science and Technology Facilities Council
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# * Neither the name of the copyright holder nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+'''Tests for writing the call graph in the supported formats.'''
+from StringIO import StringIO
+from conftest import write_sources, parse_files
+from CodeAnalysis import Link, DotExporter, EdgeListExporter
+
+SOURCES = {
+    "m.f90": '''module ma
+contains
+  subroutine graph
+    call ext
+  end subroutine graph
+  subroutine ext
+  end subroutine ext
+end module ma
+module mb
+contains
+  subroutine ext
+  end subroutine ext
+end module mb
+'''}
+
+
+def test_dot_ids_are_quoted(tmpdir):
+    ''' qualified names and dot keywords are written as quoted IDs '''
+    files = parse_files(write_sources(tmpdir, SOURCES))
+    link = Link()
+    link.transform(files)
+    stream = StringIO()
+    DotExporter().write(link.graph, stream)
+    assert stream.getvalue().splitlines() == [
+        'digraph G {', '"graph";', '"ma.ext";', '"mb.ext";',
+        '"graph" -> "ma.ext";', '}']
+
+
+CLASHES = {
+    "a.f90": '''subroutine init
+  call run
+contains
+  subroutine setup
+  end subroutine setup
+end subroutine init
+subroutine run
+contains
+  subroutine setup
+  end subroutine setup
+end subroutine run
+''',
+    "b.f90": '''subroutine init
+  call run
+end subroutine init
+'''}
+
+
+def test_labels_are_unique(tmpdir):
+    ''' units outside any module that share a name are told apart by
+        their file and then by their order, so each node and edge is kept '''
+    paths = write_sources(tmpdir, CLASHES)
+    files = parse_files(paths)
+    link = Link()
+    link.transform(files)
+    init_a, init_b = ["init ({0})".format(path) for path in paths]
+    labels = EdgeListExporter.labels(link.graph, range(len(link.graph)))
+    assert [labels[node] for node in range(len(link.graph))] == [
+        init_a, "setup ({0})#1".format(paths[0]), "run",
+        "setup ({0})#2".format(paths[0]), init_b]
+    stream = StringIO()
+    EdgeListExporter().write(link.graph, stream)
+    assert stream.getvalue().splitlines() == [
+        "caller,callee,calls", init_a + ",run,1", init_b + ",run,1"]
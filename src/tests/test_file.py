@@ -0,0 +1,182 @@
+# BSD 3-Clause License
+#
+# Copyright (c) 2017, Science and Technology Facilities Council
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# * Neither the name of the copyright holder nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+'''Tests for the parsing and analysis of single files.'''
+import pytest
+from conftest import write_sources, describe_files
+from CodeAnalysis import File, _source_info
+
+FIXED = '''C     A fixed form file
+      SUBROUTINE F1(A, N)
+      INTEGER N
+      REAL A(N)
+C     scale
+      DO 10 I = 1, N
+         A(I) = 2.0 * A(I)
+ 10   CONTINUE
+      CALL F2(A)
+      END
+'''
+
+FREE = '''module m
+contains
+  subroutine s(a, n)
+    integer :: n
+    real :: a(n)
+    ! scale
+    a = 2.0 * a
+    call t(a)
+  end subroutine s
+end module m
+'''
+
+# a module with a module procedure holding a loop and an internal
+# subroutine, a module function and a subroutine outside the module
+MODULE = """module m
+  use n
+  implicit none
+contains
+  subroutine s(a, n)
+    use o
+    integer :: n
+    real :: a(n)
+    integer :: i
+    ! a comment
+    do i = 1, n
+      a(i) = f(a(i))
+      call t(a)
+    end do
+    call t(a)
+  contains
+    subroutine inner
+      call u
+    end subroutine inner
+  end subroutine s
+  real function f(x)
+    real :: x
+    f = 2.0 * x
+  end function f
+end module m
+subroutine ext
+  call s2
+end subroutine ext
+"""
+
+
+@pytest.mark.parametrize("name,source", [
+    ("f1.f", FIXED), ("f1.F", FIXED), ("f1.for", FIXED), ("f2.f90", FREE),
+    ("f3.f90", FIXED), ("f4.f", FREE), ("f5.f", "! -*- f90 -*-\n" + FREE),
+    ("f6.f90", "C -*- fix -*-\n" + FIXED),
+    ("f7.f90", "C -*- fortran -*-\n" + FIXED),
+    ("f8.f", "! -*- pyf -*-\n" + FREE), ("f9.pyf", FREE),
+    ("f10.f90", "\n! -*- f90 -*-\n" + FIXED), ("f11.f90", ""),
+    ("f12.f90", "x = 1 + &\n    2\n")])
+def test_source_info(tmpdir, name, source):
+    ''' the form worked out from the source, using only the public
+        fparser interface, is the one fparser works out from the file '''
+    from fparser import sourceinfo
+    path, = write_sources(tmpdir, {name: source})
+    assert _source_info(path, source) == sourceinfo.get_source_info(path)
+
+
+@pytest.mark.parametrize("name,source", [("f1.f", FIXED), ("f2.f90", FREE)])
+def test_parse_source(tmpdir, name, source):
+    ''' parsing from source in memory gives the same analysis as parsing
+        the file '''
+    path, = write_sources(tmpdir, {name: source})
+    from_file = File()
+    assert from_file.parse(path)
+    from_file.analyse()
+    from_source = File()
+    assert from_source.parse(path, source)
+    from_source.analyse()
+    assert list(from_source.statement_counts) == \
+        list(from_file.statement_counts)
+    assert [unit.name for unit in from_source.all_subroutines] == \
+        [unit.name for unit in from_file.all_subroutines]
+
+
+def test_analysis(tmpdir):
+    ''' the units, USEs, calls, loops and statement categories found in a
+        single pass over the ast '''
+    path, = write_sources(tmpdir, {"m.f90": MODULE})
+    my_file = File()
+    assert my_file.parse(path)
+    my_file.analyse()
+    assert my_file.n_lines == 28
+    assert not my_file.is_empty
+    module, = my_file.modules
+    assert (module.name, module.start_line, module.end_line, module.uses) \
+        == ("m", 1, 25, ["n"])
+    # comments, declarations, code statements and other statements;
+    # a module counts everything that it contains
+    assert list(module.category_counts) == [1, 5, 19, 0]
+    units = [(unit.kind, unit.name, unit.module, unit.start_line,
+              unit.end_line, unit.uses, list(unit.category_counts),
+              [(call.name, call.is_reference, list(call.lines))
+               for call in unit.calls])
+             for unit in my_file.all_subroutines]
+    assert units == [
+        ("subroutine", "ext", None, 26, 28, [], [0, 0, 3, 0],
+         [("s2", False, [27])]),
+        ("subroutine", "s", "m", 5, 20, ["o"], [1, 3, 9, 0],
+         [("f", True, [12]), ("t", False, [13, 15])]),
+        # an internal subroutine sees the USEs of its host
+        ("subroutine", "inner", "m", 17, 19, ["o"], [0, 0, 3, 0],
+         [("u", False, [18])]),
+        ("function", "f", "m", 21, 24, [], [0, 1, 3, 0], [])]
+    loop, = my_file.all_subroutines[1].loops
+    assert (loop.variable, loop.start_line, loop.end_line, loop.calls,
+            loop.references, loop.arrays) == ("i", 11, 14, ["t"], ["f"],
+                                              ["a"])
+
+
+@pytest.mark.parametrize("protocol", [0, 2])
+def test_compact_pickle(tmpdir, protocol):
+    ''' the analysis objects have no per-object dict and a released file
+        pickles (as it does for the workers and the cache) without losing
+        anything, with its names interned again '''
+    import cPickle
+    path, = write_sources(tmpdir, {"m.f90": MODULE})
+    my_file = File()
+    assert my_file.parse(path)
+    my_file.analyse()
+    my_file.release()
+    unit = my_file.all_subroutines[1]
+    for compact in [unit, unit.calls[0], unit.loops[0]]:
+        assert not hasattr(compact, "__dict__")
+    copy = cPickle.loads(cPickle.dumps(my_file, protocol))
+    assert describe_files([copy]) == describe_files([my_file])
+    copy_unit = copy.all_subroutines[1]
+    assert copy_unit.name is intern("s")
+    assert copy_unit.calls[1].name is intern("t")
+    assert copy_unit.calls[0].caller is copy_unit
+    assert copy_unit.loops[0].arrays == ["a"]
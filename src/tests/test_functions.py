@@ -0,0 +1,139 @@
+# BSD 3-Clause License
+#
+# Copyright (c) 2017, Science and Technology Facilities Council
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# * Neither the name of the copyright holder nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+'''Tests for functions, main programs and block data, and for telling a
+    function reference apart from an array element or an intrinsic.'''
+import pytest
+from conftest import write_sources, parse_files, find_unit, link_summary
+from CodeAnalysis import Link, Subroutine, Function, Program, BlockData, \
+    _function_references, _declared_names
+
+SOURCES = {
+    "m.f90": '''module m
+  implicit none
+contains
+  real function twice(x)
+    real, intent(in) :: x
+    twice = 2.0 * x
+  end function twice
+  subroutine work(n, a)
+    integer, intent(in) :: n
+    real, intent(inout) :: a(n)
+    real :: b(3)
+    integer :: i
+    do i = 1, n
+      a(i) = twice(a(i)) + scale(a(i), 2) + sqrt(b(1))
+    end do
+    b(2) = twice(1.0)
+    if (twice(b(1)) > 0.0) call helper(b(1))
+  end subroutine work
+  subroutine helper(x)
+    real :: x
+    x = lookup(3) + x
+  end subroutine helper
+end module m
+''',
+    "lookup.f90": '''subroutine lookup(k)
+  integer :: k
+end subroutine lookup
+''',
+    "main.f90": '''program main
+  use m
+  real :: a(4)
+  a = 1.0
+  call work(4, a)
+  print *, twice(a(1))
+end program main
+''',
+    "block.f90": '''block data init
+  common /c/ v
+  real :: v
+  data v /1.0/
+end block data init
+'''}
+
+
+def test_unit_kinds(tmpdir):
+    ''' functions, main programs and block data get their own classes '''
+    files = parse_files(write_sources(tmpdir, SOURCES))
+    assert [(type(unit), unit.kind, unit.name, unit.module)
+            for my_file in files for unit in my_file.all_subroutines] == [
+                (BlockData, "block data", "init", None),
+                (Subroutine, "subroutine", "lookup", None),
+                (Function, "function", "twice", "m"),
+                (Subroutine, "subroutine", "work", "m"),
+                (Subroutine, "subroutine", "helper", "m"),
+                (Program, "program", "main", None)]
+
+
+def test_references_linked(tmpdir):
+    ''' function references link only to functions and CALLs only to
+        subroutines. Array elements and intrinsics are not references, and
+        a reference that matches no function is not unresolved. '''
+    files = parse_files(write_sources(tmpdir, SOURCES))
+    link = Link()
+    link.transform(files)
+    assert link_summary(files, link) == (
+        [(None, "main", "twice", True, [6], "m", "twice"),
+         (None, "main", "work", False, [5], "m", "work"),
+         ("m", "helper", "lookup", True, [21], None, None),
+         ("m", "work", "helper", False, [17], "m", "helper"),
+         ("m", "work", "twice", True, [14, 16, 17], "m", "twice")],
+        [], [])
+    assert not find_unit(files, "lookup").link_calls
+
+
+@pytest.mark.parametrize("statement, declared, names", [
+    ("a(i) = twice(a(i)) + scale(a(i), 2)", ["a"], ["twice"]),
+    ("x = f(1)", [], ["f"]),
+    ("a(2) = 1.0", [], []),
+    ("call s(g(1), h)", [], ["g"]),
+    ("if (f(x) > 0) y(1) = g(2)", [], ["f", "g"]),
+    ("if (g(x) .eq. 1) then", [], ["g"]),
+    ("s = 'f(1)' // c(2)", ["c"], []),
+    ("x = a%b(1)", [], []),
+    ("x = sqrt(max(y, 0.0))", [], [])])
+def test_function_references(statement, declared, names):
+    ''' the names in a statement that may be function references '''
+    assert _function_references(statement, declared) == names
+
+
+@pytest.mark.parametrize("statement, names", [
+    ("real, intent(in) :: x(3), y", ["x", "y"]),
+    ("real*8 a(3), b", ["a", "b"]),
+    ("character(len=*) s", ["s"]),
+    ("common /c/ u, v(2)", ["u", "v"]),
+    ("dimension w(10)", ["w"]),
+    ("call s(x)", None)])
+def test_declared_names(statement, names):
+    ''' the variables declared by a statement, which are array elements
+        rather than function references when followed by "(" '''
+    assert _declared_names(statement) == names
@@ -0,0 +1,148 @@
+# BSD 3-Clause License
+#
+# Copyright (c) 2017, Science and Technology Facilities Council
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# * Neither the name of the copyright holder nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+'''Tests for the CSR call graph engine and its traversals.'''
+import sys
+from conftest import write_sources, parse_files
+from CodeAnalysis import Link, Scanner
+
+SOURCES = {
+    "main.f90": '''program main
+  call a
+  call a
+  call lone_caller
+end program main
+''',
+    "cycle.f90": '''subroutine a
+  call b
+  call b
+end subroutine a
+subroutine b
+  call c
+end subroutine b
+subroutine c
+  call a
+  call r
+end subroutine c
+''',
+    "other.f90": '''subroutine r
+  call r
+end subroutine r
+subroutine lone
+end subroutine lone
+'''}
+
+
+def _graph(tmpdir):
+    files = parse_files(write_sources(tmpdir, SOURCES))
+    link = Link()
+    link.transform(files)
+    return link.graph
+
+
+def _names(graph, nodes):
+    return [graph.subroutine(node).name for node in nodes]
+
+
+def test_edges(tmpdir):
+    ''' each unique edge is held once, weighted by its call sites, in both
+        directions '''
+    graph = _graph(tmpdir)
+    edges = sorted((graph.subroutine(caller).name,
+                    graph.subroutine(callee).name, weight)
+                   for caller, callee, weight in graph.edges())
+    assert edges == [("a", "b", 2), ("b", "c", 1), ("c", "a", 1),
+                     ("c", "r", 1), ("main", "a", 2), ("r", "r", 1)]
+    assert graph.n_edges == 6
+    a_node, = graph.node_ids("a")
+    assert sorted(_names(graph, graph.successors(a_node, reverse=True))) \
+        == ["c", "main"]
+    # the results are in node (file) order
+    assert [sub.name for sub in graph.callers("a", transitive=False)] == \
+        ["c", "main"]
+
+
+def test_cycles(tmpdir):
+    ''' mutual and self recursion are found and the components are in
+        reverse topological order '''
+    graph = _graph(tmpdir)
+    components = [sorted(_names(graph, component))
+                  for component in graph.strongly_connected_components()]
+    assert sorted(components) == [["a", "b", "c"], ["lone"], ["main"],
+                                  ["r"]]
+    assert components.index(["r"]) < components.index(["a", "b", "c"]) < \
+        components.index(["main"])
+    assert sorted([sub.name for sub in group]
+                  for group in graph.recursion()) == [["a", "b", "c"],
+                                                      ["r"]]
+    # a cycle's members are their own (transitive) callees
+    assert sorted(sub.name for sub in graph.callees("a")) == \
+        ["a", "b", "c", "r"]
+
+
+def test_disconnected(tmpdir):
+    ''' a unit nobody calls, and that calls nothing, is reached only from
+        itself '''
+    graph = _graph(tmpdir)
+    assert graph.callers("lone") == []
+    assert graph.callees("lone") == []
+    assert [depth for _, depth in graph.bfs("lone")] == [0]
+    assert graph.shortest_path("main", "lone") is None
+    assert [sub.name for sub in graph.shortest_path("main", "r")] == \
+        ["main", "a", "b", "c", "r"]
+    nodes, edges = graph.subgraph("main", max_depth=1)
+    assert _names(graph, nodes) == ["main", "a"]
+    assert len(edges) == 1
+
+
+def test_deep_chain(tmpdir):
+    ''' a chain of calls much deeper than the recursion limit is traversed
+        without recursion '''
+    depth = 3 * sys.getrecursionlimit()
+    lines = []
+    for idx in range(depth):
+        lines.extend(["subroutine s{0}".format(idx),
+                      "  call s{0}".format((idx + 1) % depth),
+                      "end subroutine s{0}".format(idx)])
+    path, = write_sources(tmpdir, {"chain.f90": "\n".join(lines) + "\n"})
+    files = [Scanner().scan(path)]
+    link = Link()
+    link.transform(files)
+    graph = link.graph
+    assert len(graph) == depth
+    assert len(graph.callees("s0")) == depth
+    assert [node_depth for _, node_depth in graph.bfs("s0")][-1] == depth - 1
+    assert [node_depth for _, node_depth in graph.dfs("s0")][-1] == depth - 1
+    assert len(graph.shortest_path("s0", "s{0}".format(depth - 1))) == depth
+    # the call from the last unit back to the first makes one component
+    components = graph.strongly_connected_components()
+    assert [len(component) for component in components] == [depth]
+    assert len(graph.recursion()) == 1
@@ -0,0 +1,114 @@
+# BSD 3-Clause License
+#
+# Copyright (c) 2017, Science and Technology Facilities Council
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# * Neither the name of the copyright holder nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+'''Tests for parsing files in isolated worker processes.'''
+import time
+import pytest
+from conftest import write_sources
+import CodeAnalysis
+from CodeAnalysis import _IsolatedParser, ParseCache
+
+SMALL = '''subroutine x{0}
+  call y
+end subroutine x{0}
+'''
+
+
+def _big_source(n_subroutines=3000):
+    ''' return a module that takes fparser a few seconds to parse '''
+    lines = ["module big", "contains"]
+    for idx in range(n_subroutines):
+        lines.extend(["  subroutine s{0}(a)".format(idx),
+                      "    real :: a(10)",
+                      "    a(1) = a(2) + {0}".format(idx),
+                      "    call t{0}(a)".format(idx),
+                      "  end subroutine s{0}".format(idx)])
+    lines.append("end module big")
+    return "\n".join(lines) + "\n"
+
+
+def test_timeout_kills_worker(tmpdir):
+    ''' a file that goes over the timeout fails with "timeout" and the
+        files after it are parsed by a replacement worker '''
+    sources = {"a_big.f90": _big_source()}
+    for idx in range(3):
+        sources["b{0}.f90".format(idx)] = SMALL.format(idx)
+    paths = write_sources(tmpdir, sources)
+    results = list(_IsolatedParser(workers=1, timeout=0.3).imap(paths))
+    assert [my_file.path for my_file in results] == paths
+    assert results[0].parsed_ok is False
+    assert results[0].failure == "timeout"
+    for my_file in results[1:]:
+        assert my_file.parsed_ok
+        assert [unit.name for unit in my_file.all_subroutines] == \
+            [my_file.path[-6:-4].replace("b", "x")]
+
+
+def test_timeout_excludes_start_up(tmpdir, monkeypatch):
+    ''' the time a worker takes to start up is not part of the timeout of
+        the file it is given '''
+    import os
+    statement_types = CodeAnalysis.statement_types
+    started = set()
+
+    def slow_statement_types():
+        # only the first call in each process is slow, as at start up
+        if os.getpid() not in started:
+            started.add(os.getpid())
+            time.sleep(1.0)
+        return statement_types()
+
+    # the workers are forked so they see the slow version
+    monkeypatch.setattr(CodeAnalysis, "statement_types",
+                        slow_statement_types)
+    started.add(os.getpid())
+    paths = write_sources(tmpdir, dict(("b{0}.f90".format(idx),
+                                        SMALL.format(idx))
+                                       for idx in range(2)))
+    results = list(_IsolatedParser(workers=2, timeout=0.5).imap(paths))
+    assert [my_file.parsed_ok for my_file in results] == [True, True]
+
+
+@pytest.mark.parametrize("limits,failures", [
+    ({"timeout": 0.3}, ["timeout"]),
+    # too little address space for the worker to parse anything, which
+    # fparser may also report as an error
+    ({"memory_limit": 50 * 1024 ** 2}, ["memory", "killed", "error"])])
+def test_limits_not_cached(tmpdir, limits, failures):
+    ''' a file that fails because of a time or memory limit is not cached,
+        so it is parsed again without the limit '''
+    paths = write_sources(tmpdir.mkdir("src"), {"a_big.f90": _big_source()})
+    cache = ParseCache(str(tmpdir.join("cache")))
+    my_file, = CodeAnalysis.CodeAnalysis._parse_files(paths, cache=cache,
+                                                      **limits)
+    assert my_file.failure in failures
+    assert cache._entries() == []
+    assert cache.get(paths[0]) is None
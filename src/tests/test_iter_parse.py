@@ -0,0 +1,61 @@
+# BSD 3-Clause License
+#
+# Copyright (c) 2017, Science and Technology Facilities Council
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# * Neither the name of the copyright holder nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+'''Tests for the streaming iter_parse.'''
+from conftest import write_sources, describe_files
+from test_file import MODULE
+from CodeAnalysis import CodeAnalysis
+
+
+def test_released_after_analysis(tmpdir):
+    ''' each file is yielded with its fparser ast released, is not kept by
+        the analysis, and has the same analysis as a full parse '''
+    write_sources(tmpdir, {"m.f90": MODULE,
+                           "bad.f90": "subroutine x(\n",
+                           "e.f90": "subroutine e\n  call ext\n"
+                                    "end subroutine e\n"})
+    analysis = CodeAnalysis()
+    analysis.add_directory(str(tmpdir))
+    files = list(analysis.iter_parse())
+    assert analysis._files == []
+    assert len(files) == 2
+    for my_file in files:
+        assert my_file._ast is None
+        for module in my_file.modules:
+            assert module._ast is None
+        for unit in my_file.all_subroutines:
+            assert unit._ast is None
+            for call in unit.calls:
+                assert call._stmt is None
+
+    parsed = CodeAnalysis()
+    parsed.add_directory(str(tmpdir))
+    assert describe_files(files) == describe_files(parsed.parse())
@@ -0,0 +1,92 @@
+# BSD 3-Clause License
+#
+# Copyright (c) 2017, Science and Technology Facilities Council
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# * Neither the name of the copyright holder nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+'''Tests for the lazy analysis driven by call tree queries.'''
+from conftest import write_sources, link_summary
+from CodeAnalysis import CodeAnalysis, Link
+
+SOURCES = {
+    "main.f90": '''program main
+  real :: x
+  call a(x)
+end program main
+''',
+    "a.f90": '''subroutine a(x)
+  real :: x
+  x = fb(x)
+end subroutine a
+''',
+    "fb.f90": '''real function fb(y)
+  real :: y
+  fb = 2.0 * y
+end function fb
+''',
+    "c.f90": '''subroutine c
+  call d
+end subroutine c
+''',
+    "d.f90": '''subroutine d
+end subroutine d
+'''}
+
+
+def _unit_names(files):
+    return sorted(unit.name for my_file in files
+                  for unit in my_file.all_subroutines)
+
+
+def test_query_parses_reached_files(tmpdir):
+    ''' a query only parses the files it reaches, each file is parsed
+        once, and the links match those of a full analysis '''
+    write_sources(tmpdir, SOURCES)
+    analysis = CodeAnalysis()
+    analysis.add_directory(str(tmpdir))
+    lazy = analysis.lazy()
+    files = lazy.files("main")
+    assert lazy.n_parsed == 3
+    assert _unit_names(files) == ["a", "fb", "main"]
+    # the parsed files have statement counts, the scanned ones none
+    assert all(sum(my_file.statement_counts) for my_file in files)
+    lazy_link = lazy.link("main")
+    assert lazy.n_parsed == 3
+
+    full = CodeAnalysis()
+    full.add_directory(str(tmpdir))
+    full_files = full.parse()
+    full_link = Link()
+    full_link.transform(full_files)
+    reached = [my_file for my_file in full_files
+               if _unit_names([my_file])[0] in ["a", "fb", "main"]]
+    assert link_summary(files, lazy_link)[0] == \
+        link_summary(reached, full_link)[0]
+
+    assert _unit_names(lazy.files("c")) == ["c", "d"]
+    assert lazy.n_parsed == 5
@@ -0,0 +1,181 @@
+# BSD 3-Clause License
+#
+# Copyright (c) 2017, Science and Technology Facilities Council
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# * Neither the name of the copyright holder nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+'''Tests for the linking of calls to the units that they call.'''
+from conftest import write_sources, parse_files, find_unit, link_summary
+from CodeAnalysis import CodeAnalysis, Link
+
+EXTERNAL = {
+    "ma.f90": '''module ma
+  interface
+    subroutine ext(x)
+      real :: x
+    end subroutine ext
+  end interface
+contains
+  subroutine s1(x)
+    real :: x
+    call ext(x)
+  end subroutine s1
+end module ma
+''',
+    "ext.f90": '''subroutine ext(x)
+  real :: x
+  x = 1.0
+end subroutine ext
+''',
+    "main.f90": '''program main
+  interface
+    subroutine ext(x)
+      real :: x
+    end subroutine ext
+  end interface
+  real :: y
+  call ext(y)
+end program main
+'''}
+
+
+def test_interface_bodies_are_not_definitions(tmpdir):
+    ''' a call to a procedure declared in an interface block is linked to
+        the procedure's real definition and is not ambiguous '''
+    files = parse_files(write_sources(tmpdir, EXTERNAL))
+    assert [unit.name for my_file in files
+            for unit in my_file.all_subroutines] == ["ext", "s1", "main"]
+    link = Link()
+    link.transform(files)
+    real = find_unit(files, "ext")
+    for caller in [find_unit(files, "s1", "ma"), find_unit(files, "main")]:
+        assert caller.calls[0].link is real
+    assert not link.ambiguous()
+    assert not link.unresolved()
+
+
+def test_interface_statements_are_counted(tmpdir):
+    ''' the statements in an interface block are still counted '''
+    files = parse_files(write_sources(tmpdir, {"ma.f90": EXTERNAL["ma.f90"]}))
+    # module, interface, subroutine, real, end subroutine, end interface,
+    # contains, subroutine, real, call, end subroutine, end module
+    assert sum(files[0].statement_counts) == 12
+
+
+SCOPES = {
+    "ma.f90": '''module ma
+contains
+  subroutine init()
+  end subroutine init
+  subroutine run()
+    call init()
+  end subroutine run
+end module ma
+''',
+    "mb.f90": '''module mb
+contains
+  subroutine init()
+  end subroutine init
+end module mb
+''',
+    "mc.f90": '''module mc
+  use mb
+end module mc
+''',
+    "init.f90": '''subroutine init()
+end subroutine init
+''',
+    "main.f90": '''program main
+  use mc
+  call init()
+  call helper()
+end program main
+''',
+    "helper.f90": '''subroutine helper()
+  call init()
+  call missing()
+end subroutine helper
+'''}
+
+
+def test_scope_resolution(tmpdir):
+    ''' a name defined more than once resolves to the definition in the
+        caller's module, then in a module it USEs (here through another
+        module), then outside any module '''
+    files = parse_files(write_sources(tmpdir, SCOPES))
+    link = Link()
+    link.transform(files)
+    assert find_unit(files, "run", "ma").calls[0].link is \
+        find_unit(files, "init", "ma")
+    assert find_unit(files, "main").calls[0].link is \
+        find_unit(files, "init", "mb")
+    assert find_unit(files, "helper").calls[0].link is \
+        find_unit(files, "init")
+    assert not link.ambiguous()
+    assert [call.name for call in link.unresolved()] == ["missing"]
+
+
+def test_update_matches_relink(tmpdir):
+    ''' re-linking only the changed files gives the same links as linking
+        the changed tree from scratch '''
+    write_sources(tmpdir, SCOPES)
+    analysis = CodeAnalysis()
+    analysis.add_directory(str(tmpdir))
+    link = Link()
+    link.transform(analysis.parse())
+
+    # missing is now defined, a second helper makes helper ambiguous and
+    # with mb gone main's init falls back to the one outside any module
+    changed = write_sources(tmpdir, {
+        "missing.f90": "subroutine missing()\nend subroutine missing\n",
+        "helper2.f90": "subroutine helper()\nend subroutine helper\n"})
+    tmpdir.join("mb.f90").remove()
+    changed.append(str(tmpdir.join("mb.f90")))
+    files = analysis.update(changed, link=link)
+
+    fresh = CodeAnalysis()
+    fresh.add_directory(str(tmpdir))
+    fresh_files = fresh.parse()
+    fresh_link = Link()
+    fresh_link.transform(fresh_files)
+    summary = link_summary(files, link)
+    assert summary == link_summary(fresh_files, fresh_link)
+    assert summary[1:] == ([], ["helper"])
+
+    # main is unchanged but, as mc now USEs ma, it sees ma's init
+    changed = write_sources(tmpdir, {
+        "mc.f90": "module mc\n  use ma\nend module mc\n"})
+    files = analysis.update(changed, link=link)
+    fresh = CodeAnalysis()
+    fresh.add_directory(str(tmpdir))
+    fresh_files = fresh.parse()
+    fresh_link = Link()
+    fresh_link.transform(fresh_files)
+    assert link_summary(files, link) == link_summary(fresh_files, fresh_link)
+    assert find_unit(files, "main").calls[0].link is \
+        find_unit(files, "init", "ma")
@@ -0,0 +1,192 @@
+# BSD 3-Clause License
+#
+# Copyright (c) 2017, Science and Technology Facilities Council
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# * Neither the name of the copyright holder nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+'''Tests for the DO loop nests and the parallelisation candidates.'''
+import pytest
+from conftest import write_sources, parse_files, find_unit
+from CodeAnalysis import File, Link, LoopNests
+
+GRID = {
+    "grid.f90": '''module grid
+  real, allocatable :: e1t(:,:), tmask(:,:,:)
+contains
+  real function stretch(x)
+    real, intent(in) :: x
+    stretch = 2.0 * x
+  end function stretch
+end module grid
+''',
+    "work.f90": '''module work
+contains
+  subroutine area(a, n, m, l)
+    use grid
+    integer :: n, m, l, i, j, k
+    real :: a(n, m, l)
+    do k = 1, l
+      do j = 1, m
+        do i = 1, n
+          a(i, j, k) = e1t(i, j) * tmask(i, j, k)
+        end do
+      end do
+    end do
+    do j = 1, m
+      do i = 1, n
+        a(i, j, 1) = stretch(e1t(i, j))
+      end do
+    end do
+    !$omp parallel do
+    do k = 1, l
+      a(:, :, k) = 0.0
+    end do
+    do i = 1, n
+      call flush(a)
+    end do
+  end subroutine area
+end module work
+'''}
+
+
+def _nests(tmpdir, sources):
+    files = parse_files(write_sources(tmpdir, sources))
+    Link().transform(files)
+    nests = LoopNests()
+    nests.apply(files)
+    return files, nests
+
+
+def test_loops(tmpdir):
+    ''' the loop nests are found with their depths, bounds and
+        directives '''
+    files, _ = _nests(tmpdir, GRID)
+    loops = find_unit(files, "area", "work").loops
+    assert [loop.nest_depth for loop in loops] == [3, 2, 1, 1]
+    assert [(loop.variable, loop.bounds) for loop in loops[0].walk()] == \
+        [("k", "1, l"), ("j", "1, m"), ("i", "1, n")]
+    assert loops[0].is_perfect
+    assert [loop.directives for loop in loops] == \
+        [[], [], ["!$omp parallel do"], []]
+    assert loops[3].calls == ["flush"]
+
+
+def test_used_arrays_are_not_calls(tmpdir):
+    ''' arrays from a USEd module are arrays, and only references that
+        are linked to a function are calls '''
+    files, nests = _nests(tmpdir, GRID)
+    unit = find_unit(files, "area", "work")
+    first, second = unit.loops[:2]
+    assert nests.calls(unit, first) == []
+    assert nests.arrays(unit, first) == ["a", "e1t", "tmask"]
+    assert nests.calls(unit, second) == ["stretch"]
+    assert nests.arrays(unit, second) == ["a", "e1t"]
+
+
+def test_candidates(tmpdir):
+    ''' only the call and directive free nests are candidates, deepest
+        first '''
+    files, nests = _nests(tmpdir, GRID)
+    candidates = nests.candidates()
+    assert [(loop.start_line, loop.nest_depth)
+            for _, _, loop in candidates] == [(7, 3)]
+    assert nests.report()[0][-1] == ["a", "e1t", "tmask"]
+
+
+def test_breakdown_calls(tmpdir):
+    ''' the calls in the stats breakdown are the CALL sites and the linked
+        function references, not the array elements '''
+    from CodeAnalysis import Stats
+    files, _ = _nests(tmpdir, GRID)
+    stats = Stats()
+    stats.apply(files)
+    rows = dict((row[0], row[-1]) for row in stats.breakdown("subroutine"))
+    assert rows["area"] == 2
+
+
+FIXED = '''      SUBROUTINE W(A, N)
+      INTEGER N, I, J
+      REAL A(N, N)
+C$OMP PARALLEL DO
+C$OMP+PRIVATE(I)
+      DO 20 J = 1, N
+!$OMP SIMD
+         DO 10 I = 1, N
+            A(I, J) = 0.0
+ 10      CONTINUE
+ 20   CONTINUE
+C$OMP END PARALLEL DO
+*$ACC KERNELS
+      DO 30 I = 1, N
+         A(I, 1) = 1.0
+ 30   CONTINUE
+C     not a directive
+      DO 40 I = 1, N
+         A(I, 2) = 1.0
+ 40   CONTINUE
+      END
+'''
+
+
+def test_fixed_form_directives(tmpdir):
+    ''' the directives in fixed form files, which fparser drops, are read
+        from the source '''
+    files, nests = _nests(tmpdir, {"w.f": FIXED})
+    loops = [loop for nest in files[0].all_subroutines[0].loops
+             for loop in nest.walk()]
+    assert [(loop.start_line, loop.directives) for loop in loops] == [
+        (6, ["!$OMP PARALLEL DO PRIVATE(I)", "!$OMP SIMD"]),
+        (8, ["!$OMP SIMD"]), (14, ["!$ACC KERNELS"]), (18, [])]
+    assert [loop.start_line for _, _, loop in nests.candidates()] == [18]
+
+
+def test_fixed_form_read_once(tmpdir, monkeypatch):
+    ''' a fixed form file is read once for both fparser and its
+        directives, and a problem with the directives is not taken for a
+        failure to parse '''
+    import __builtin__
+    import CodeAnalysis
+    path = write_sources(tmpdir, {"w.f": FIXED})[0]
+    opened = []
+    builtin_open = __builtin__.open
+
+    def counting_open(name, *args, **kwargs):
+        if name == path:
+            opened.append(name)
+        return builtin_open(name, *args, **kwargs)
+
+    monkeypatch.setattr(__builtin__, "open", counting_open)
+    assert File().parse(path)
+    assert opened == [path]
+
+    def broken(lines):
+        raise ValueError("broken directive")
+
+    monkeypatch.setattr(CodeAnalysis, "_fixed_form_directives", broken)
+    with pytest.raises(ValueError):
+        File().parse(path)
@@ -0,0 +1,132 @@
+# BSD 3-Clause License
+#
+# Copyright (c) 2017, Science and Technology Facilities Council
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# * Neither the name of the copyright holder nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+'''Tests for the module USE dependency graph.'''
+from StringIO import StringIO
+import pytest
+from conftest import write_sources, parse_files
+from CodeAnalysis import ModuleGraph
+
+DIAMOND = {
+    "base.f90": '''module base
+  use mpi
+end module base
+''',
+    "left.f90": '''module left
+  use base
+end module left
+''',
+    "right.f90": '''module right
+contains
+  subroutine r
+    use base
+  end subroutine r
+end module right
+''',
+    "top.f90": '''module top
+  use left
+  use right
+end module top
+''',
+    "main.f90": '''program main
+  use top
+end program main
+'''}
+
+CYCLE = {
+    "a.f90": "module a\n  use b\nend module a\n",
+    "b.f90": "module b\n  use c\nend module b\n",
+    "c.f90": "module c\n  use a\nend module c\n",
+    "d.f90": "module d\n  use a\nend module d\n"}
+
+
+def _graph(tmpdir, sources):
+    return ModuleGraph(parse_files(write_sources(tmpdir, sources)))
+
+
+def _relative(text, tmpdir):
+    return text.replace(str(tmpdir) + "/", "")
+
+
+def test_diamond(tmpdir):
+    ''' the levels, the build order and the critical path of a diamond,
+        including a USE in a module procedure '''
+    graph = _graph(tmpdir, DIAMOND)
+    assert graph.names == ["base", "left", "right", "top"]
+    assert graph.n_edges == 4
+    assert graph.dependencies("top") == ["left", "right"]
+    assert graph.dependents("base") == ["left", "right"]
+    assert graph.external() == ["mpi"]
+    assert graph.cycles() == []
+    assert graph.levels() == [["base"], ["left", "right"], ["top"]]
+    assert graph.compile_order() == ["base", "left", "right", "top"]
+    assert graph.critical_path() == (3, ["base", "left", "top"])
+    # the cost of a module weights the path
+    costs = {"base": 1, "left": 1, "right": 5, "top": 1}
+    assert graph.critical_path(lambda module: costs[module.name]) == \
+        (7, ["base", "right", "top"])
+
+
+def test_build_fragments(tmpdir):
+    ''' the Makefile and Ninja fragments make each object depend on the
+        objects of the modules it uses '''
+    graph = _graph(tmpdir, DIAMOND)
+    stream = StringIO()
+    graph.makefile(stream)
+    assert _relative(stream.getvalue(), tmpdir) == (
+        "left.o: base.o\n"
+        "main.o: top.o\n"
+        "right.o: base.o\n"
+        "top.o: left.o right.o\n")
+    stream = StringIO()
+    graph.ninja(stream)
+    assert _relative(stream.getvalue(), tmpdir) == (
+        "build base.o: fc base.f90\n"
+        "build left.o: fc left.f90 | base.o\n"
+        "build main.o: fc main.f90 | top.o\n"
+        "build right.o: fc right.f90 | base.o\n"
+        "build top.o: fc top.f90 | left.o right.o\n")
+
+
+def test_cycle(tmpdir):
+    ''' modules that USE each other are reported and there is no build
+        order '''
+    graph = _graph(tmpdir, CYCLE)
+    assert graph.cycles() == [["a", "b", "c"]]
+    assert graph.dependents("a") == ["c", "d"]
+    for method in [graph.levels, graph.compile_order, graph.critical_path]:
+        with pytest.raises(RuntimeError) as excinfo:
+            method()
+        assert "a b c" in str(excinfo.value)
+    stream = StringIO()
+    graph.makefile(stream)
+    assert _relative(stream.getvalue(), tmpdir) == (
+        "a.o: b.o\nb.o: c.o\nc.o: a.o\nd.o: a.o\n")
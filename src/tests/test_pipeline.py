@@ -0,0 +1,109 @@
+# BSD 3-Clause License
+#
+# Copyright (c) 2017, Science and Technology Facilities Council
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# * Neither the name of the copyright holder nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+'''Tests for the pipelined analysis.'''
+import multiprocessing
+import threading
+import pytest
+from conftest import write_sources, describe_files, link_summary
+import CodeAnalysis
+from CodeAnalysis import Link, Stats
+
+SOURCES = dict(("s{0:02}.f90".format(idx), '''subroutine s{0}(a)
+  real :: a(10)
+  a(1) = 2.0 * a(2)
+  call s{1}(a)
+end subroutine s{0}
+'''.format(idx, idx + 1)) for idx in range(20))
+SOURCES["bad.f90"] = "subroutine x(\n"
+
+
+def _analysis(tmpdir):
+    analysis = CodeAnalysis.CodeAnalysis()
+    analysis.add_directory(str(tmpdir))
+    return analysis
+
+
+@pytest.mark.parametrize("workers", [None, 2])
+def test_matches_parse(tmpdir, workers):
+    ''' the pipeline gives the same files, links and stats as parse '''
+    write_sources(tmpdir, SOURCES)
+    parsed = _analysis(tmpdir).parse()
+    link = Link()
+    link.transform(parsed)
+    stats = Stats()
+    stats.apply(parsed, quiet=True)
+
+    pipeline_link = Link()
+    pipeline_stats = Stats()
+    files = _analysis(tmpdir).pipeline(workers=workers, queue_size=2).run(
+        link=pipeline_link, stats=pipeline_stats)
+    assert describe_files(files) == describe_files(parsed)
+    assert link_summary(files, pipeline_link) == link_summary(parsed, link)
+    assert pipeline_stats.summary() == stats.summary()
+
+
+def _stopped(threads):
+    ''' whether only the threads (and no worker processes) that were
+        running before are left '''
+    return set(threading.enumerate()) == threads and \
+        multiprocessing.active_children() == []
+
+
+def test_stage_error_raised(tmpdir, monkeypatch):
+    ''' an error in the discovery stage is raised to the caller and the
+        pipeline stops '''
+    paths = write_sources(tmpdir, SOURCES)
+
+    def failing_walk(*args):
+        for file_path in paths[:3]:
+            yield file_path
+        raise IOError("directory went away")
+
+    monkeypatch.setattr(CodeAnalysis, "_walk_files", failing_walk)
+    threads = set(threading.enumerate())
+    with pytest.raises(IOError) as excinfo:
+        _analysis(tmpdir).pipeline(workers=2).run()
+    assert "went away" in str(excinfo.value)
+    assert _stopped(threads)
+
+
+def test_stopped_on_exception(tmpdir):
+    ''' when the consumer stops early the stages, which are blocked on
+        full queues, and the workers are shut down '''
+    write_sources(tmpdir, SOURCES)
+    threads = set(threading.enumerate())
+    files = _analysis(tmpdir).pipeline(workers=2, queue_size=1).files()
+    with pytest.raises(RuntimeError):
+        for _ in files:
+            raise RuntimeError("consumer failed")
+    files.close()
+    assert _stopped(threads)
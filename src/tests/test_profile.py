@@ -0,0 +1,227 @@
+# BSD 3-Clause License
+#
+# Copyright (c) 2017, Science and Technology Facilities Council
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# * Neither the name of the copyright holder nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+'''Tests for reading runtime profiles and overlaying them on the call
+    graph.'''
+from StringIO import StringIO
+import pytest
+from conftest import write_sources, parse_files, find_unit
+from CodeAnalysis import Link, Profile, ProfileOverlay
+
+SOURCES = {
+    "m.f90": '''module m
+contains
+  subroutine driver
+    call work
+    call work
+    call helper
+  end subroutine driver
+  subroutine work
+    call helper
+  end subroutine work
+  subroutine helper
+  end subroutine helper
+end module m
+''',
+    "main.f90": '''program main
+  use m
+  call driver
+end program main
+'''}
+
+GPROF = '''Flat profile:
+
+Each sample counts as 0.01 seconds.
+  %   cumulative   self              self     total
+ time   seconds   seconds    calls   s/call   s/call  name
+ 50.00      2.00     2.00        2     1.00     1.33  __m_MOD_work
+ 25.00      3.00     1.00        3     0.33     0.33  __m_MOD_helper
+ 12.50      3.50     0.50        1     0.50     3.50  __m_MOD_driver
+ 12.50      4.00     0.50                             memcpy
+
+\t\t     Call graph (explanation follows)
+
+
+granularity: each sample hit covers 2 byte(s) for 0.25% of 4.00 seconds
+
+index % time    self  children    called     name
+                                                 <spontaneous>
+[1]     87.5    0.00    3.50                 MAIN__ [1]
+                0.50    3.00       1/1           __m_MOD_driver [2]
+-----------------------------------------------
+                0.50    3.00       1/1           MAIN__ [1]
+[2]     87.5    0.50    3.00       1         __m_MOD_driver [2]
+                2.00    0.67       2/2           __m_MOD_work [3]
+                0.33    0.00       1/3           __m_MOD_helper [4]
+-----------------------------------------------
+                2.00    0.67       2/2           __m_MOD_driver [2]
+[3]     66.7    2.00    0.67       2         __m_MOD_work [3]
+                0.67    0.00       2/3           __m_MOD_helper [4]
+-----------------------------------------------
+                0.33    0.00       1/3           __m_MOD_driver [2]
+                0.67    0.00       2/3           __m_MOD_work [3]
+[4]     25.0    1.00    0.00       3         __m_MOD_helper [4]
+-----------------------------------------------
+
+Index by function name
+
+   [1] MAIN__    [2] __m_MOD_driver    [4] __m_MOD_helper
+'''
+
+PERF = '''# Samples: 4K of event 'cycles'
+# Overhead  Command  Shared Object  Symbol
+# ........  .......  .............  ......
+#
+    50.00%  prog     prog           [.] __m_MOD_work
+    25.00%  prog     prog           [.] __m_MOD_helper
+    12.50%  prog     prog           [.] __m_MOD_driver
+    12.50%  prog     libc-2.31.so   [.] memcpy
+'''
+
+PERF_CHILDREN = '''# Children      Self  Command  Shared Object  Symbol
+    87.50%    12.50%  prog     prog           [.] __m_MOD_driver
+    62.50%    50.00%  prog     prog           [.] __m_MOD_work
+'''
+
+CSV = '''Routine,Calls,Exclusive Time,Inclusive Time
+__m_MOD_work,2,2.0,2.5
+helper_,3,1.0,
+'''
+
+
+def _units(tmpdir):
+    files = parse_files(write_sources(tmpdir, SOURCES))
+    link = Link()
+    link.transform(files)
+    return link, dict((name, find_unit(files, name, "m")) for name in
+                      ["driver", "work", "helper"]), find_unit(files, "main")
+
+
+def test_read_gprof():
+    ''' the flat profile gives the exclusive times and calls, the call
+        graph the inclusive times and the edges '''
+    profile = Profile()
+    profile.read_gprof(StringIO(GPROF))
+    assert profile.unit == "s"
+    assert profile.routines == ["MAIN__", "__m_MOD_driver", "__m_MOD_helper",
+                                "__m_MOD_work", "memcpy"]
+    assert profile.exclusive("__m_MOD_work") == 2.0
+    assert profile.calls("__m_MOD_helper") == 3
+    assert profile.calls("memcpy") is None
+    assert profile.inclusive("__m_MOD_work") == pytest.approx(2.67)
+    assert profile.inclusive("MAIN__") == 3.5
+    assert profile.edges == {
+        ("MAIN__", "__m_MOD_driver"): [3.5, 1],
+        ("__m_MOD_driver", "__m_MOD_work"): [pytest.approx(2.67), 2],
+        ("__m_MOD_driver", "__m_MOD_helper"): [0.33, 1],
+        ("__m_MOD_work", "__m_MOD_helper"): [0.67, 2]}
+
+
+def test_read_perf():
+    ''' perf gives percentages, and inclusive ones with --children '''
+    profile = Profile()
+    profile.read_perf(StringIO(PERF))
+    assert profile.unit == "%"
+    assert profile.exclusive("__m_MOD_helper") == 25.0
+    assert profile.inclusive("__m_MOD_helper") is None
+    assert profile.edges == {}
+    profile = Profile()
+    profile.read_perf(StringIO(PERF_CHILDREN))
+    assert profile.exclusive("__m_MOD_driver") == 12.5
+    assert profile.inclusive("__m_MOD_driver") == 87.5
+
+
+def test_read_csv():
+    ''' the columns are found by name and empty values are skipped, and a
+        file without the columns needed is an error '''
+    profile = Profile()
+    profile.read_csv(StringIO(CSV))
+    assert profile.exclusive("helper_") == 1.0
+    assert profile.inclusive("helper_") is None
+    assert profile.inclusive("__m_MOD_work") == 2.5
+    assert profile.calls("__m_MOD_work") == 2
+    with pytest.raises(RuntimeError):
+        Profile().read_csv(StringIO("name,colour\nwork,red\n"))
+
+
+def test_overlay_measured_edges(tmpdir):
+    ''' with a gprof call graph the measured edge times are used '''
+    link, units, main = _units(tmpdir)
+    profile = Profile()
+    profile.read_gprof(StringIO(GPROF))
+    overlay = ProfileOverlay(link, profile)
+    assert overlay.unmapped == ["memcpy"]
+    assert overlay.unmapped_time == 0.5
+    assert overlay.total_time == pytest.approx(4.0)
+    assert overlay.exclusive(units["work"]) == 2.0
+    assert overlay.inclusive(units["work"]) == pytest.approx(2.67)
+    assert overlay.inclusive(main) == 3.5
+    assert overlay.calls(units["helper"]) == 3
+    assert overlay.edge_time(main, units["driver"]) == 3.5
+    assert overlay.edge_time(units["driver"], units["work"]) == \
+        pytest.approx(2.67)
+    assert overlay.edge_time(units["driver"], units["helper"]) == 0.33
+    assert overlay.edge_time(units["work"], units["helper"]) == 0.67
+    assert [(sub.name, time) for sub, time in overlay.hot_path("main")] == [
+        ("main", 3.5), ("driver", 3.5), ("work", pytest.approx(2.67)),
+        ("helper", 1.0)]
+
+
+def test_overlay_shared_edges(tmpdir):
+    ''' without a call graph the time of a unit is shared between its
+        callers by their number of call sites '''
+    link, units, main = _units(tmpdir)
+    profile = Profile()
+    profile.read_perf(StringIO(PERF))
+    overlay = ProfileOverlay(link, profile)
+    assert overlay.edge_time(units["driver"], units["helper"]) == 12.5
+    assert overlay.edge_time(units["work"], units["helper"]) == 12.5
+    assert overlay.inclusive(units["work"]) == 62.5
+    assert overlay.edge_time(units["driver"], units["work"]) == 62.5
+    assert overlay.inclusive(units["driver"]) == 87.5
+    assert overlay.inclusive(main) == 87.5
+    assert overlay.calls(units["work"]) is None
+    assert [sub.name for sub, _ in overlay.ranked(2)] == ["work", "helper"]
+
+
+def test_overlay_csv(tmpdir):
+    ''' a measured inclusive time is kept, a missing one is worked out, and
+        a name with a trailing underscore is mapped '''
+    link, units, main = _units(tmpdir)
+    profile = Profile()
+    profile.read_csv(StringIO(CSV))
+    overlay = ProfileOverlay(link, profile)
+    assert overlay.unmapped == []
+    assert overlay.inclusive(units["work"]) == 2.5
+    assert overlay.inclusive(units["helper"]) == 1.0
+    assert overlay.edge_time(units["work"], units["helper"]) == 0.5
+    assert overlay.exclusive(units["driver"]) == 0.0
+    assert overlay.inclusive(units["driver"]) == 3.0
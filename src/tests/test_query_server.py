@@ -0,0 +1,133 @@
+# BSD 3-Clause License
+#
+# Copyright (c) 2017, Science and Technology Facilities Council
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# * Neither the name of the copyright holder nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+'''Tests for the query server.'''
+import threading
+import time
+import urllib2
+import pytest
+from conftest import write_sources
+import json
+from CodeAnalysis import CodeAnalysis, Stats
+from query_server import QueryServer, request
+
+SOURCES = {"a.f90": '''subroutine a(x)
+  real :: x
+  call b(x)
+end subroutine a
+''',
+           "b.f90": '''subroutine b(x)
+  real :: x
+  x = 2.0 * x
+end subroutine b
+'''}
+
+
+@pytest.fixture
+def server(tmpdir):
+    ''' a server for a small tree, listening on a free port '''
+    write_sources(tmpdir, SOURCES)
+    analysis = CodeAnalysis()
+    analysis.add_directory(str(tmpdir))
+    server = QueryServer(analysis, port=0, poll_interval=None)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    while server._http is None:
+        time.sleep(0.01)
+    server.port = server._http.server_address[1]
+    yield server
+    server.shutdown()
+    thread.join(5.0)
+
+
+def test_shutdown_is_post_only(server):
+    ''' a GET of shutdown is refused, a POST stops the server '''
+    url = "http://127.0.0.1:{0}/shutdown".format(server.port)
+    with pytest.raises(urllib2.HTTPError) as excinfo:
+        urllib2.urlopen(url)
+    assert excinfo.value.code == 405
+    assert '"a"' in request("callers", "b", port=server.port)
+    assert request("shutdown", port=server.port) == "shutting down\n"
+    with pytest.raises(Exception):
+        for _ in range(100):
+            request("status", port=server.port)
+            time.sleep(0.05)
+
+
+def _server(directory, **kwargs):
+    analysis = CodeAnalysis()
+    analysis.add_directory(str(directory))
+    server = QueryServer(analysis, poll_interval=None, **kwargs)
+    server.load()
+    return server
+
+
+def _callers(server, name):
+    return [caller["name"] for caller in
+            json.loads(server.query("callers", name)[1])]
+
+
+def test_stale_database_updated(tmpdir):
+    ''' files edited after the database was saved are re-analysed when
+        it is loaded '''
+    source = tmpdir.mkdir("src")
+    write_sources(source, SOURCES)
+    database = str(tmpdir.join("tree.db"))
+    assert _callers(_server(source, database=database), "b") == ["a"]
+    write_sources(source, {
+        "a.f90": "subroutine a(x)\n  real :: x\n  call c(x)\n"
+                 "end subroutine a\n",
+        "c.f90": "subroutine c(x)\n  real :: x\nend subroutine c\n"})
+    server = _server(source, database=database)
+    assert _callers(server, "b") == []
+    assert _callers(server, "c") == ["a"]
+
+
+def test_stats_cached(tmpdir, monkeypatch):
+    ''' the stats are only worked out again after the tree changes '''
+    applied = []
+    apply = Stats.apply
+
+    def counted_apply(self, files, quiet=False):
+        applied.append(len(files))
+        return apply(self, files, quiet)
+
+    monkeypatch.setattr(Stats, "apply", counted_apply)
+    write_sources(tmpdir, SOURCES)
+    server = _server(tmpdir)
+    first = server.query("stats")
+    assert server.query("stats") == first
+    assert applied == [2]
+    write_sources(tmpdir, {"c.f90": "subroutine c()\nend subroutine c\n"})
+    assert server.check() == [str(tmpdir.join("c.f90"))]
+    assert server.query("stats") != first
+    assert applied == [2, 3]
@@ -0,0 +1,109 @@
+# BSD 3-Clause License
+#
+# Copyright (c) 2017, Science and Technology Facilities Council
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# * Neither the name of the copyright holder nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+'''Tests for the line oriented Scanner.'''
+from conftest import write_sources, parse_files, link_summary
+from CodeAnalysis import Link, Scanner
+
+SOURCES = {
+    "ma.f90": '''module ma
+  use mb
+  interface
+    subroutine ext(x)
+      real :: x
+    end subroutine ext
+  end interface
+contains
+  subroutine s1(x, n)
+    integer :: n
+    real :: x(n)
+    integer :: i
+    do i = 1, n
+      x(i) = twice(x(i)) + grid(i) ; call ext(x(i))
+    end do
+    call ext(x(1)); call &
+      ext(x(n))
+  end subroutine s1
+  real function twice(y)
+    real :: y
+    twice = 2.0 * y  ! call not_a_call(y)
+  end function twice
+end module ma
+''',
+    "mb.f90": '''module mb
+  real :: grid(10)
+end module mb
+''',
+    "ext.f": '''C     A fixed form file
+      SUBROUTINE EXT(X)
+      REAL X
+      X = 1.0
+      CALL
+     &     EXT2(X)
+      END
+      SUBROUTINE EXT2(X)
+      REAL X
+      END
+''',
+    "main.f90": '''program main
+  use ma
+  real :: y(3)
+  call s1(y, 3)
+  print *, "call s1(y, 3)"
+end program main
+'''}
+
+
+def _units(files):
+    return [(unit.kind, unit.name.lower(), unit.module, sorted(unit.uses))
+            for my_file in files for unit in my_file.all_subroutines]
+
+
+def test_scan_matches_parse(tmpdir):
+    ''' the scanned files have the same units and, once linked, the same
+        calls as the parsed files '''
+    paths = write_sources(tmpdir, SOURCES)
+    parsed = parse_files(paths)
+    scanned = [Scanner().scan(path) for path in paths]
+    assert all(my_file.parsed_ok for my_file in scanned)
+    assert _units(scanned) == _units(parsed)
+    parsed_link = Link()
+    parsed_link.transform(parsed)
+    scanned_link = Link()
+    scanned_link.transform(scanned)
+    # array elements are only told apart from function references by the
+    # link, so compare the calls and the references that were linked
+    assert [call for call in link_summary(scanned, scanned_link)[0]
+            if not call[3] or call[-1] is not None] == \
+        [call for call in link_summary(parsed, parsed_link)[0]
+         if not call[3] or call[-1] is not None]
+    assert link_summary(scanned, scanned_link)[1:] == \
+        link_summary(parsed, parsed_link)[1:]
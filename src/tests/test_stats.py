@@ -0,0 +1,86 @@
+# BSD 3-Clause License
+#
+# Copyright (c) 2017, Science and Technology Facilities Council
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# * Neither the name of the copyright holder nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+'''Tests for the statement type table and the Stats engine.'''
+from conftest import write_sources
+from test_file import MODULE
+from CodeAnalysis import CodeAnalysis, Stats, StatementTypes, \
+    statement_types
+
+
+def test_statement_types():
+    ''' each fparser statement type has an index and a category, and any
+        other type is counted as other '''
+    from fparser import statements, typedecl_statements, block_statements
+    types = statement_types()
+    assert types is statement_types()
+    for type_statement, category in [
+            (statements.Comment, StatementTypes.COMMENT),
+            (typedecl_statements.Real, StatementTypes.DECLARATION),
+            (statements.Call, StatementTypes.CODE),
+            (block_statements.Module, StatementTypes.CODE)]:
+        idx = types.index(type_statement)
+        assert types.names[idx] == type_statement.__name__
+        assert types.categories[idx] == category
+    assert types.index(dict) == types.other_index
+    assert types.categories[types.other_index] == StatementTypes.OTHER
+    assert list(types.new_counts()) == [0] * len(types)
+
+
+def test_stats(tmpdir):
+    ''' the statement counts, totals and breakdowns of a representative
+        module, an empty file and a file that fails to parse '''
+    paths = write_sources(tmpdir, {"a.f90": MODULE, "b.f90": "",
+                                   "c.f90": "subroutine x(\n"})
+    files = list(CodeAnalysis._parse_files(paths))
+    types = statement_types()
+    assert dict((types.names[idx], count) for idx, count in
+                enumerate(files[0].statement_counts) if count) == {
+                    "Assignment": 2, "Call": 4, "Comment": 1,
+                    "Contains": 2, "Do": 1, "EndDo": 1, "EndFunction": 1,
+                    "EndModule": 1, "EndSubroutine": 3, "Function": 1,
+                    "Implicit": 1, "Integer": 2, "Module": 1, "Real": 2,
+                    "Subroutine": 3, "Use": 2}
+    stats = Stats()
+    stats.apply(files, quiet=True)
+    assert stats.summary() == {
+        "files": 3, "files successfully parsed": 1,
+        "files failed to parse": 1, "files that are empty": 1,
+        "modules": 1, "modules without subroutines": 0,
+        "subroutines outside modules": 1, "subroutines inside modules": 2,
+        "functions": 1, "programs": 0, "block data": 0, "statements": 28,
+        "comments": 1, "declarations": 5, "code statements": 22}
+    # name, lines, comments, declarations, code statements, calls
+    assert stats.breakdown("file") == [(paths[0], 28, 1, 5, 22, 4)]
+    assert stats.breakdown("module") == [("m", 25, 1, 5, 19, 3)]
+    assert stats.breakdown("subroutine") == [
+        ("ext", 3, 0, 0, 3, 1), ("s", 16, 1, 3, 9, 2),
+        ("inner", 3, 0, 0, 3, 1), ("f", 4, 0, 1, 3, 0)]
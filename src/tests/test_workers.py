@@ -0,0 +1,70 @@
+# BSD 3-Clause License
+#
+# Copyright (c) 2017, Science and Technology Facilities Council
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# * Neither the name of the copyright holder nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+'''Tests for parsing files in a pool of worker processes.'''
+from conftest import write_sources, describe_files
+from CodeAnalysis import CodeAnalysis
+
+SOURCES = dict(("s{0}.f90".format(idx), '''module m{0}
+  use m{1}
+contains
+  subroutine s{0}(a)
+    real :: a(10)
+    a(1) = f{0}(a(2))
+    call s{1}(a)
+  end subroutine s{0}
+  real function f{0}(x)
+    real :: x
+    f{0} = 2.0 * x
+  end function f{0}
+end module m{0}
+'''.format(idx, idx + 1)) for idx in range(8))
+SOURCES["bad.f90"] = "subroutine x(\n"
+SOURCES["empty.f90"] = "\n"
+
+
+def test_workers_match_serial(tmpdir):
+    ''' parsing with several workers gives the same files, in the same
+        order and including the failures, as parsing them one at a time '''
+    paths = write_sources(tmpdir, SOURCES)
+    serial = list(CodeAnalysis._parse_files(paths, release=True))
+    parallel = list(CodeAnalysis._parse_files(paths, workers=3))
+    assert [my_file.path for my_file in parallel] == paths
+    assert describe_files(parallel) == describe_files(serial)
+    assert [my_file.parsed_ok for my_file in serial].count(False) == 1
+
+    analysis = CodeAnalysis()
+    analysis.add_directory(str(tmpdir))
+    in_process = analysis.parse()
+    analysis = CodeAnalysis()
+    analysis.add_directory(str(tmpdir))
+    assert describe_files(analysis.parse(workers=3)) == \
+        describe_files(in_process)